@@ -1,4 +1,5 @@
 import os
+import sys
 import requests
 from langchain_openai import AzureOpenAIEmbeddings
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
@@ -8,6 +9,10 @@ from langchain_community.document_loaders import UnstructuredMarkdownLoader, PyP
 import nltk
 import time
 
+# The embeddings cache is shared with the backend
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "..", "backend"))
+from modules.embedding_cache import CachedEmbeddings, EmbeddingStore
+
 nltk.download('punkt_tab')
 nltk.download('averaged_perceptron_tagger_eng')
 
@@ -66,12 +71,20 @@ elif os.getenv("EMBEDDINGS_MODEL") == "google":
 else:
     embeddings = AzureOpenAIEmbeddings(model="ada-002", openai_api_version="2024-06-01")
 
+# Chunks that didn't change since the last run are not embedded again.
+# The file is kept between runs by the workflow cache, and only needs room for the chunks of the knowledge base
+embedding_cache_path = os.getenv("EMBEDDING_CACHE_PATH", ".cache/embeddings/embedding_cache.sqlite")
+os.makedirs(os.path.dirname(embedding_cache_path) or ".", exist_ok=True)
+embedding_cache = EmbeddingStore(embedding_cache_path, max_disk_entries=int(os.getenv("EMBEDDING_CACHE_ENTRIES", "10000")))
+embeddings = CachedEmbeddings(embeddings, embeddings.model, embedding_cache)
+
 # Connect with database
+# The embeddings model is passed whole, so each batch of chunks is embedded in a single call
 azure_search = AzureSearch(
     azure_search_endpoint=os.getenv("AZURE_SEARCH_URI"),
     azure_search_key=os.getenv("AZURE_SEARCH_KEY"),
     index_name=index_name,
-    embedding_function=embeddings.embed_query
+    embedding_function=embeddings
 )
 
 # Define how the text should be split:
@@ -103,3 +116,6 @@ for root, dirs, files in os.walk(source_folder):
         if len(file_chunks) > 0 :
             inserted_ids = batch_insert_chunks(file_chunks, batch_size=3, delay_between_batches=20)
             print(f"Inserted {len(inserted_ids)} documents")    
+
+embedding_cache.flush()
+print(f"Embeddings cache: {embedding_cache.stats()}")
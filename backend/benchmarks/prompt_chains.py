@@ -0,0 +1,74 @@
+# Micro-benchmark of the per-call overhead of the agents chains, without calling the LLM.
+# Compares the previous chain structure, which built its ChatPromptTemplate on every call from a lambda
+# and wrapped every input in its own RunnableLambda, with the prompts compiled once.
+#
+# Run from the backend folder: python -m benchmarks.prompt_chains
+from modules.utils import build_prompt
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
+import asyncio
+import time
+
+SYSTEM_PROMPT = (
+    "You are an AI assistant for question-answering tasks. "
+    "Use only the following pieces of retrieved context to answer the question. "
+    "\n\n"
+    "Context: {context}"
+    "\n\n"
+    "Chat history: {history}"
+)
+
+INPUTS = {
+    "question": "Which technologies were used in the final project?",
+    "context": "The project uses FastAPI, LangGraph and Azure OpenAI. " * 20,
+    "history": [{ "role": "user", "content": "hi!" }, { "role": "bot", "content": "hi! how can I help you?" }]
+}
+
+# Stands in for the LLM, so that only the chain overhead is measured
+fake_llm = RunnableLambda(lambda prompt: "CONTINUE")
+
+
+def build_previous_chain():
+    prompt = lambda inputs: ChatPromptTemplate.from_messages(
+        [
+            ("system", inputs["system_prompt"]),
+            ("human", inputs["human_prompt"]),
+        ]
+    )
+    return (
+        { "question": RunnableLambda(lambda inputs: inputs["question"]), "context": RunnableLambda(lambda inputs: inputs["context"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
+        | RunnableLambda(lambda inputs: prompt({"system_prompt": SYSTEM_PROMPT, "human_prompt": inputs["question"]}))
+        | fake_llm
+        | StrOutputParser()
+    )
+
+
+def build_compiled_chain():
+    return build_prompt(SYSTEM_PROMPT) | fake_llm | StrOutputParser()
+
+
+def measure(name, chain, iterations):
+    chain.invoke(INPUTS)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        chain.invoke(INPUTS)
+    sync_time = (time.perf_counter() - start) / iterations
+
+    async def run():
+        await chain.ainvoke(INPUTS)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            await chain.ainvoke(INPUTS)
+        return (time.perf_counter() - start) / iterations
+    async_time = asyncio.run(run())
+
+    print(f"{name:<10} invoke {sync_time * 1e6:8.0f} us   ainvoke {async_time * 1e6:8.0f} us")
+    return sync_time, async_time
+
+
+if __name__ == "__main__":
+    iterations = 2000
+    previous = measure("previous", build_previous_chain(), iterations)
+    compiled = measure("compiled", build_compiled_chain(), iterations)
+    print(f"speedup    invoke {previous[0] / compiled[0]:8.1f}x   ainvoke {previous[1] / compiled[1]:8.1f}x")
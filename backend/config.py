@@ -32,4 +32,245 @@ api_config = {
     "spec_url": os.getenv("API_SPEC_URL"),
     "spec_format": os.getenv("API_SPEC_FORMAT"),
     "endpoint_filter": ["/users/{username}"]
-}
\ No newline at end of file
+}
+
+graph_config = {
+    # Run all the relevant agents at the same time instead of one after another
+    "parallel": True,
+    # Skip the summarizer when only one agent provided a real answer
+    "bypass_summarizer": True,
+    # Default time in seconds for /api/ask to answer, it can be overridden per request
+    "request_timeout": 60,
+    # Seconds of the request time kept for the summarizer, the rest is split between the agents
+    "summarizer_reserve": 10,
+    # Maximum fraction of the request time kept for the summarizer, so short timeouts still leave time to the agents
+    "summarizer_reserve_fraction": 0.25,
+    # Identical questions asked at the same time, with the same recent history, share one graph execution
+    "coalesce": True,
+    # Start retrieving the data for every agent while the supervisor is picking them
+    "speculative": False
+}
+
+tracing_config = {
+    # Number of request traces kept for /api/trace, in memory and in the file
+    "max_traces": 500,
+    # SQLite file where the finished traces are shared by the workers, None to keep them only in the worker memory
+    "path": os.getenv("TRACE_STORE_PATH", "traces.sqlite")
+}
+
+summarizer_config = {
+    # Agent answers matching any of these patterns are not considered real answers
+    "non_answer_patterns": [
+        r"\bi (do not|don['’]?t) know\b",
+        r"\bi (could not|couldn['’]?t|cannot|can['’]?t) find\b",
+        r"\bi['’]?m not sure\b"
+    ]
+}
+
+cache_config = {
+    # Answer questions similar enough to a recent one with the same answer, without running the graph.
+    # Off by default: questions that only differ in an entity, e.g. "sales in March" and "sales in May", can be very similar
+    "enabled": False,
+    # Minimum cosine similarity between the embeddings of two questions to reuse the answer.
+    # With ada-002, questions that only differ in an entity often score between 0.95 and 0.97
+    "similarity_threshold": 0.98,
+    # Seconds an answer can be reused
+    "ttl": 3600,
+    # Maximum number of answers kept, the least recently used ones are dropped first
+    "max_entries": 1000,
+    # SQLite file where DELETE /api/cache is shared with the other workers, None if there is a single worker
+    "invalidations_path": os.getenv("CACHE_INVALIDATIONS_PATH", "cache_invalidations.sqlite")
+}
+
+router_config = {
+    # "llm" asks the supervisor LLM for the relevant agents,
+    # "embedding" compares the question with the agents skills and examples, and asks the LLM only if it is not clear
+    "mode": "llm",
+    # When the LLM routes, it also tells for each agent if it can answer right away, saving a call per agent
+    "fused": False,
+    # "centroid" compares with the average of each agent's texts, "top_k" with the most similar texts
+    "strategy": "centroid",
+    "top_k": 5,
+    # Minimum cosine similarity of the best agent to pick it without the LLM
+    "min_similarity": 0.7,
+    # Minimum difference in similarity between the best and the second agent to pick it without the LLM
+    "min_margin": 0.05,
+    # Example questions for each agent, they make the routing more accurate
+    "examples": {
+        "agent_rag": ["What is Fabian's master project about?", "Which technologies were used in the final project?"],
+        "agent_sql": ["Which are the best selling products?", "How many orders were placed last year?"],
+        "agent_csv": ["Which Marvel characters appear the most?", "How many DC heroes have blue eyes?"],
+        "agent_api": ["How many public repositories does fabimass have?", "When was the GitHub user fabimass created?"]
+    }
+}
+
+routing_cache_config = {
+    # Remember the agents picked for each question and recent history
+    "enabled": True,
+    # Maximum number of decisions kept, the least recently used ones are dropped first
+    "max_entries": 5000,
+    # Seconds a decision is kept
+    "ttl": 86400,
+    # Number of chat history rows read at startup to load past decisions, the last session read is always read whole. 0 to disable
+    "warm_up_rows": 5000
+}
+
+batch_config = {
+    # Maximum number of questions of a batch answered at the same time, a batch can ask for less
+    "concurrency": 8,
+    # Maximum number of questions in a batch
+    "max_questions": 1000
+}
+
+llm_config = {
+    "api_version": "2023-06-01-preview",
+    # Connections open at the same time to each deployment, it should cover the questions answered at the same time
+    # (a batch runs up to batch_config["concurrency"]) times the LLM calls each one makes in parallel (one per agent)
+    "max_connections": 50,
+    # Idle connections kept open to each deployment, so the next calls skip the TCP and TLS handshakes
+    "max_keepalive_connections": 20,
+    # Seconds an idle connection is kept open
+    "keepalive_expiry": 120,
+    # Seconds to wait for the LLM to answer
+    "timeout": 120
+}
+
+models_config = {
+    # Deployment and generation parameters (max_tokens, temperature...) of the chains without their own entry
+    "default": { "deployment_name": "gpt-4o" },
+    # Model of each chain role, as "<chain>" for every component or "<component>.<chain>" for just one of them.
+    # A chain can also skip the LLM responses cache with "cache": False, or keep its responses for "cache_ttl" seconds.
+    # The short classification and selection steps can run on a smaller deployment, e.g.
+    # "entry_point_chain": { "deployment_name": "gpt-4o-mini" },
+    # "agent_csv.file_selector_chain": { "deployment_name": "gpt-4o-mini", "max_tokens": 100 }
+    "chains": {
+        "entry_point_chain": { "deployment_name": "gpt-4o" },
+        "file_selector_chain": { "deployment_name": "gpt-4o" },
+        "endpoint_selector_chain": { "deployment_name": "gpt-4o" },
+        # A cached query or code that failed would be run again for as long as it is cached
+        "query_generator_chain": { "deployment_name": "gpt-4o", "cache": False },
+        "query_reviewer_chain": { "deployment_name": "gpt-4o", "cache": False },
+        "code_generator_chain": { "deployment_name": "gpt-4o", "cache": False },
+        "code_reviewer_chain": { "deployment_name": "gpt-4o", "cache": False },
+        # The summary is streamed, a cached one would come in a single piece
+        "summarizer_chain": { "deployment_name": "gpt-4o", "cache": False }
+    }
+}
+
+llm_cache_config = {
+    # Reuse the response of an LLM call made before with the same deployment, parameters and prompt
+    "enabled": True,
+    # SQLite file where the responses are kept between restarts, None to keep them only in memory
+    "path": os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite"),
+    # Responses kept in memory, the least recently used ones are dropped first
+    "max_entries": 5000,
+    # Responses kept in the SQLite file, the oldest ones are dropped at startup
+    "max_disk_entries": 100000,
+    # Seconds a response is reused, chains can override it in models_config
+    "ttl": 86400
+}
+
+embedding_cache_config = {
+    # Reuse the vectors of the texts embedded before with the same embeddings model, instead of calling the model again
+    "enabled": True,
+    # SQLite file where the vectors are kept between restarts, shared by the workers. None to keep them only in memory
+    "path": os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite"),
+    # Vectors kept in memory, the least recently used ones are dropped first
+    "max_entries": 10000,
+    # Vectors kept in the SQLite file, the oldest ones are dropped at startup and shutdown
+    "max_disk_entries": 10000
+}
+
+prompt_budget_config = {
+    # Tokenizer of the deployments, used to count the tokens of the prompts
+    "encoding": "o200k_base",
+    # Maximum tokens of each variable section of the prompts, None for no limit.
+    # The oldest history entries are dropped first, the other sections keep their beginning
+    "default": {
+        "history": 2000,
+        "context": 6000,
+        "schema": 16000,
+        "result": 3000,
+        "index": 2000,
+        "endpoints": 4000,
+        "agents_output": 4000
+    },
+    # Budgets of a chain role, as "<chain>" for every component or "<component>.<chain>" for just one of them
+    "chains": {
+        "entry_point_chain": { "history": 1000 },
+        "supervisor_chain": { "history": 1000 }
+    }
+}
+
+admission_config = {
+    # Hold back the LLM calls that would go over the deployment limits, instead of letting Azure OpenAI reject them
+    "enabled": True,
+    # Limits of each deployment, calls over them wait in a queue where /api/ask goes before /api/greetings and batches
+    "deployments": {
+        "gpt-4o": {
+            # LLM calls running at the same time, it should be below llm_config["max_connections"]
+            "max_concurrency": 24,
+            # Estimated prompt and answer tokens per minute, a bit below the deployment quota
+            "tokens_per_minute": 150000
+        }
+    },
+    # Limits of the deployments not listed, None for no limit
+    "default": {
+        "max_concurrency": 24,
+        "tokens_per_minute": None
+    },
+    # Tokens expected in an answer when the chain doesn't set max_tokens
+    "completion_tokens": 500,
+    # Workers of the server, the limits above are for the whole deployment and are split between them
+    "workers": int(os.getenv("WEB_CONCURRENCY", "1"))
+}
+
+circuit_breaker_config = {
+    # Retry the transient errors of the agents backends, and skip the agents while their backend is down
+    "enabled": True,
+    # Settings of every backend
+    "default": {
+        # Failures within the window, in seconds, that open the circuit and make the agent unavailable
+        "failure_threshold": 5,
+        "window": 60,
+        # Seconds before trying a backend again after the circuit opened
+        "reset_timeout": 30,
+        # Extra attempts for the transient errors, waiting a random time up to backoff * 2^attempt seconds, capped at max_backoff
+        "retries": 2,
+        "backoff": 0.2,
+        "max_backoff": 2
+    },
+    # Settings of a backend, as "<backend>" for every agent or "<agent>.<backend>" for just one,
+    # the backends are "vector_store", "database", "blob_storage" and "api"
+    "backends": {}
+}
+
+health_config = {
+    # Probe the agents backends in the background, /api/agents answers with the latest results.
+    # If disabled, every call to /api/agents probes the backends
+    "enabled": True,
+    # Seconds between two rounds of probes
+    "interval": 30,
+    # Seconds each probe can take before the agent is reported as unhealthy
+    "timeout": 5
+}
+
+startup_config = {
+    # Agents connect to their backend (vector store, database, API spec) on first use instead of at startup
+    "lazy_backends": True,
+    # Connect the lazy backends in the background right after startup, so the first questions don't wait for them
+    "warm_up": True
+}
+
+logging_config = {
+    # Level of every module, e.g. "DEBUG" also logs the schemas, documents, queries and results sent to the LLM
+    "level": "INFO",
+    # Levels of single modules over the default one, e.g. { "modules.agent_sql": "DEBUG" }
+    "levels": {},
+    # "text" for reading them in a terminal, "json" for one JSON object per line for the log ingestion
+    "format": "text",
+    # Characters kept of each message, longer payloads are cut. None to keep them whole
+    "max_payload": 1000,
+    # Fraction of the records of each level that are written, e.g. { "DEBUG": 0.1 } writes one in ten debug records
+    "sample_rates": {}
+}
@@ -1,9 +1,15 @@
 import os
 import uuid
-from http.client import HTTPException
-from fastapi import FastAPI, Depends
-from config import rag_config, sql_config, csv_config, api_config
-from modules.models import QuestionModel, AnswerModel, FeedbackModel
+import json
+import time
+import asyncio
+import logging
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, Depends, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from config import rag_config, sql_config, csv_config, api_config, graph_config, summarizer_config, tracing_config, startup_config, cache_config, batch_config, router_config, routing_cache_config, llm_config, models_config, llm_cache_config, prompt_budget_config, admission_config, logging_config, circuit_breaker_config, health_config, embedding_cache_config
+from modules.models import QuestionModel, AnswerModel, FeedbackModel, BatchModel
 from modules.agent_rag import AgentRag
 from modules.agent_sql import AgentSql
 from modules.agent_csv import AgentCsv
@@ -12,53 +18,166 @@ from modules.supervisor import Supervisor
 from modules.summarizer import Summarizer
 from modules.greeter import Greeter
 from modules.graph import Graph
+from modules.tracing import ExecutionTrace, TraceStore
+from modules.single_flight import SingleFlight
+from modules.answer_cache import SemanticCache, InvalidationLog
+from modules.router import EmbeddingRouter
+from modules.routing_cache import RoutingCache
+from modules.utils import get_question_key
+from modules.llm import llm_registry
+from modules.llm_cache import LLMCache, ResponseStore
+from modules.embedding_cache import EmbeddingStore
+from modules.admission import admission, llm_priority
+from modules.prompt_budget import prompt_budget
+from modules.logs import setup_logging
+from modules.circuit_breaker import circuit_breakers
+from modules.health import HealthMonitor
+from modules import metrics
 from azure.data.tables import TableServiceClient, TableEntity
+from azure.data.tables.aio import TableServiceClient as AsyncTableServiceClient
 
+logger = logging.getLogger(__name__)
 
 # Entry point to use FastAPI
 app = FastAPI()
 
 def initial_setup():
-    print("Running initial setup...")
+    logger.info("Running initial setup...")
+
+    # Time spent building each component, reported by /api/ready
+    timings = {}
+    lazy = startup_config["lazy_backends"]
+
+    # Responses of the LLM calls, repeated calls are answered without calling the LLM
+    llm_cache = None
+    if llm_cache_config["enabled"]:
+        store = build_component(timings, "llm_cache", lambda: ResponseStore(llm_cache_config["path"], llm_cache_config["max_entries"], llm_cache_config["max_disk_entries"]))
+        llm_cache = LLMCache(store, llm_cache_config["ttl"])
+
+    # Every component gets its LLM clients from the registry, which keeps one connection pool per deployment
+    # and picks the model of each chain
+    llm_registry.configure(**llm_config, models=models_config, cache=llm_cache)
+    # The LLM calls of every component wait their turn in the same per deployment queues
+    admission.configure(**admission_config)
+    # The sections of the prompts that grow with the data are kept within their token budgets
+    prompt_budget.configure(**prompt_budget_config)
+    # Each agent gets a circuit breaker for its backend, so it is skipped right away while the backend is down
+    circuit_breakers.configure(**circuit_breaker_config)
+
+    # Vectors of the questions embedded before, shared by the retrieval, the router and the answer cache
+    embedding_cache = None
+    if embedding_cache_config["enabled"]:
+        embedding_cache = build_component(timings, "embedding_cache", lambda: EmbeddingStore(embedding_cache_config["path"], embedding_cache_config["max_entries"], embedding_cache_config["max_disk_entries"]))
 
     # Agents instantiation
-    agent_rag = AgentRag(rag_config)
-    print(f"{agent_rag.name} ready.")
-    agent_sql = AgentSql(sql_config)
-    print(f"{agent_sql.name} ready.")
-    agent_csv = AgentCsv(csv_config)
-    print(f"{agent_csv.name} ready.")
-    agent_api = AgentApi(api_config)
-    print(f"{agent_api.name} ready.")
-    agents = [agent_rag, agent_sql, agent_csv, agent_api]
+    # The agents don't depend on each other, so they are built at the same time
+    agent_builders = [
+        (f"agent_{rag_config['agent_id']}", lambda: AgentRag(rag_config, lazy=lazy, embedding_cache=embedding_cache)),
+        (f"agent_{sql_config['agent_id']}", lambda: AgentSql(sql_config, lazy=lazy)),
+        (f"agent_{csv_config['agent_id']}", lambda: AgentCsv(csv_config)),
+        (f"agent_{api_config['agent_id']}", lambda: AgentApi(api_config, lazy=lazy))
+    ]
+    with ThreadPoolExecutor(max_workers=len(agent_builders)) as executor:
+        agents = list(executor.map(lambda builder: build_component(timings, *builder), agent_builders))
+
+    # The RAG agent's embeddings model is shared with the router and the answer cache
+    agent_rag = next(agent for agent in agents if isinstance(agent, AgentRag))
+
+    # Router instantiation, it embeds the agents skills on first use
+    router = None
+    if router_config["mode"] == "embedding":
+        router = EmbeddingRouter(agent_rag.aembed_query, agent_rag.aembed_documents, agents, examples=router_config["examples"], strategy=router_config["strategy"], top_k=router_config["top_k"], min_similarity=router_config["min_similarity"], min_margin=router_config["min_margin"])
+
+    # Cache of the routing decisions
+    routing_cache = RoutingCache(routing_cache_config["max_entries"], routing_cache_config["ttl"]) if routing_cache_config["enabled"] else None
 
     # Supervisor & summarizer instantiation
-    supervisor = Supervisor(agents)
-    print("Supervisor ready.")
-    summarizer = Summarizer()
-    print("Summarizer ready.")
+    supervisor = build_component(timings, "supervisor", lambda: Supervisor(agents, router=router, cache=routing_cache, fused=router_config["fused"]))
+    summarizer = build_component(timings, "summarizer", lambda: Summarizer(summarizer_config))
 
     # Graph instantiation
-    graph = Graph(supervisor, summarizer, agents)
-    print("Graph ready.")
+    graph = build_component(timings, "graph", lambda: Graph(supervisor, summarizer, agents, parallel=graph_config["parallel"], bypass_summarizer=graph_config["bypass_summarizer"], summarizer_reserve=graph_config["summarizer_reserve"], summarizer_reserve_fraction=graph_config["summarizer_reserve_fraction"], speculative=graph_config["speculative"]))
 
     # Tables instantiation
     table_service = TableServiceClient.from_connection_string(conn_str=os.getenv("AZURE_STORAGE_CONNECTION_STRING"))
-    feedback_table = table_service.get_table_client("Feedback")
-    print("Feedback table client ready.")
-    history_table = table_service.get_table_client("ChatHistory")
-    print("History table client ready.") 
+    feedback_table = build_component(timings, "feedback_table", lambda: table_service.get_table_client("Feedback"))
+    history_table = build_component(timings, "history_table", lambda: table_service.get_table_client("ChatHistory"))
+
+    # Async tables instantiation, used in the request path so that waiting on storage doesn't block a worker
+    async_table_service = AsyncTableServiceClient.from_connection_string(conn_str=os.getenv("AZURE_STORAGE_CONNECTION_STRING"))
+    async_history_table = build_component(timings, "async_history_table", lambda: async_table_service.get_table_client("ChatHistory"))
 
     # Greeter instantiation
-    greeter = Greeter(agents)
-    print("Greeter ready.")
+    greeter = build_component(timings, "greeter", lambda: Greeter(agents))
+
+    # Traces of the latest requests
+    trace_store = TraceStore(tracing_config["max_traces"], tracing_config["path"])
+
+    # Semantic cache of the answers, the questions are embedded with the model of the RAG knowledge base
+    invalidations = InvalidationLog(cache_config["invalidations_path"]) if cache_config["invalidations_path"] else None
+    answer_cache = SemanticCache(agent_rag.aembed_query, similarity_threshold=cache_config["similarity_threshold"], ttl=cache_config["ttl"], max_entries=cache_config["max_entries"], invalidations=invalidations)
+
+    # Executions of the graph in flight, shared by identical questions
+    single_flight = SingleFlight()
+
+    # Latest status of the agents backends, probed in the background
+    health_monitor = HealthMonitor(agents, interval=health_config["interval"], timeout=health_config["timeout"])
     
-    return { "graph": graph, "feedback_table": feedback_table, "history_table": history_table, "agents": agents, "greeter": greeter }
+    return { "graph": graph, "feedback_table": feedback_table, "history_table": history_table, "async_table_service": async_table_service, "async_history_table": async_history_table, "agents": agents, "greeter": greeter, "trace_store": trace_store, "single_flight": single_flight, "answer_cache": answer_cache, "summarizer": summarizer, "router": router, "routing_cache": routing_cache, "health_monitor": health_monitor, "embedding_cache": embedding_cache, "timings": timings }
+
+def build_component(timings, name, builder):
+    start = time.perf_counter()
+    component = builder()
+    timings[name] = round(time.perf_counter() - start, 3)
+    logger.info("%s ready in %ss.", name, timings[name])
+    return component
+
+async def warm_up(setup: dict):
+    # Connects the lazy backends in the background, each agent gets ready on its own
+    async def connect(agent):
+        start = time.perf_counter()
+        connected = await asyncio.to_thread(agent.ensure_connected)
+        setup["timings"][f"{agent.name}_backend"] = round(time.perf_counter() - start, 3)
+        logger.info("%s backend %s.", agent.name, 'ready' if connected else 'not available')
+    await asyncio.gather(*(connect(agent) for agent in setup["agents"] if hasattr(agent, "ensure_connected")))
+
+    # The router needs the embeddings model, so it is loaded once the backends are ready
+    if setup.get("router") is not None:
+        start = time.perf_counter()
+        try:
+            await setup["router"].aload()
+            setup["timings"]["router"] = round(time.perf_counter() - start, 3)
+        except Exception as e:
+            logger.error("Router says: ERROR %s", e)
 
 # Store initial setup in the application state during startup
 @app.on_event("startup")
 async def startup():
+    # Logs are written by a background thread, it is started first so the setup logs go through it
+    app.state.log_listener = setup_logging(**logging_config)
     app.state.setup = initial_setup()
+    if startup_config["lazy_backends"] and startup_config["warm_up"]:
+        # The task is kept in the state so it isn't garbage collected while running
+        app.state.warm_up = asyncio.create_task(warm_up(app.state.setup))
+    if routing_cache_config["enabled"] and routing_cache_config["warm_up_rows"] > 0:
+        app.state.warm_routing_cache = asyncio.create_task(warm_routing_cache(app.state.setup))
+    if health_config["enabled"]:
+        app.state.setup["health_monitor"].start()
+
+# Close the async clients on shutdown
+@app.on_event("shutdown")
+async def shutdown():
+    setup = getattr(app.state, 'setup', {})
+    if "async_table_service" in setup:
+        await setup["async_table_service"].close()
+    await llm_registry.aclose()
+    if "health_monitor" in setup:
+        await setup["health_monitor"].stop()
+    if setup.get("embedding_cache") is not None:
+        setup["embedding_cache"].flush()
+    # Writes the logs still in the queue
+    if hasattr(app.state, 'log_listener'):
+        app.state.log_listener.stop()
 
 # Dependency to retrieve agents and graph
 def get_setup():
@@ -71,31 +190,244 @@ def ping():
     return "pong"
 
 # Endpoint to check the status of each agent
+# The status comes from the latest background probes, refresh=true probes every agent right away
 @app.get("/api/agents")
-def ping_agents(setup: dict = Depends(get_setup)):
-    agents = []
-    for agent in setup["agents"]:
-        status = agent.check_connection()
-        agents.append({ "agent": agent.name, "healthy": status["healthy"], "info": status["info"] })
-    return agents
+async def ping_agents(refresh: bool = False, setup: dict = Depends(get_setup)):
+    monitor = setup["health_monitor"]
+    if refresh or not health_config["enabled"]:
+        return await monitor.probe_all()
+    return await monitor.probe_pending()
+
+# Endpoint to check which agents are ready, without probing their backends
+@app.get("/api/ready")
+def ready(setup: dict = Depends(get_setup)):
+    agents = [{ "agent": agent.name, "ready": is_agent_ready(agent) } for agent in setup["agents"]]
+    return { "ready": all(agent["ready"] for agent in agents), "agents": agents, "timings": setup["timings"], "circuit_breakers": circuit_breakers.status(), "embedding_cache": setup["embedding_cache"].stats() if setup.get("embedding_cache") is not None else None }
+
+def is_agent_ready(agent):
+    # Agents without a lazy backend are ready as soon as they are built
+    return agent.is_ready() if hasattr(agent, "is_ready") else True
 
 # This endpoint receives a prompt and generates a response
 @app.post("/api/ask")
-def generate_answer(body: QuestionModel, setup: dict = Depends(get_setup)):
+async def generate_answer(body: QuestionModel, setup: dict = Depends(get_setup)):
+    session_id = body.session_id
+    trace = start_trace(setup, "/api/ask")
+    metrics.requests_in_flight.inc(endpoint="/api/ask")
+
+    try:
+        # Retrieve conversation history or start a new one
+        with trace.span("history_read"):
+            session_history = await aget_chat_history(session_id, setup)
+
+        response = await answer_question(body, session_history, setup, trace)
+        with trace.span("history_write"):
+            await aadd_to_chat_history(AnswerModel(**response), setup=setup)
+        trace.end()
+        return response
+    except Exception as e:
+        trace.end(error=e)
+        raise HTTPException(status_code=500, detail=f"Error: {e}")
+    finally:
+        metrics.requests_in_flight.dec(endpoint="/api/ask")
+
+
+# This endpoint receives a prompt and streams the response as Server-Sent Events:
+#  - "agents" when the supervisor picks the relevant agents
+#  - "agent" every time an agent answers
+#  - "token" for each piece of the final answer
+#  - "answer" at the end, with the same payload as /api/ask
+@app.post("/api/ask/stream")
+async def stream_answer(body: QuestionModel, setup: dict = Depends(get_setup)):
     session_id = body.session_id
     prompt = body.question
     graph = setup["graph"]
+    trace = start_trace(setup, "/api/ask/stream")
 
     # Retrieve conversation history or start a new one
-    session_history = get_chat_history(session_id, setup)
+    with trace.span("history_read"):
+        session_history = await aget_chat_history(session_id, setup)
+
+    async def event_stream():
+        metrics.requests_in_flight.inc(endpoint="/api/ask/stream")
+        try:
+            # A cached answer is streamed as if the graph answered in one go
+            cached, vector = await lookup_answer(body, session_history, setup, trace)
+            if cached is not None:
+                events = stream_cached_answer(cached)
+            else:
+                events = graph.astream(build_state(body, session_history, vector), config={ "callbacks": [trace] })
+
+            async for event, data in events:
+                if event == "end":
+                    if cached is None:
+                        store_answer(body, session_history, vector, data, setup)
+                    response = {"question": prompt, "answer": data["answer"], "session_id": session_id, "agents": data["agents"], "timed_out": data.get("timed_out", []), "unavailable": data.get("unavailable", []), "request_id": trace.request_id, "cached": cached is not None}
+                    with trace.span("history_write"):
+                        await aadd_to_chat_history(AnswerModel(**response), setup=setup)
+                    trace.end()
+                    yield format_sse("answer", response)
+                else:
+                    yield format_sse(event, data)
+        except Exception as e:
+            # The response has already started, so the error is sent as an event
+            trace.end(error=e)
+            yield format_sse("error", {"detail": f"Error: {e}"})
+        finally:
+            metrics.requests_in_flight.dec(endpoint="/api/ask/stream")
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def answer_question(body: QuestionModel, session_history, setup: dict, trace: ExecutionTrace):
+    prompt = body.question
+    graph = setup["graph"]
 
+    # Similar questions asked recently are answered from the cache
+    cached, vector = await lookup_answer(body, session_history, setup, trace)
+
+    async def run_graph():
+        result = await graph.ainvoke(build_state(body, session_history, vector), config={ "callbacks": [trace] })
+        store_answer(body, session_history, vector, result, setup)
+        return result
+
+    if cached is not None:
+        result = cached
+    elif graph_config["coalesce"]:
+        # The first request runs the graph and records its trace, the identical ones wait for its result.
+        # Each request still writes its own history record
+        result = await setup["single_flight"].run(get_question_key(prompt, session_history), run_graph)
+    else:
+        result = await run_graph()
+    return {"question": prompt, "answer": result["answer"], "session_id": body.session_id, "agents": result["agents"], "timed_out": result.get("timed_out", []), "unavailable": result.get("unavailable", []), "request_id": trace.request_id, "cached": cached is not None}
+
+
+# This endpoint answers a list of questions, a few at a time, and streams each answer as a Server-Sent Event as soon as it is ready:
+#  - "answer" with the same payload as /api/ask, plus the position of the question in the list
+#  - "error" with the position of the question, if it failed
+# The chat history is only read and written if requested
+@app.post("/api/ask/batch")
+async def batch_answer(body: BatchModel, setup: dict = Depends(get_setup)):
+    if len(body.questions) > batch_config["max_questions"]:
+        raise HTTPException(status_code=400, detail=f"A batch can't have more than {batch_config['max_questions']} questions.")
+    semaphore = asyncio.Semaphore(max(min(body.concurrency or batch_config["concurrency"], batch_config["concurrency"]), 1))
+
+    async def answer(index, question: QuestionModel):
+        # Each question runs in its own task, so the priority only applies to the LLM calls of the batch
+        llm_priority.set("batch")
+        async with semaphore:
+            trace = start_trace(setup, "/api/ask/batch")
+            metrics.requests_in_flight.inc(endpoint="/api/ask/batch")
+            try:
+                session_history = []
+                if body.use_history:
+                    with trace.span("history_read"):
+                        session_history = await aget_chat_history(question.session_id, setup)
+                response = await answer_question(question, session_history, setup, trace)
+                if body.use_history:
+                    with trace.span("history_write"):
+                        await aadd_to_chat_history(AnswerModel(**response), setup=setup)
+                trace.end()
+                return "answer", { "index": index, **response }
+            except Exception as e:
+                trace.end(error=e)
+                return "error", { "index": index, "detail": f"Error: {e}", "request_id": trace.request_id }
+            finally:
+                metrics.requests_in_flight.dec(endpoint="/api/ask/batch")
+
+    async def event_stream():
+        tasks = [asyncio.create_task(answer(index, question)) for index, question in enumerate(body.questions)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                event, data = await task
+                yield format_sse(event, data)
+        finally:
+            # Stop answering if the client went away
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def lookup_answer(body: QuestionModel, session_history, setup: dict, trace: ExecutionTrace):
+    # Returns the cached answer to the question, if there is one, and the question embedding to cache a new answer
+    cache = setup["answer_cache"]
+    if not cache_config["enabled"] or not body.use_cache or not cache.is_cacheable(session_history):
+        metrics.answer_cache_requests.inc(result="bypass")
+        return None, None
     try:
-        result = graph.invoke({ "question": prompt, "history": session_history })
-        response = {"question": prompt, "answer": result["answer"], "session_id": session_id, "agents": result["agents"]}
-        add_to_chat_history(AnswerModel(**response), setup=setup)
-        return response
+        with trace.span("cache_lookup"):
+            vector = await cache.aembed(body.question)
+            cached = cache.lookup(vector)
+        return cached, vector
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error: {e}")
+        # The question can still be answered without the cache
+        logger.error("Cache says: ERROR %s", e)
+        return None, None
+
+
+def store_answer(body: QuestionModel, session_history, vector, result, setup: dict):
+    # Answers built from a conversation may not hold for other sessions.
+    # Timeouts, answers missing an unavailable agent and "I don't know" answers are not worth reusing
+    if vector is None or not setup["answer_cache"].is_cacheable(session_history) or result.get("timed_out") or result.get("unavailable") or setup["summarizer"].is_non_answer(result["answer"]):
+        return
+    setup["answer_cache"].add(body.question, vector, result["answer"], result["agents"])
+
+
+async def stream_cached_answer(cached):
+    yield "agents", list(cached["agents"].keys())
+    yield "token", cached["answer"]
+    yield "end", cached
+
+
+# This endpoint drops the cached answers, e.g. after a knowledge base is updated
+# If an agent is given, only the answers that agent took part in are dropped.
+# The count is for the worker answering, the other workers drop their answers before their next lookup
+@app.delete("/api/cache")
+def invalidate_cache(agent: Optional[str] = None, setup: dict = Depends(get_setup)):
+    count = setup["answer_cache"].invalidate(agent)
+    return {"message": f"Invalidated {count} cached answers."}
+
+
+def start_trace(setup: dict, endpoint):
+    # Every question gets a request id, used to retrieve its trace from /api/trace
+    # The spans of the trace also feed the latency metrics
+    trace = ExecutionTrace(str(uuid.uuid4()), name=endpoint, on_span_end=metrics.observe_span, on_end=setup["trace_store"].save)
+    setup["trace_store"].add(trace)
+    return trace
+
+
+# This endpoint returns the execution trace of a recent request
+@app.get("/api/trace/{request_id}")
+def get_trace(request_id, setup: dict = Depends(get_setup)):
+    trace = setup["trace_store"].get(request_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail=f"No trace found for request {request_id}.")
+    return trace
+
+
+# This endpoint exposes the metrics of this worker in Prometheus text format
+@app.get("/api/metrics")
+def get_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
+def build_state(body: QuestionModel, session_history, vector):
+    state = { "question": body.question, "history": session_history, "deadline": get_deadline(body) }
+    # The question embedding computed for the answer cache is reused by the router
+    if vector is not None:
+        state["embedding"] = vector
+    return state
+
+
+def get_deadline(body: QuestionModel):
+    # Point in time when the agents must have answered, the summarizer uses whatever arrived until then
+    timeout = body.timeout if body.timeout is not None else graph_config["request_timeout"]
+    return time.monotonic() + timeout
+
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
 
 # This endpoint receives feedback from the user
@@ -140,45 +472,65 @@ def get_feedback_count(setup: dict = Depends(get_setup)):
 def get_chat_history(session_id, setup: dict = Depends(get_setup)):
     history_table = setup["history_table"]
     entities = history_table.query_entities(query_filter=f"PartitionKey eq '{session_id}'")
+    return process_chat_history(entities)
 
+
+# Same as get_chat_history, but using the async table client
+async def aget_chat_history(session_id, setup: dict):
+    history_table = setup["async_history_table"]
+    entities = [entity async for entity in history_table.query_entities(query_filter=f"PartitionKey eq '{session_id}'")]
+    return process_chat_history(entities)
+
+
+def process_chat_history(entities):
+    # Return the latest 2 question-answer pairs
+    return sort_chat_history(entities)[-4:]
+
+
+def sort_chat_history(entities):
     # Sort the entities by timestamp
     sorted_entities = sorted(
             (dict(entity, Timestamp=entity.metadata["timestamp"]) for entity in entities),
             key=lambda x: x["Timestamp"]
         )
-    
-    # Return the latest 2 question-answer pairs
-    filtered_entities = sorted_entities[-4:]
 
     processed_entities = [
         {**{k: v for k, v in d.items() if k != "Timestamp" and k != "RowKey" and k != "PartitionKey"}}
-        for d in filtered_entities
+        for d in sorted_entities
     ]
 
     return processed_entities
 
 
+async def warm_routing_cache(setup: dict):
+    # Loads the routing decisions from the chat history, so that common questions skip the routing right after a deploy
+    try:
+        # The table lists the rows by session, so once there are enough rows the session being read is finished
+        # and the reading stops at the next one. A session cut in the middle would rebuild the wrong history
+        sessions = {}
+        count = 0
+        async for entity in setup["async_history_table"].list_entities():
+            if count >= routing_cache_config["warm_up_rows"] and entity["PartitionKey"] not in sessions:
+                break
+            sessions.setdefault(entity["PartitionKey"], []).append(entity)
+            count += 1
+        agent_names = [agent.name for agent in setup["agents"]]
+        setup["routing_cache"].warm([sort_chat_history(entities) for entities in sessions.values()], agent_names)
+    except Exception as e:
+        logger.error("Routing cache says: ERROR %s", e)
+
+
 # This endpoint adds a new chat to the chat history for a given session id
 @app.post("/api/history")
 def add_to_chat_history(body: AnswerModel, setup: dict = Depends(get_setup)):
     history_table = setup["history_table"]
     try:
+        user_entity, bot_entity = build_chat_entities(body)
+
         # Insert the entity for the user question
-        user_entity = TableEntity()
-        user_entity["PartitionKey"] = body.session_id
-        user_entity["RowKey"] = str(uuid.uuid4())
-        user_entity["role"] = "user"
-        user_entity["content"] = body.question
         history_table.create_entity(entity=user_entity)
 
         # Insert the entity for the bot answer
-        bot_entity = TableEntity()
-        bot_entity["PartitionKey"] = body.session_id
-        bot_entity["RowKey"] = str(uuid.uuid4())
-        bot_entity["role"] = "bot"
-        bot_entity["content"] = body.answer
-        for key, value in body.agents.items():
-            bot_entity[key] = value
         history_table.create_entity(entity=bot_entity)
         
         return {"message": "Chat history updated successfully."}
@@ -186,6 +538,38 @@ def add_to_chat_history(body: AnswerModel, setup: dict = Depends(get_setup)):
         raise HTTPException(status_code=500, detail=f"Error: {e}") 
 
 
+# Same as add_to_chat_history, but using the async table client
+async def aadd_to_chat_history(body: AnswerModel, setup: dict):
+    history_table = setup["async_history_table"]
+    try:
+        user_entity, bot_entity = build_chat_entities(body)
+        await history_table.create_entity(entity=user_entity)
+        await history_table.create_entity(entity=bot_entity)
+        return {"message": "Chat history updated successfully."}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error: {e}")
+
+
+def build_chat_entities(body: AnswerModel):
+    # Entity for the user question
+    user_entity = TableEntity()
+    user_entity["PartitionKey"] = body.session_id
+    user_entity["RowKey"] = str(uuid.uuid4())
+    user_entity["role"] = "user"
+    user_entity["content"] = body.question
+
+    # Entity for the bot answer
+    bot_entity = TableEntity()
+    bot_entity["PartitionKey"] = body.session_id
+    bot_entity["RowKey"] = str(uuid.uuid4())
+    bot_entity["role"] = "bot"
+    bot_entity["content"] = body.answer
+    for key, value in body.agents.items():
+        bot_entity[key] = value
+
+    return user_entity, bot_entity
+
+
 # This endpoint deletes the chat history for a given session id
 @app.delete("/api/history/{session_id}")
 def delete_chat_history(session_id, setup: dict = Depends(get_setup)):
@@ -203,10 +587,11 @@ def delete_chat_history(session_id, setup: dict = Depends(get_setup)):
 
 # Endpoint to provide a greetings message
 @app.get("/api/greetings")
-def greetings(setup: dict = Depends(get_setup)):
+async def greetings(setup: dict = Depends(get_setup)):
     greeter = setup["greeter"]
+    llm_priority.set("greeting")
     try:
-        result = greeter.generate_answer()
+        result = await greeter.agenerate_answer()
         return {"answer": result["answer"]}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {e}")
\ No newline at end of file
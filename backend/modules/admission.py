@@ -0,0 +1,198 @@
+from .metrics import llm_queue_depth, llm_queue_wait
+from contextvars import ContextVar
+from collections import deque
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+
+# Order in which the queued LLM calls are let through, interactive questions first
+PRIORITIES = { "interactive": 0, "greeting": 1, "batch": 2 }
+
+# Priority of the LLM calls made while serving the current request, each endpoint sets its own
+llm_priority = ContextVar("llm_priority", default="interactive")
+
+
+class Ticket:
+    # An LLM call waiting for, or holding, a slot of a deployment
+    def __init__(self, tokens, priority, notify):
+        self.tokens = tokens
+        self.priority = priority
+        self.notify = notify
+        self.enqueued = time.monotonic()
+        self.admitted = False
+        # Entry of the deployment tokens window, so that the estimate can be corrected with the real usage
+        self.entry = None
+
+
+class DeploymentQueue:
+    # Limits and queue of one deployment
+    def __init__(self, name, max_concurrency=None, tokens_per_minute=None, window=60):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.window = window
+        # Calls running right now
+        self.active = 0
+        # Tokens used in the last minute, as [admission time, tokens] entries
+        self.used = deque()
+        self.used_tokens = 0
+        # Heap of (priority, arrival, ticket)
+        self.waiting = []
+
+    def expire(self, now):
+        while self.used and self.used[0][0] <= now - self.window:
+            self.used_tokens -= self.used.popleft()[1]
+
+    def can_admit(self, ticket):
+        if self.max_concurrency is not None and self.active >= self.max_concurrency:
+            return False
+        # A call bigger than the whole budget still goes through once the window is empty
+        if self.tokens_per_minute is not None and self.used_tokens > 0 and self.used_tokens + ticket.tokens > self.tokens_per_minute:
+            return False
+        return True
+
+    def admit(self, ticket, now):
+        self.active += 1
+        ticket.entry = [now, ticket.tokens]
+        self.used.append(ticket.entry)
+        self.used_tokens += ticket.tokens
+        ticket.admitted = True
+
+    def retry_after(self, now):
+        # Seconds until the oldest tokens leave the window, None if only a finished call can free a slot
+        if self.max_concurrency is not None and self.active >= self.max_concurrency:
+            return None
+        if self.used:
+            return max(self.used[0][0] + self.window - now, 0.01)
+        return None
+
+
+class AdmissionController:
+    # Lets the LLM calls of this worker through to each deployment without going over its concurrency
+    # and estimated tokens per minute limits, the calls over the limits wait in a priority queue.
+    # Calls from threads and from the event loop share the same queues
+    def __init__(self, enabled=True, deployments=None, default=None, completion_tokens=500, workers=1):
+        self.configure(enabled, deployments, default, completion_tokens, workers)
+        self.lock = threading.Lock()
+        self.sequence = itertools.count()
+
+    def configure(self, enabled=True, deployments=None, default=None, completion_tokens=500, workers=1):
+        self.enabled = enabled
+        # Limits per deployment, e.g. { "gpt-4o": { "max_concurrency": 24, "tokens_per_minute": 150000 } }
+        self.limits = deployments or {}
+        # Limits of the deployments not listed
+        self.default = default or {}
+        # Tokens expected in the answer when the call doesn't set max_tokens
+        self.completion_tokens = completion_tokens
+        # The limits are for the whole deployment, and every worker of the server gets an equal share of them
+        self.workers = max(workers, 1)
+        self.queues = {}
+
+    def get_share(self, limit):
+        return max(limit // self.workers, 1) if limit is not None else None
+
+    def get_queue(self, deployment):
+        if deployment not in self.queues:
+            limits = self.limits.get(deployment, self.default)
+            self.queues[deployment] = DeploymentQueue(deployment, self.get_share(limits.get("max_concurrency")), self.get_share(limits.get("tokens_per_minute")))
+        return self.queues[deployment]
+
+    def enqueue(self, deployment, tokens, notify):
+        priority = llm_priority.get()
+        ticket = Ticket(tokens, priority, notify)
+        queue = self.get_queue(deployment)
+        heapq.heappush(queue.waiting, (PRIORITIES.get(priority, 0), next(self.sequence), ticket))
+        llm_queue_depth.inc(deployment=deployment)
+        self.dispatch(queue)
+        return queue, ticket
+
+    def dispatch(self, queue):
+        # Admits the waiting calls in order, the first one that doesn't fit stops the rest so that it isn't starved
+        now = time.monotonic()
+        queue.expire(now)
+        while queue.waiting and queue.can_admit(queue.waiting[0][2]):
+            _, _, ticket = heapq.heappop(queue.waiting)
+            queue.admit(ticket, now)
+            llm_queue_depth.dec(deployment=queue.name)
+            llm_queue_wait.observe(now - ticket.enqueued, deployment=queue.name, priority=ticket.priority)
+            ticket.notify()
+
+    def acquire(self, deployment, tokens):
+        # Blocks the thread until the call can go through
+        if not self.enabled:
+            return None
+        event = threading.Event()
+        with self.lock:
+            queue, ticket = self.enqueue(deployment, tokens, event.set)
+        try:
+            while True:
+                with self.lock:
+                    self.dispatch(queue)
+                    if ticket.admitted:
+                        return queue, ticket
+                    timeout = queue.retry_after(time.monotonic())
+                    event.clear()
+                event.wait(timeout)
+        except BaseException:
+            self.abandon(queue, ticket)
+            raise
+
+    async def aacquire(self, deployment, tokens):
+        # Waits without blocking the event loop until the call can go through
+        if not self.enabled:
+            return None
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        with self.lock:
+            queue, ticket = self.enqueue(deployment, tokens, lambda: loop.call_soon_threadsafe(event.set))
+        try:
+            while True:
+                with self.lock:
+                    self.dispatch(queue)
+                    if ticket.admitted:
+                        return queue, ticket
+                    timeout = queue.retry_after(time.monotonic())
+                    event.clear()
+                try:
+                    await asyncio.wait_for(event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self.abandon(queue, ticket)
+            raise
+
+    def release(self, admission, tokens=None):
+        # Frees the slot of a finished call, correcting its estimated tokens with the real ones if known
+        if admission is None:
+            return
+        queue, ticket = admission
+        with self.lock:
+            queue.active -= 1
+            now = time.monotonic()
+            queue.expire(now)
+            if tokens is not None and ticket.entry[0] > now - queue.window:
+                queue.used_tokens += tokens - ticket.entry[1]
+                ticket.entry[1] = tokens
+            self.dispatch(queue)
+
+    def abandon(self, queue, ticket):
+        # The caller gave up (e.g. the request was cancelled) while waiting
+        with self.lock:
+            admitted = ticket.admitted
+            if not admitted:
+                queue.waiting = [item for item in queue.waiting if item[2] is not ticket]
+                heapq.heapify(queue.waiting)
+                llm_queue_depth.dec(deployment=queue.name)
+        if admitted:
+            self.release((queue, ticket))
+
+    def status(self):
+        # Current load of every deployment
+        with self.lock:
+            return { name: { "active": queue.active, "waiting": len(queue.waiting), "tokens_last_minute": queue.used_tokens } for name, queue in self.queues.items() }
+
+
+# Admission control of this process
+admission = AdmissionController()
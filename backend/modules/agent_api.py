@@ -1,37 +1,46 @@
 from .models import State
-from .utils import filter_agent_history
-from langchain_openai import AzureChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
+from .utils import filter_agent_history, build_prompt
+from .tracing import trace_span
+from .metrics import record_agent_error
+from .llm import get_llm
+from .prompt_budget import budget_prompt
+from .circuit_breaker import circuit_breakers
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnableLambda, RunnablePassthrough
+from requests.exceptions import RequestException, ConnectionError as RequestsConnectionError, Timeout as RequestsTimeout
 import re
+import asyncio
+import threading
 import requests
 import yaml
 import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+class CodeError(Exception):
+    # Raised when the generated code fails on its own, it is not the API fault
+    pass
 
 class AgentApi:
     
-    def __init__(self, config): 
+    def __init__(self, config, lazy=False): 
         self.name = f"agent_{config['agent_id']}"
         self.skills = config['agent_directive']
         self.spec_url = config["spec_url"]
+        self.spec_format = config["spec_format"]
         self.endpoint_filter = config["endpoint_filter"]
-        self.base_url, self.endpoints, self.spec_data = self.get_spec(config["spec_format"])
-        
-        # LLM instantiation
-        self.llm = AzureChatOpenAI(
-            deployment_name="gpt-4o",
-            api_version="2023-06-01-preview"
-        )
 
-        # The prompt puts together the system prompt with the user question
-        self.prompt = lambda inputs: ChatPromptTemplate.from_messages(
-            [
-                ("system", inputs["system_prompt"]),
-                ("human", inputs["human_prompt"]),
-            ]
-        )
+        # API specification download
+        # Lazy agents download it on first use, so they don't slow down the startup
+        self.connect_lock = threading.Lock()
+        self.base_url, self.endpoints, self.spec_data = None, None, None
+        if not lazy:
+            self.connect()
 
+        # Failed downloads of the specification and API calls are retried, and the agent is skipped while the API is down.
+        # Errors of the generated code don't count as failures
+        self.breaker = circuit_breakers.get(self.name, "api", transient=(RequestsConnectionError, RequestsTimeout), ignore=(CodeError,))
+        
         # The parser just plucks the string content out of the LLM's output message
         self.parser = StrOutputParser()
 
@@ -48,12 +57,11 @@ class AgentApi:
         )
 
         self.endpoint_selector_chain = (
-            { "question": RunnableLambda(lambda inputs: inputs["question"]), "endpoints": RunnableLambda(lambda inputs: inputs["endpoints"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
-            #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
-            | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.endpoint_selector_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            budget_prompt(self.name, "endpoint_selector_chain")
+            | build_prompt(self.endpoint_selector_prompt)
+            | get_llm(self.name, "endpoint_selector_chain")
             | self.parser
-        )
+        ).with_config(run_name="endpoint_selector_chain")
 
         # A prompt to double check the generated query and adjust if needed
         self.code_generator_prompt = (
@@ -67,7 +75,7 @@ class AgentApi:
             "- Ensure the code is executable. "
             "- ALWAYS assign the final result to a variable called 'result'. "
             "\n\n"
-            f"API base url: {self.base_url}"
+            "API base url: {base_url}"
             "\n\n"
             "Endpoint specification: {context}"
             "\n\n"
@@ -77,12 +85,11 @@ class AgentApi:
         )
 
         self.code_generator_chain = (
-            { "question": RunnableLambda(lambda inputs: inputs["question"]), "context": RunnableLambda(lambda inputs: inputs["context"]), "token": RunnableLambda(lambda inputs: inputs["token"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
-            #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
-            | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.code_generator_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            budget_prompt(self.name, "code_generator_chain")
+            | build_prompt(self.code_generator_prompt)
+            | get_llm(self.name, "code_generator_chain")
             | self.parser
-        )
+        ).with_config(run_name="code_generator_chain")
 
         # A prompt to double check the generated code and adjust if needed
         self.code_reviewer_prompt = (
@@ -95,12 +102,10 @@ class AgentApi:
         )
 
         self.code_reviewer_chain = (
-            { "code": RunnablePassthrough() }
-            #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
-            | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.code_reviewer_prompt, "human_prompt": inputs["code"]}))
-            | self.llm
+            build_prompt(self.code_reviewer_prompt, "{code}")
+            | get_llm(self.name, "code_reviewer_chain")
             | self.parser
-        )
+        ).with_config(run_name="code_reviewer_chain")
 
         # A prompt to generate an answer to the question given the information pulled from the csv
         self.answer_generator_prompt = (
@@ -118,12 +123,11 @@ class AgentApi:
         )
 
         self.answer_generator_chain = (
-            { "question": RunnableLambda(lambda inputs: inputs["question"]), "code": RunnableLambda(lambda inputs: inputs["code"]), "result": RunnableLambda(lambda inputs: inputs["result"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
-            #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
-            | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.answer_generator_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            budget_prompt(self.name, "answer_generator_chain")
+            | build_prompt(self.answer_generator_prompt)
+            | get_llm(self.name, "answer_generator_chain")
             | self.parser
-        )
+        ).with_config(run_name="answer_generator_chain")
 
         self.entry_point_prompt = (
             "You are an AI assistant for question-answering tasks. "
@@ -139,32 +143,58 @@ class AgentApi:
         )
 
         self.entry_point_chain = (
-            { "question": RunnableLambda(lambda inputs: inputs["question"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
-            #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
-            | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.entry_point_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            budget_prompt(self.name, "entry_point_chain")
+            | build_prompt(self.entry_point_prompt)
+            | get_llm(self.name, "entry_point_chain")
             | self.parser
-        )
+        ).with_config(run_name="entry_point_chain")
+
+    def connect(self):
+        spec = self.get_spec(self.spec_format)
+        if spec is not None:
+            self.base_url, self.endpoints, self.spec_data = spec
+
+    def ensure_connected(self):
+        # Downloads the specification if it isn't yet, only once when called from several threads
+        with self.connect_lock:
+            if self.spec_data is None:
+                self.connect()
+        return self.spec_data is not None
+
+    def is_ready(self):
+        return self.spec_data is not None
+
+    def is_available(self):
+        return self.breaker.is_available()
+
+    def load_spec(self):
+        if not self.ensure_connected():
+            raise ConnectionError(f"{self.name} could not retrieve the api specification")
 
     def check_connection(self):
-        print(f"{self.name} says: checking connection to API...")
+        logger.info("%s says: checking connection to API...", self.name)
         try:
-            username = "fabimass"
-            url = f"https://api.github.com/users/{username}/repos"
+            # The rate limit endpoint doesn't count against the quota the agent needs to answer questions,
+            # so the background probes can't use it up
+            url = "https://api.github.com/rate_limit"
             response = requests.get(url)
 
             if response.status_code == 200:
-                print(f"{self.name} says: connection up and running.")
-                return { "healthy": True, "info": "Agent up and running" }
+                remaining = response.json()["resources"]["core"]["remaining"]
+                if remaining == 0:
+                    logger.info("%s says: API rate limit exceeded.", self.name)
+                    return { "healthy": False, "info": "API rate limit exceeded" }
+                logger.info("%s says: connection up and running.", self.name)
+                return { "healthy": True, "info": f"Agent up and running, {remaining} API calls left" }
             else:
-                print(f"{self.name} says: connection failed.")
+                logger.info("%s says: connection failed.", self.name)
                 return { "healthy": False, "info": response.status_code }
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            logger.error("%s says: ERROR %s", self.name, e)
             return { "healthy": False, "info": e }
 
     def get_spec(self, format):
-        print(f"{self.name} says: retrieving api specification...")
+        logger.info("%s says: retrieving api specification...", self.name)
 
         try:
             response = requests.get(self.spec_url)
@@ -188,29 +218,41 @@ class AgentApi:
             servers = openapi_data.get("servers", [])
             base_url = servers[0].get("url", None)
 
-            print(f"{self.name} says:\n {base_url}\n {endpoints[:5]}")
+            logger.debug("%s says:\n %s\n %s", self.name, base_url, endpoints[:5])
             return base_url, endpoints, openapi_data
        
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            logger.error("%s says: ERROR %s", self.name, e)
             return None   
 
     def get_relevant_endpoints(self, question, history):
-        print(f"{self.name} says: getting relevant endpoints...")
+        logger.info("%s says: getting relevant endpoints...", self.name)
+        self.breaker.call(self.load_spec)
         endpoints = self.endpoint_selector_chain.invoke({"question": question, "endpoints": self.endpoints, "history": history})
         if endpoints == "":
             endpoints_list = []
         else:
             endpoints_list = endpoints.replace(" ", "").split(",")
-        print(f"{self.name} says: {endpoints_list}")
+        logger.debug("%s says: %s", self.name, endpoints_list)
+        return endpoints_list
+
+    async def aget_relevant_endpoints(self, question, history):
+        logger.info("%s says: getting relevant endpoints...", self.name)
+        await asyncio.to_thread(self.breaker.call, self.load_spec)
+        endpoints = await self.endpoint_selector_chain.ainvoke({"question": question, "endpoints": self.endpoints, "history": history})
+        if endpoints == "":
+            endpoints_list = []
+        else:
+            endpoints_list = endpoints.replace(" ", "").split(",")
+        logger.debug("%s says: %s", self.name, endpoints_list)
         return endpoints_list
 
     def get_endpoint_details(self, endpoints_list):
-        print(f"{self.name} says: getting endpoint details...")
+        logger.info("%s says: getting endpoint details...", self.name)
         endpoint_details = {}
         for endpoint in endpoints_list:
             details = self.spec_data["paths"].get(endpoint)
-            print(f"{self.name} says:\n {details}")
+            logger.debug("%s says:\n %s", self.name, details)
             endpoint_details[endpoint] = details
         return endpoint_details
     
@@ -218,40 +260,63 @@ class AgentApi:
         return ""
 
     def generate_code(self, question, context, history):
-        print(f"{self.name} says: generating code...")
+        logger.info("%s says: generating code...", self.name)
         token = self.get_token()
-        code = self.code_generator_chain.invoke({"question": question, "context": context, "token": token, "history": history})
-        print(f"{self.name} says: {code}")
+        code = self.code_generator_chain.invoke({"question": question, "context": context, "base_url": self.base_url, "token": token, "history": history})
+        logger.debug("%s says: %s", self.name, code)
 
-        print(f"{self.name} says: reviewing code...")
-        reviewed_code = self.code_reviewer_chain.invoke(code.replace("{", "{{").replace("}", "}}"))
-        print(f"{self.name} says: {reviewed_code}")
-        
-        cleaned_code = re.sub(r"^```python\n", "", reviewed_code)  # Remove start markdown
+        logger.info("%s says: reviewing code...", self.name)
+        reviewed_code = self.code_reviewer_chain.invoke({"code": code})
+        logger.debug("%s says: %s", self.name, reviewed_code)
+        return self.clean_code(reviewed_code)
+
+    async def agenerate_code(self, question, context, history):
+        logger.info("%s says: generating code...", self.name)
+        token = self.get_token()
+        code = await self.code_generator_chain.ainvoke({"question": question, "context": context, "base_url": self.base_url, "token": token, "history": history})
+        logger.debug("%s says: %s", self.name, code)
+
+        logger.info("%s says: reviewing code...", self.name)
+        reviewed_code = await self.code_reviewer_chain.ainvoke({"code": code})
+        logger.debug("%s says: %s", self.name, reviewed_code)
+        return self.clean_code(reviewed_code)
+
+    def clean_code(self, code):
+        cleaned_code = re.sub(r"^```python\n", "", code)  # Remove start markdown
         cleaned_code = re.sub(r"\n```$", "", cleaned_code)  # Remove end markdown
         return cleaned_code
     
-    def run_code(self, code):
+    def execute_code(self, code):
         safe_locals = {}
-        print(f"{self.name} says: executing code...")
-        exec(code, globals(), safe_locals)
-        result = safe_locals['result']
-        print(f"{self.name} says: {result}")
+        try:
+            exec(code, globals(), safe_locals)
+            return safe_locals['result']
+        except RequestException:
+            raise
+        except Exception as e:
+            raise CodeError(e) from e
+
+    def run_code(self, code):
+        logger.info("%s says: executing code...", self.name)
+        # The code calls the API, so it goes through the breaker like the specification download
+        with trace_span("code_execution"):
+            result = self.breaker.call(self.execute_code, code)
+        logger.debug("%s says: %s", self.name, result)
         return result
     
     def generate_answer(self, state: State):
-        print(f"{self.name} says: received question '{state['question']}'")
-        
-        if "agents" not in state:
-            state["agents"] = {}
+        logger.info("%s says: received question '%s'", self.name, state['question'])
 
         try:
             # Filter agent history
             agent_history = filter_agent_history(state["history"], self.name)
 
             # Check if it can answer the question right away or if it needs to continue
-            answer = self.entry_point_chain.invoke({"question": state["question"], "history": agent_history})
-            print(f"{self.name} says: {answer}")
+            # In fused mode the supervisor already did this check
+            answer = (state.get("entry_answers") or {}).get(self.name)
+            if answer is None:
+                answer = self.entry_point_chain.invoke({"question": state["question"], "history": agent_history})
+            logger.debug("%s says: %s", self.name, answer)
             if answer == 'CONTINUE':
                 # Get relevant endpoints
                 relevant_endpoints = self.get_relevant_endpoints(state['question'], agent_history)
@@ -266,14 +331,52 @@ class AgentApi:
                 result = self.run_code(code)
 
                 # Finally answer the question
-                print(f"{self.name} says: generating answer...")
-                answer = self.answer_generator_chain.invoke({"question": state["question"], "code": code.replace("{", "{{").replace("}", "}}"), "result": result, "history": agent_history})
-                print(f"{self.name} says: {answer}")
+                logger.info("%s says: generating answer...", self.name)
+                answer = self.answer_generator_chain.invoke({"question": state["question"], "code": code, "result": result, "history": agent_history})
+                logger.debug("%s says: %s", self.name, answer)
             
-            state["agents"][f"{self.name}"] = answer
-            return state
+            # Only this agent's entry is returned, so it can be merged with other agents running in parallel
+            return { "agents": { self.name: answer } }
         
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
-            state["agents"][f"{self.name}"] = "I don't know"
-            return state
\ No newline at end of file
+            logger.error("%s says: ERROR %s", self.name, e)
+            record_agent_error(self.name)
+            return { "agents": { self.name: "I don't know" } }
+
+    async def agenerate_answer(self, state: State):
+        logger.info("%s says: received question '%s'", self.name, state['question'])
+
+        try:
+            # Filter agent history
+            agent_history = filter_agent_history(state["history"], self.name)
+
+            # Check if it can answer the question right away or if it needs to continue
+            # In fused mode the supervisor already did this check
+            answer = (state.get("entry_answers") or {}).get(self.name)
+            if answer is None:
+                answer = await self.entry_point_chain.ainvoke({"question": state["question"], "history": agent_history})
+            logger.debug("%s says: %s", self.name, answer)
+            if answer == 'CONTINUE':
+                # Get relevant endpoints
+                relevant_endpoints = await self.aget_relevant_endpoints(state['question'], agent_history)
+
+                # Get relevant endpoints details
+                context = self.get_endpoint_details(relevant_endpoints)
+
+                # Generate Python code to interact with the files
+                code = await self.agenerate_code(state['question'], context, agent_history)
+
+                # The generated code makes blocking HTTP calls, so it runs in a worker thread
+                result = await asyncio.to_thread(self.run_code, code)
+
+                # Finally answer the question
+                logger.info("%s says: generating answer...", self.name)
+                answer = await self.answer_generator_chain.ainvoke({"question": state["question"], "code": code, "result": result, "history": agent_history})
+                logger.debug("%s says: %s", self.name, answer)
+
+            return { "agents": { self.name: answer } }
+
+        except Exception as e:
+            logger.error("%s says: ERROR %s", self.name, e)
+            record_agent_error(self.name)
+            return { "agents": { self.name: "I don't know" } }
@@ -1,13 +1,21 @@
 from .models import State
-from .utils import filter_agent_history
-from langchain_openai import AzureChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
+from .utils import filter_agent_history, build_prompt
+from .tracing import trace_span
+from .metrics import record_agent_error
+from .llm import get_llm
+from .prompt_budget import budget_prompt
+from .circuit_breaker import circuit_breakers
+from .deadline import check_deadline
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from azure.storage.blob import BlobServiceClient
+from azure.core.exceptions import ServiceRequestError, ServiceResponseError, ResourceNotFoundError
 from io import StringIO
 import re
+import asyncio
 import pandas as pd
+import logging
+
+logger = logging.getLogger(__name__)
 
 class AgentCsv:
     
@@ -19,21 +27,11 @@ class AgentCsv:
         
         # Blob storage instantiation
         self.blob_service_client = self.connect()
-        
-        # LLM instantiation
-        self.llm = AzureChatOpenAI(
-            deployment_name="gpt-4o",
-            api_version="2023-06-01-preview"
-        )
-
-        # The prompt puts together the system prompt with the user question
-        self.prompt = lambda inputs: ChatPromptTemplate.from_messages(
-            [
-                ("system", inputs["system_prompt"]),
-                ("human", inputs["human_prompt"]),
-            ]
-        )
 
+        # Failed downloads are retried, and the agent is skipped while the storage account is down.
+        # A file that doesn't exist is not the storage fault, so it doesn't count as a failure
+        self.breaker = circuit_breakers.get(self.name, "blob_storage", transient=(ServiceRequestError, ServiceResponseError), ignore=(ResourceNotFoundError,))
+        
         # The parser just plucks the string content out of the LLM's output message
         self.parser = StrOutputParser()
 
@@ -50,12 +48,11 @@ class AgentCsv:
         )
 
         self.file_selector_chain = (
-            { "question": RunnableLambda(lambda inputs: inputs["question"]), "index": RunnableLambda(lambda inputs: inputs["index"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
-            #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
-            | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.file_selector_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            budget_prompt(self.name, "file_selector_chain")
+            | build_prompt(self.file_selector_prompt)
+            | get_llm(self.name, "file_selector_chain")
             | self.parser
-        )
+        ).with_config(run_name="file_selector_chain")
 
         # A prompt to double check the generated query and adjust if needed
         self.code_generator_prompt = (
@@ -88,12 +85,11 @@ class AgentCsv:
         )
 
         self.code_generator_chain = (
-            { "question": RunnableLambda(lambda inputs: inputs["question"]), "context": RunnableLambda(lambda inputs: inputs["context"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
-            #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
-            | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.code_generator_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            budget_prompt(self.name, "code_generator_chain")
+            | build_prompt(self.code_generator_prompt)
+            | get_llm(self.name, "code_generator_chain")
             | self.parser
-        )
+        ).with_config(run_name="code_generator_chain")
 
         # A prompt to double check the generated code and adjust if needed
         self.code_reviewer_prompt = (
@@ -106,12 +102,10 @@ class AgentCsv:
         )
 
         self.code_reviewer_chain = (
-            { "code": RunnablePassthrough() }
-            #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
-            | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.code_reviewer_prompt, "human_prompt": inputs["code"]}))
-            | self.llm
+            build_prompt(self.code_reviewer_prompt, "{code}")
+            | get_llm(self.name, "code_reviewer_chain")
             | self.parser
-        )
+        ).with_config(run_name="code_reviewer_chain")
 
         # A prompt to generate an answer to the question given the information pulled from the csv
         self.answer_generator_prompt = (
@@ -129,12 +123,11 @@ class AgentCsv:
         )
 
         self.answer_generator_chain = (
-            { "question": RunnableLambda(lambda inputs: inputs["question"]), "code": RunnableLambda(lambda inputs: inputs["code"]), "result": RunnableLambda(lambda inputs: inputs["result"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
-            #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
-            | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.answer_generator_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            budget_prompt(self.name, "answer_generator_chain")
+            | build_prompt(self.answer_generator_prompt)
+            | get_llm(self.name, "answer_generator_chain")
             | self.parser
-        )
+        ).with_config(run_name="answer_generator_chain")
 
         self.entry_point_prompt = (
             "You are an AI assistant for question-answering tasks. "
@@ -150,105 +143,141 @@ class AgentCsv:
         )
 
         self.entry_point_chain = (
-            { "question": RunnableLambda(lambda inputs: inputs["question"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
-            #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
-            | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.entry_point_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            budget_prompt(self.name, "entry_point_chain")
+            | build_prompt(self.entry_point_prompt)
+            | get_llm(self.name, "entry_point_chain")
             | self.parser
-        )
+        ).with_config(run_name="entry_point_chain")
 
     def connect(self):
         self.index_file_name = self.config["index_file_name"]
         self.container_name = self.config["container_name"]
         self.connection_string = self.config["connection_string"]
-        print(f"{self.name} says: connecting to Azure Blob Storage...")
+        logger.info("%s says: connecting to Azure Blob Storage...", self.name)
         try:
             blob_client = BlobServiceClient.from_connection_string(self.connection_string)
-            print(f"{self.name} says: connection established.")
+            logger.info("%s says: connection established.", self.name)
             return blob_client
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            logger.error("%s says: ERROR %s", self.name, e)
             self.status = e
             return None
         
     def check_connection(self):
-        print(f"{self.name} says: checking connection to storage account...")
+        logger.info("%s says: checking connection to storage account...", self.name)
         try:
             self.blob_service_client.get_blob_client(container=self.container_name, blob=self.index_file_name)
-            print(f"{self.name} says: connection up and running.")
+            logger.info("%s says: connection up and running.", self.name)
             self.status = "up and running"
             return { "healthy": True, "info": self.status }
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            logger.error("%s says: ERROR %s", self.name, e)
             # Try to reconnect
             self.blob_service_client = self.connect()
             return { "healthy": True if self.blob_service_client is not None else False, "info": self.status }
 
+    def is_available(self):
+        return self.breaker.is_available()
+
+    def download(self, file_name):
+        # Connects again if the connection failed
+        if self.blob_service_client is None:
+            self.blob_service_client = self.connect()
+        if self.blob_service_client is None:
+            raise ConnectionError(f"{self.name} could not connect to the storage account: {self.status}")
+        blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=file_name)
+        return blob_client.download_blob().content_as_text()
+
     def get_index(self):
-        print(f"{self.name} says: retrieving index file...")
-        blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=self.index_file_name)
-        blob_data = blob_client.download_blob().content_as_text()
+        logger.info("%s says: retrieving index file...", self.name)
+        with trace_span("blob_download"):
+            blob_data = self.breaker.call(self.download, self.index_file_name)
         csv_data = StringIO(blob_data)
         index = pd.read_csv(csv_data)
-        print(f"{self.name} says:\n {index}")
+        logger.debug("%s says:\n %s", self.name, index)
         return index
 
     def get_relevant_files(self, question, index, history):
-        print(f"{self.name} says: getting relevant files...")
+        logger.info("%s says: getting relevant files...", self.name)
         files = self.file_selector_chain.invoke({"question": question, "index": index, "history": history})
         if files == "":
             files_list = []
         else:
             files_list = files.replace(" ", "").split(",")
-        print(f"{self.name} says: {files_list}")
+        logger.debug("%s says: %s", self.name, files_list)
+        return files_list
+
+    async def aget_relevant_files(self, question, index, history):
+        logger.info("%s says: getting relevant files...", self.name)
+        files = await self.file_selector_chain.ainvoke({"question": question, "index": index, "history": history})
+        if files == "":
+            files_list = []
+        else:
+            files_list = files.replace(" ", "").split(",")
+        logger.debug("%s says: %s", self.name, files_list)
         return files_list
     
     def get_files_head(self, files_list):
-        print(f"{self.name} says: getting a sample from the files...")
+        logger.info("%s says: getting a sample from the files...", self.name)
         files_head = {}
         for file in files_list:
-            blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=file)
-            blob_data = blob_client.download_blob().content_as_text()
+            with trace_span("blob_download"):
+                blob_data = self.breaker.call(self.download, file)
             csv_data = StringIO(blob_data)
             head = pd.read_csv(csv_data, nrows=5)
-            print(f"{self.name} says:\n {head}")
+            logger.debug("%s says:\n %s", self.name, head)
             files_head[file] = head.fillna("null").to_dict(orient="records")
         return files_head
 
     def generate_code(self, question, context, history):
-        print(f"{self.name} says: generating code...")
+        logger.info("%s says: generating code...", self.name)
         code = self.code_generator_chain.invoke({"question": question, "context": context, "history": history})
-        print(f"{self.name} says: {code}")
+        logger.debug("%s says: %s", self.name, code)
 
-        print(f"{self.name} says: reviewing code...")
-        reviewed_code = self.code_reviewer_chain.invoke(code.replace("{", "{{").replace("}", "}}"))
-        print(f"{self.name} says: {reviewed_code}")
-        
-        cleaned_code = re.sub(r"^```python\n", "", reviewed_code)  # Remove start markdown
+        logger.info("%s says: reviewing code...", self.name)
+        reviewed_code = self.code_reviewer_chain.invoke({"code": code})
+        logger.debug("%s says: %s", self.name, reviewed_code)
+        return self.clean_code(reviewed_code)
+
+    async def agenerate_code(self, question, context, history):
+        logger.info("%s says: generating code...", self.name)
+        code = await self.code_generator_chain.ainvoke({"question": question, "context": context, "history": history})
+        logger.debug("%s says: %s", self.name, code)
+
+        logger.info("%s says: reviewing code...", self.name)
+        reviewed_code = await self.code_reviewer_chain.ainvoke({"code": code})
+        logger.debug("%s says: %s", self.name, reviewed_code)
+        return self.clean_code(reviewed_code)
+
+    def clean_code(self, code):
+        cleaned_code = re.sub(r"^```python\n", "", code)  # Remove start markdown
         cleaned_code = re.sub(r"\n```$", "", cleaned_code)  # Remove end markdown
         return cleaned_code
     
     def run_code(self, code):
         safe_locals = {}
-        print(f"{self.name} says: executing code...")
-        exec(code, globals(), safe_locals)
+        # The code can't be stopped once it runs in its thread, so it doesn't start after the agent timed out
+        check_deadline()
+        logger.info("%s says: executing code...", self.name)
+        with trace_span("code_execution"):
+            exec(code, globals(), safe_locals)
         result = safe_locals['result']
-        print(f"{self.name} says: {result}")
+        logger.debug("%s says: %s", self.name, result)
         return result
     
     def generate_answer(self, state: State):
-        print(f"{self.name} says: received question '{state['question']}'")
-        
-        if "agents" not in state:
-            state["agents"] = {}
+        logger.info("%s says: received question '%s'", self.name, state['question'])
 
         try:
             # Filter agent history
             agent_history = filter_agent_history(state["history"], self.name)
 
             # Check if it can answer the question right away or if it needs to continue
-            answer = self.entry_point_chain.invoke({"question": state["question"], "history": agent_history})
-            print(f"{self.name} says: {answer}")
+            # In fused mode the supervisor already did this check
+            answer = (state.get("entry_answers") or {}).get(self.name)
+            if answer is None:
+                answer = self.entry_point_chain.invoke({"question": state["question"], "history": agent_history})
+            logger.debug("%s says: %s", self.name, answer)
             if answer == 'CONTINUE':
                 # Get index file
                 index = self.get_index()
@@ -266,14 +295,68 @@ class AgentCsv:
                 result = self.run_code(code)
 
                 # Finally answer the question
-                print(f"{self.name} says: generating answer...")
-                answer = self.answer_generator_chain.invoke({"question": state["question"], "code": code.replace("{", "{{").replace("}", "}}"), "result": result, "history": agent_history})
-                print(f"{self.name} says: {answer}")
+                logger.info("%s says: generating answer...", self.name)
+                answer = self.answer_generator_chain.invoke({"question": state["question"], "code": code, "result": result, "history": agent_history})
+                logger.debug("%s says: %s", self.name, answer)
             
-            state["agents"][f"{self.name}"] = answer
-            return state
+            # Only this agent's entry is returned, so it can be merged with other agents running in parallel
+            return { "agents": { self.name: answer } }
         
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
-            state["agents"][f"{self.name}"] = "I don't know"
-            return state
\ No newline at end of file
+            logger.error("%s says: ERROR %s", self.name, e)
+            record_agent_error(self.name)
+            return { "agents": { self.name: "I don't know" } }
+
+    async def aprefetch(self, state: State):
+        # The index doesn't depend on the question, so it can be retrieved before the agent is picked
+        try:
+            return { "index": await asyncio.to_thread(self.get_index) }
+        except Exception as e:
+            logger.error("%s says: ERROR %s", self.name, e)
+            return {}
+
+    async def agenerate_answer(self, state: State):
+        logger.info("%s says: received question '%s'", self.name, state['question'])
+        prefetched = (state.get("prefetched") or {}).get(self.name, {})
+
+        try:
+            # Filter agent history
+            agent_history = filter_agent_history(state["history"], self.name)
+
+            # Check if it can answer the question right away or if it needs to continue
+            # In fused mode the supervisor already did this check
+            answer = (state.get("entry_answers") or {}).get(self.name)
+            if answer is None:
+                answer = await self.entry_point_chain.ainvoke({"question": state["question"], "history": agent_history})
+            logger.debug("%s says: %s", self.name, answer)
+            if answer == 'CONTINUE':
+                # Blob downloads and code execution are blocking, so they run in a worker thread
+                # Get index file
+                if "index" in prefetched:
+                    index = prefetched["index"]
+                else:
+                    index = await asyncio.to_thread(self.get_index)
+
+                # Get relevant files
+                relevant_files = await self.aget_relevant_files(state['question'], index, agent_history)
+
+                # Get an extract from the relevant files
+                context = await asyncio.to_thread(self.get_files_head, relevant_files)
+
+                # Generate Python code to interact with the files
+                code = await self.agenerate_code(state['question'], context, agent_history)
+
+                # Execute the code
+                result = await asyncio.to_thread(self.run_code, code)
+
+                # Finally answer the question
+                logger.info("%s says: generating answer...", self.name)
+                answer = await self.answer_generator_chain.ainvoke({"question": state["question"], "code": code, "result": result, "history": agent_history})
+                logger.debug("%s says: %s", self.name, answer)
+
+            return { "agents": { self.name: answer } }
+
+        except Exception as e:
+            logger.error("%s says: ERROR %s", self.name, e)
+            record_agent_error(self.name)
+            return { "agents": { self.name: "I don't know" } }
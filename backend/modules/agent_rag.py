@@ -1,27 +1,39 @@
 from .models import State
-from .utils import filter_agent_history
-from langchain_openai import AzureOpenAIEmbeddings, AzureChatOpenAI
+from .utils import filter_agent_history, build_prompt
+from .tracing import trace_span
+from .metrics import record_agent_error
+from .llm import get_llm
+from .prompt_budget import budget_prompt
+from .circuit_breaker import circuit_breakers
+from .embedding_cache import CachedEmbeddings
+from langchain_openai import AzureOpenAIEmbeddings
 from langchain_google_genai import GoogleGenerativeAIEmbeddings
 from langchain_community.vectorstores.azuresearch import AzureSearch
-from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnableLambda
+from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+import asyncio
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
 
 class AgentRag:    
-    def __init__(self, config):
+    def __init__(self, config, lazy=False, embedding_cache=None):
         self.name = f"agent_{config['agent_id']}"
         self.skills = config['agent_directive']
         self.config = config
         self.status = ""
         
         # Vector store instantiation
-        self.vstore = self.connect()
+        # Lazy agents connect on first use, so they don't slow down the startup
+        self.connect_lock = threading.Lock()
+        self.embeddings = None
+        # Optional store of the embedded texts, repeated questions are not sent to the embeddings model again
+        self.embedding_cache = embedding_cache
+        self.vstore = None if lazy else self.connect()
 
-        # LLM instantiation
-        self.llm = AzureChatOpenAI(
-            deployment_name="gpt-4o",
-            api_version="2023-06-01-preview"
-        )
+        # Failed searches are retried, and the agent is skipped while the vector store is down
+        self.breaker = circuit_breakers.get(self.name, "vector_store", transient=(ServiceRequestError, ServiceResponseError))
 
         # The system prompt guides the agent on how to respond
         self.answer_generator_prompt = (
@@ -36,25 +48,16 @@ class AgentRag:
             "Chat history: {history}"
         )
 
-        # The prompt puts together the system prompt with the user question
-        self.prompt = lambda inputs: ChatPromptTemplate.from_messages(
-            [
-                ("system", inputs["system_prompt"]),
-                ("human", inputs["human_prompt"]),
-            ]
-        )
-
         # The parser just plucks the string content out of the LLM's output message
         self.parser = StrOutputParser()
 
         # The chain orchestrates the whole flow
         self.answer_generator_chain = (
-            { "question": RunnableLambda(lambda inputs: inputs["question"]), "context": RunnableLambda(lambda inputs: inputs["context"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
-            #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
-            | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.answer_generator_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            budget_prompt(self.name, "answer_generator_chain")
+            | build_prompt(self.answer_generator_prompt)
+            | get_llm(self.name, "answer_generator_chain")
             | self.parser
-        )
+        ).with_config(run_name="answer_generator_chain")
 
         self.entry_point_prompt = (
             "You are an AI assistant for question-answering tasks. "
@@ -70,83 +73,153 @@ class AgentRag:
         )
 
         self.entry_point_chain = (
-            { "question": RunnableLambda(lambda inputs: inputs["question"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
-            #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
-            | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.entry_point_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            budget_prompt(self.name, "entry_point_chain")
+            | build_prompt(self.entry_point_prompt)
+            | get_llm(self.name, "entry_point_chain")
             | self.parser
-        )
+        ).with_config(run_name="entry_point_chain")
 
     def connect(self):
-        print(f"{self.name} says: connecting to vector store...")
+        logger.info("%s says: connecting to vector store...", self.name)
         try:
             # Embeddings model instantiation
+            # The model is kept, as it is also used to embed the questions for the answer cache
             if self.config["embeddings"] == "openai":
-                embeddings = AzureOpenAIEmbeddings(model="ada-002", openai_api_version="2024-06-01")
+                self.embeddings = AzureOpenAIEmbeddings(model="ada-002", openai_api_version="2024-06-01")
             elif self.config["embeddings"] == "google":    
-                embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
+                self.embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
             else:
-                embeddings = AzureOpenAIEmbeddings(model="ada-002", openai_api_version="2024-06-01")
+                self.embeddings = AzureOpenAIEmbeddings(model="ada-002", openai_api_version="2024-06-01")
+            if self.embedding_cache is not None:
+                self.embeddings = CachedEmbeddings(self.embeddings, self.embeddings.model, self.embedding_cache)
 
             # Connect to the vector store    
             vstore = AzureSearch(
                 azure_search_endpoint=self.config["azure_search_endpoint"],
                 azure_search_key=self.config["azure_search_key"],
                 index_name=self.config["index_name"],
-                embedding_function=embeddings.embed_query
+                embedding_function=self.embeddings.embed_query
             )
-            print(f"{self.name} says: connection established.")
+            logger.info("%s says: connection established.", self.name)
             return vstore
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            logger.error("%s says: ERROR %s", self.name, e)
             self.status = e
             return None
 
+    def ensure_connected(self):
+        # Connects the vector store if it isn't yet, only once when called from several threads
+        with self.connect_lock:
+            if self.vstore is None:
+                self.vstore = self.connect()
+        return self.vstore is not None
+
+    def is_ready(self):
+        return self.vstore is not None
+
+    def is_available(self):
+        return self.breaker.is_available()
+
     def check_connection(self):
-        print(f"{self.name} says: checking connection to vector store...")
+        logger.info("%s says: checking connection to vector store...", self.name)
         try:
             self.vstore.similarity_search("this is a test", k=1)
-            print(f"{self.name} says: connection up and running.")
+            logger.info("%s says: connection up and running.", self.name)
             self.status = "up and running"
             return { "healthy": True, "info": self.status }
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            logger.error("%s says: ERROR %s", self.name, e)
             # Try to reconnect
             self.vstore = self.connect()
             return { "healthy": True if self.vstore is not None else False, "info": self.status }
 
+    async def aembed_query(self, text):
+        await asyncio.to_thread(self.ensure_connected)
+        return await self.embeddings.aembed_query(text)
+
+    async def aembed_documents(self, texts):
+        await asyncio.to_thread(self.ensure_connected)
+        return await self.embeddings.aembed_documents(texts)
+
+    def search(self, query):
+        # Connects on first use, and again after the connection failed
+        if not self.ensure_connected():
+            raise ConnectionError(f"{self.name} could not connect to the vector store: {self.status}")
+        return self.vstore.similarity_search(query, k=3)
+
     def retrieve_context(self, query):
-        print(f"{self.name} says: retrieving relevant information...")      
-        docs = self.vstore.similarity_search(query, k=3)
-        print(f"{self.name} says: {docs}")
+        logger.info("%s says: retrieving relevant information...", self.name)      
+        with trace_span("vector_search"):
+            docs = self.breaker.call(self.search, query)
+        logger.debug("%s says: %s", self.name, docs)
         # Put together the results of the similarity search into one chunk of text
         return "\n\n".join(doc.page_content for doc in docs)
 
     def generate_answer(self, state: State):
-        print(f"{self.name} says: received question '{state['question']}'")
-
-        if "agents" not in state:
-            state["agents"] = {}
+        logger.info("%s says: received question '%s'", self.name, state['question'])
 
         try:
             # Filter agent history
             agent_history = filter_agent_history(state["history"], self.name)
 
             # Check if it can answer the question right away or if it needs to continue
-            answer = self.entry_point_chain.invoke({"question": state["question"], "history": agent_history})
-            print(f"{self.name} says: {answer}")
+            # In fused mode the supervisor already did this check
+            answer = (state.get("entry_answers") or {}).get(self.name)
+            if answer is None:
+                answer = self.entry_point_chain.invoke({"question": state["question"], "history": agent_history})
+            logger.debug("%s says: %s", self.name, answer)
             if answer == 'CONTINUE':
                 # Retrieve the most relevant documents from the vector store
                 context = self.retrieve_context(state['question'])
                 
-                print(f"{self.name} says: generating answer...")
+                logger.info("%s says: generating answer...", self.name)
                 answer = self.answer_generator_chain.invoke({"question": state["question"], "context": context, "history": agent_history})
-                print(f"{self.name} says: {answer}")
+                logger.debug("%s says: %s", self.name, answer)
             
-            state["agents"][f"{self.name}"] = answer
-            return state
+            # Only this agent's entry is returned, so it can be merged with other agents running in parallel
+            return { "agents": { self.name: answer } }
         
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
-            state["agents"][f"{self.name}"] = "I don't know"
-            return state
+            logger.error("%s says: ERROR %s", self.name, e)
+            record_agent_error(self.name)
+            return { "agents": { self.name: "I don't know" } }
+
+    async def aprefetch(self, state: State):
+        # The retrieval doesn't depend on the LLM, so it can start before the agent is picked
+        try:
+            return { "context": await asyncio.to_thread(self.retrieve_context, state["question"]) }
+        except Exception as e:
+            logger.error("%s says: ERROR %s", self.name, e)
+            return {}
+
+    async def agenerate_answer(self, state: State):
+        logger.info("%s says: received question '%s'", self.name, state['question'])
+        prefetched = (state.get("prefetched") or {}).get(self.name, {})
+
+        try:
+            # Filter agent history
+            agent_history = filter_agent_history(state["history"], self.name)
+
+            # Check if it can answer the question right away or if it needs to continue
+            # In fused mode the supervisor already did this check
+            answer = (state.get("entry_answers") or {}).get(self.name)
+            if answer is None:
+                answer = await self.entry_point_chain.ainvoke({"question": state["question"], "history": agent_history})
+            logger.debug("%s says: %s", self.name, answer)
+            if answer == 'CONTINUE':
+                # The vector store client is blocking, so the search runs in a worker thread
+                if "context" in prefetched:
+                    context = prefetched["context"]
+                else:
+                    context = await asyncio.to_thread(self.retrieve_context, state['question'])
+
+                logger.info("%s says: generating answer...", self.name)
+                answer = await self.answer_generator_chain.ainvoke({"question": state["question"], "context": context, "history": agent_history})
+                logger.debug("%s says: %s", self.name, answer)
+
+            return { "agents": { self.name: answer } }
+
+        except Exception as e:
+            logger.error("%s says: ERROR %s", self.name, e)
+            record_agent_error(self.name)
+            return { "agents": { self.name: "I don't know" } }
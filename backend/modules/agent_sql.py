@@ -1,36 +1,39 @@
 from .models import State
-from .utils import filter_agent_history
-from langchain_openai import AzureChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
+from .utils import filter_agent_history, build_prompt
+from .tracing import trace_span
+from .metrics import record_agent_error
+from .llm import get_llm
+from .prompt_budget import budget_prompt
+from .circuit_breaker import circuit_breakers
+from .deadline import get_remaining
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain_community.utilities import SQLDatabase
+from sqlalchemy import Engine, event
+from sqlalchemy.exc import OperationalError, InterfaceError, ProgrammingError, DataError
 import re
+import math
+import asyncio
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
 
 class AgentSql:
-    def __init__(self, config): 
+    def __init__(self, config, lazy=False): 
         self.name = f"agent_{config['agent_id']}"
         self.skills = config['agent_directive']
         self.config = config
         self.status = ""
         
         # Database instantiation 
-        self.db = self.connect()
-        
-        # LLM instantiation
-        self.llm = AzureChatOpenAI(
-            deployment_name="gpt-4o",
-            api_version="2023-06-01-preview"
-        )
-
-        # The prompt puts together the system prompt with the user question
-        self.prompt = lambda inputs: ChatPromptTemplate.from_messages(
-            [
-                ("system", inputs["system_prompt"]),
-                ("human", inputs["human_prompt"]),
-            ]
-        )
+        # Lazy agents connect on first use, so they don't slow down the startup
+        self.connect_lock = threading.Lock()
+        self.db = None if lazy else self.connect()
 
+        # Lost connections are retried, and the agent is skipped while the database is down.
+        # Errors in the generated queries are not the database fault, so they don't count as failures
+        self.breaker = circuit_breakers.get(self.name, "database", transient=(OperationalError, InterfaceError), ignore=(ProgrammingError, DataError))
+        
         # The parser just plucks the string content out of the LLM's output message
         self.parser = StrOutputParser()
 
@@ -52,12 +55,11 @@ class AgentSql:
         )
 
         self.query_generator_chain = (
-            { "question": RunnableLambda(lambda inputs: inputs["question"]), "schema": RunnableLambda(lambda inputs: inputs["schema"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
-            #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
-            | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.query_generator_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            budget_prompt(self.name, "query_generator_chain")
+            | build_prompt(self.query_generator_prompt)
+            | get_llm(self.name, "query_generator_chain")
             | self.parser
-        )
+        ).with_config(run_name="query_generator_chain")
 
         # A prompt to double check the generated query and adjust if needed
         self.query_reviewer_prompt = (
@@ -77,12 +79,10 @@ class AgentSql:
         )
 
         self.query_reviewer_chain = (
-            { "query": RunnablePassthrough() }
-            #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
-            | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.query_reviewer_prompt, "human_prompt": inputs["query"]}))
-            | self.llm
+            build_prompt(self.query_reviewer_prompt, "{query}")
+            | get_llm(self.name, "query_reviewer_chain")
             | self.parser
-        )
+        ).with_config(run_name="query_reviewer_chain")
 
         # A prompt to generate an answer to the question given the information pulled from the database
         self.answer_generator_prompt = (
@@ -100,12 +100,11 @@ class AgentSql:
         )
 
         self.answer_generator_chain = (
-            { "question": RunnableLambda(lambda inputs: inputs["question"]), "query": RunnableLambda(lambda inputs: inputs["query"]), "result": RunnableLambda(lambda inputs: inputs["result"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
-            #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
-            | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.answer_generator_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            budget_prompt(self.name, "answer_generator_chain")
+            | build_prompt(self.answer_generator_prompt)
+            | get_llm(self.name, "answer_generator_chain")
             | self.parser
-        )
+        ).with_config(run_name="answer_generator_chain")
 
         self.entry_point_prompt = (
             "You are an AI assistant for question-answering tasks. "
@@ -121,81 +120,124 @@ class AgentSql:
         )
 
         self.entry_point_chain = (
-            { "question": RunnableLambda(lambda inputs: inputs["question"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
-            #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
-            | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.entry_point_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            budget_prompt(self.name, "entry_point_chain")
+            | build_prompt(self.entry_point_prompt)
+            | get_llm(self.name, "entry_point_chain")
             | self.parser
-        )
+        ).with_config(run_name="entry_point_chain")
 
     def connect(self):
         self.connection_string = self.config["connection_string"]
-        print(f"{self.name} says: connecting to database...")
+        logger.info("%s says: connecting to database...", self.name)
         try:
             db = SQLDatabase.from_uri(self.connection_string)
-            print(f"{self.name} says: connection established.")
+            if isinstance(db._engine, Engine):
+                event.listen(db._engine, "before_cursor_execute", self.set_statement_timeout)
+            logger.info("%s says: connection established.", self.name)
             return db
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            logger.error("%s says: ERROR %s", self.name, e)
             self.status = e
             return None
 
+    def set_statement_timeout(self, conn, cursor, statement, parameters, context, executemany):
+        # The queries of an agent with a deadline are cancelled by the driver when it runs out of time,
+        # instead of holding the connection after the request gave up on them
+        driver_connection = getattr(conn.connection, "driver_connection", None)
+        if not hasattr(driver_connection, "timeout"):
+            return
+        remaining = get_remaining()
+        # The connections are pooled, so the ones without a deadline are set back to no timeout
+        driver_connection.timeout = max(math.ceil(remaining), 1) if remaining is not None else 0
+
+    def ensure_connected(self):
+        # Connects to the database if it isn't yet, only once when called from several threads
+        with self.connect_lock:
+            if self.db is None:
+                self.db = self.connect()
+        return self.db is not None
+
+    def is_ready(self):
+        return self.db is not None
+
+    def is_available(self):
+        return self.breaker.is_available()
+
     def check_connection(self):
-        print(f"{self.name} says: checking connection to database...")
+        logger.info("%s says: checking connection to database...", self.name)
         try:
-            self.db.run("""SELECT 1""")
-            print(f"{self.name} says: connection up and running.")
+            with trace_span("sql_check"):
+                self.db.run("""SELECT 1""")
+            logger.info("%s says: connection up and running.", self.name)
             self.status = "up and running"
             return { "healthy": True, "info": self.status }
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            logger.error("%s says: ERROR %s", self.name, e)
             # Try to reconnect
             self.db = self.connect()
             return { "healthy": True if self.db is not None else False, "info": self.status }
 
+    def run_statement(self, statement):
+        # Connects on first use, and again after the connection was lost
+        if not self.ensure_connected():
+            raise ConnectionError(f"{self.name} could not connect to the database: {self.status}")
+        return self.db.run(statement)
+
     def get_schema(self):
-        print(f"{self.name} says: retrieving database schema...")
-        schema = self.db.run("SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME, DATA_TYPE FROM INFORMATION_SCHEMA.COLUMNS")
-        print(f"{self.name} says: {schema}")
+        logger.info("%s says: retrieving database schema...", self.name)
+        with trace_span("sql_schema"):
+            schema = self.breaker.call(self.run_statement, "SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME, DATA_TYPE FROM INFORMATION_SCHEMA.COLUMNS")
+        logger.debug("%s says: %s", self.name, schema)
         return schema
 
     def generate_query(self, question, schema, history):
-        print(f"{self.name} says: generating query...")
+        logger.info("%s says: generating query...", self.name)
         query = self.query_generator_chain.invoke({"question": question, "schema": schema, "history": history})
-        print(f"{self.name} says: {query}")
+        logger.debug("%s says: %s", self.name, query)
 
-        print(f"{self.name} says: reviewing query...")
-        reviewed_query = self.query_reviewer_chain.invoke(query)
-        print(f"{self.name} says: {reviewed_query}")
+        logger.info("%s says: reviewing query...", self.name)
+        reviewed_query = self.query_reviewer_chain.invoke({"query": query})
+        logger.debug("%s says: %s", self.name, reviewed_query)
+        return self.clean_query(reviewed_query)
 
-        cleaned_query = re.sub(r"^```sql\n", "", reviewed_query)  # Remove start markdown
+    async def agenerate_query(self, question, schema, history):
+        logger.info("%s says: generating query...", self.name)
+        query = await self.query_generator_chain.ainvoke({"question": question, "schema": schema, "history": history})
+        logger.debug("%s says: %s", self.name, query)
+
+        logger.info("%s says: reviewing query...", self.name)
+        reviewed_query = await self.query_reviewer_chain.ainvoke({"query": query})
+        logger.debug("%s says: %s", self.name, reviewed_query)
+        return self.clean_query(reviewed_query)
+
+    def clean_query(self, query):
+        cleaned_query = re.sub(r"^```sql\n", "", query)  # Remove start markdown
         cleaned_query = re.sub(r"\n```$", "", cleaned_query)  # Remove end markdown
         cleaned_query = re.sub(r"\n", " ", cleaned_query) # Replace new line with space
         cleaned_query = cleaned_query.strip() # Remove leading and trailing whitespace (just in case)   
         return cleaned_query
     
     def run_query(self, query):
-        print(f"{self.name} says: executing query...")
-        result = self.db.run(query)
-        print(f"{self.name} says: {result}")
+        logger.info("%s says: executing query...", self.name)
+        with trace_span("sql_query"):
+            result = self.breaker.call(self.run_statement, query)
+        logger.debug("%s says: %s", self.name, result)
         return result
     
     def generate_answer(self, state: State):
-        print(f"{self.name} says: received question '{state['question']}'")
-        
-        if "agents" not in state:
-            state["agents"] = {}
+        logger.info("%s says: received question '%s'", self.name, state['question'])
         
         try:
             # Filter agent history
             agent_history = filter_agent_history(state["history"], self.name)
 
             # Check if it can answer the question right away or if it needs to continue
-            answer = self.entry_point_chain.invoke({"question": state["question"], "history": agent_history})
-            print(f"{self.name} says: {answer}")
+            # In fused mode the supervisor already did this check
+            answer = (state.get("entry_answers") or {}).get(self.name)
+            if answer is None:
+                answer = self.entry_point_chain.invoke({"question": state["question"], "history": agent_history})
+            logger.debug("%s says: %s", self.name, answer)
             if answer == 'CONTINUE':
-                self.check_connection()
-                
                 # Get tables and columns from the database
                 schema = self.get_schema()
 
@@ -206,14 +248,63 @@ class AgentSql:
                 result = self.run_query(query)
 
                 # Finally answer the question
-                print(f"{self.name} says: generating answer...")
+                logger.info("%s says: generating answer...", self.name)
                 answer = self.answer_generator_chain.invoke({"question": state["question"], "query": query, "result": result, "history": agent_history})
-                print(f"{self.name} says: {answer}")
+                logger.debug("%s says: %s", self.name, answer)
             
-            state["agents"][f"{self.name}"] = answer
-            return state
+            # Only this agent's entry is returned, so it can be merged with other agents running in parallel
+            return { "agents": { self.name: answer } }
         
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
-            state["agents"][f"{self.name}"] = "I don't know"
-            return state
\ No newline at end of file
+            logger.error("%s says: ERROR %s", self.name, e)
+            record_agent_error(self.name)
+            return { "agents": { self.name: "I don't know" } }
+
+    async def aprefetch(self, state: State):
+        # The schema doesn't depend on the question, so it can be retrieved before the agent is picked
+        try:
+            return { "schema": await asyncio.to_thread(self.get_schema) }
+        except Exception as e:
+            logger.error("%s says: ERROR %s", self.name, e)
+            return {}
+
+    async def agenerate_answer(self, state: State):
+        logger.info("%s says: received question '%s'", self.name, state['question'])
+        prefetched = (state.get("prefetched") or {}).get(self.name, {})
+
+        try:
+            # Filter agent history
+            agent_history = filter_agent_history(state["history"], self.name)
+
+            # Check if it can answer the question right away or if it needs to continue
+            # In fused mode the supervisor already did this check
+            answer = (state.get("entry_answers") or {}).get(self.name)
+            if answer is None:
+                answer = await self.entry_point_chain.ainvoke({"question": state["question"], "history": agent_history})
+            logger.debug("%s says: %s", self.name, answer)
+            if answer == 'CONTINUE':
+                # The database driver is blocking, so every call to it runs in a worker thread
+                if "schema" in prefetched:
+                    # The connection is known to work, as the schema was already retrieved
+                    schema = prefetched["schema"]
+                else:
+                    # Get tables and columns from the database
+                    schema = await asyncio.to_thread(self.get_schema)
+
+                # Construct a SQL query
+                query = await self.agenerate_query(state['question'], schema, agent_history)
+
+                # Execute the query
+                result = await asyncio.to_thread(self.run_query, query)
+
+                # Finally answer the question
+                logger.info("%s says: generating answer...", self.name)
+                answer = await self.answer_generator_chain.ainvoke({"question": state["question"], "query": query, "result": result, "history": agent_history})
+                logger.debug("%s says: %s", self.name, answer)
+
+            return { "agents": { self.name: answer } }
+
+        except Exception as e:
+            logger.error("%s says: ERROR %s", self.name, e)
+            record_agent_error(self.name)
+            return { "agents": { self.name: "I don't know" } }
@@ -0,0 +1,143 @@
+from .metrics import answer_cache_requests
+from collections import OrderedDict
+import numpy as np
+import sqlite3
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class InvalidationLog:
+    # Invalidations of the answer cache, written to a SQLite file shared by the workers of the server.
+    # Each worker applies the ones made by the others before its next lookup
+    def __init__(self, path, check_interval=1):
+        # Seconds between two reads of the file, the other workers can serve a dropped answer for that long
+        self.check_interval = check_interval
+        self.checked = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS invalidations (id INTEGER PRIMARY KEY AUTOINCREMENT, agent TEXT, created REAL NOT NULL)")
+        self.db.commit()
+        # A new worker starts with an empty cache, the invalidations made before don't apply to it
+        self.last_id = self.db.execute("SELECT COALESCE(MAX(id), 0) FROM invalidations").fetchone()[0]
+        self.own_ids = set()
+
+    def publish(self, agent=None):
+        with self.lock:
+            cursor = self.db.execute("INSERT INTO invalidations (agent, created) VALUES (?, ?)", (agent, time.time()))
+            self.db.commit()
+            self.own_ids.add(cursor.lastrowid)
+
+    def poll(self):
+        # Returns the agents invalidated by the other workers since the last read, None meaning every answer
+        with self.lock:
+            now = time.monotonic()
+            if now - self.checked < self.check_interval:
+                return []
+            self.checked = now
+            rows = self.db.execute("SELECT id, agent FROM invalidations WHERE id > ? ORDER BY id", (self.last_id,)).fetchall()
+            if rows:
+                self.last_id = rows[-1][0]
+            agents = [agent for id, agent in rows if id not in self.own_ids]
+            self.own_ids.difference_update(id for id, _ in rows)
+            return agents
+
+
+class SemanticCache:
+    # Keeps the latest answers, indexed by the embedding of their question.
+    # A new question reuses the answer of the most similar previous question, if it is similar enough
+    def __init__(self, embed, similarity_threshold=0.98, ttl=3600, max_entries=1000, invalidations=None):
+        # Async function that returns the embedding of a text
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Invalidations shared with the other workers, None if this worker is the only one
+        self.invalidations = invalidations
+
+        # Least recently used entries first
+        self.entries = OrderedDict()
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+        # Vectors of the entries in one preallocated matrix, so a lookup is a single product without copying them.
+        # Each entry has its row, and each row its entry id and expiry time, -1 for a free row
+        self.vectors = None
+        self.row_ids = np.full(max_entries, -1, dtype=np.int64)
+        self.row_expires = np.zeros(max_entries)
+
+    def is_cacheable(self, history):
+        # The cache is shared by every session, so only the questions asked without a conversation use it.
+        # An answer built from the history may depend on it, e.g. "what is my name?"
+        return len(history or []) == 0
+
+    async def aembed(self, question):
+        # Vectors are normalized, so the cosine similarity is just a dot product
+        vector = np.asarray(await self.embed(question), dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def lookup(self, vector):
+        self.apply_invalidations()
+        with self.lock:
+            self.remove_expired()
+            if len(self.entries) == 0:
+                answer_cache_requests.inc(result="miss")
+                return None
+
+            similarities = self.vectors @ vector
+            similarities[self.row_ids < 0] = -np.inf
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity_threshold:
+                answer_cache_requests.inc(result="miss")
+                return None
+
+            id = int(self.row_ids[best])
+            self.entries.move_to_end(id)
+            entry = self.entries[id]
+            answer_cache_requests.inc(result="hit")
+            logger.info("Cache says: '%s' matches with similarity %.3f", entry['question'], similarities[best])
+            return { "answer": entry["answer"], "agents": entry["agents"] }
+
+    def add(self, question, vector, answer, agents):
+        vector = np.asarray(vector, dtype=np.float32)
+        with self.lock:
+            if self.vectors is None:
+                # Allocated on the first answer, as its size depends on the embeddings model
+                self.vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+            # The least recently used entry makes room when the cache is full
+            if len(self.entries) >= self.max_entries:
+                self.remove(next(iter(self.entries)))
+            row = int(np.flatnonzero(self.row_ids < 0)[0])
+            expires = time.monotonic() + self.ttl
+            self.entries[self.next_id] = { "question": question, "answer": answer, "agents": agents, "expires": expires, "row": row }
+            self.vectors[row] = vector
+            self.row_ids[row] = self.next_id
+            self.row_expires[row] = expires
+            self.next_id += 1
+
+    def remove(self, id):
+        self.row_ids[self.entries.pop(id)["row"]] = -1
+
+    def invalidate(self, agent=None, publish=True):
+        # Drops the answers an agent took part in, e.g. after its knowledge base is updated, or all of them.
+        # The other workers drop theirs before their next lookup
+        with self.lock:
+            ids = [id for id, entry in self.entries.items() if agent is None or agent in entry["agents"]]
+            for id in ids:
+                self.remove(id)
+        if publish and self.invalidations is not None:
+            self.invalidations.publish(agent)
+        logger.info("Cache says: %s answers invalidated", len(ids))
+        return len(ids)
+
+    def apply_invalidations(self):
+        if self.invalidations is None:
+            return
+        for agent in self.invalidations.poll():
+            self.invalidate(agent, publish=False)
+
+    def remove_expired(self):
+        for row in np.flatnonzero((self.row_ids >= 0) & (self.row_expires < time.monotonic())):
+            self.remove(int(self.row_ids[row]))
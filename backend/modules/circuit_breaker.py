@@ -0,0 +1,156 @@
+from .metrics import circuit_breaker_state, circuit_breaker_calls
+from .deadline import check_deadline, get_remaining
+import random
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Answer recorded for an agent whose backend is down, it is skipped without calling the LLM
+UNAVAILABLE_ANSWER = "I don't know (unavailable)"
+
+# Values of the state gauge
+STATES = { "closed": 0, "half_open": 1, "open": 2 }
+
+
+class CircuitOpenError(Exception):
+    # Raised instead of calling a backend that is known to be down
+    pass
+
+
+class CircuitBreaker:
+    # Tracks the recent failures of a backend. Transient errors are retried with a jittered backoff,
+    # and once there are too many failures the backend is not called at all for a while.
+    # After that time a single call goes through, and its result closes or opens the circuit again
+    def __init__(self, name, enabled=True, failure_threshold=5, window=60, reset_timeout=30, retries=2, backoff=0.2, max_backoff=2, transient=(), ignore=()):
+        self.name = name
+        self.enabled = enabled
+        # Failures within the window that open the circuit
+        self.failure_threshold = failure_threshold
+        self.window = window
+        # Seconds the circuit stays open before trying the backend again
+        self.reset_timeout = reset_timeout
+        # Extra attempts for the transient errors, waiting a random time up to backoff * 2^attempt
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # Connection errors and timeouts are always retried, each backend adds its own transient errors
+        self.transient = (ConnectionError, TimeoutError, *transient)
+        # Errors that are not the backend fault, e.g. a wrong query, are raised without counting them
+        self.ignore = tuple(ignore)
+
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = []
+        self.opened = None
+        self.probing = False
+        circuit_breaker_state.set(STATES["closed"], breaker=name)
+
+    def set_state(self, state):
+        if state != self.state:
+            logger.info("Circuit breaker says: %s is %s", self.name, state.replace("_", " "))
+        self.state = state
+        circuit_breaker_state.set(STATES[state], breaker=self.name)
+
+    def is_available(self):
+        # True when a call would go through, without taking the trial call of a half open circuit
+        with self.lock:
+            return self.state != "open" or time.monotonic() - self.opened >= self.reset_timeout
+
+    def allow(self):
+        with self.lock:
+            if self.state == "open" and time.monotonic() - self.opened >= self.reset_timeout:
+                self.set_state("half_open")
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.probing = False
+            if self.state != "closed":
+                self.failures.clear()
+                self.set_state("closed")
+
+    def record_failure(self):
+        with self.lock:
+            now = time.monotonic()
+            self.probing = False
+            self.failures = [failure for failure in self.failures if now - failure < self.window] + [now]
+            if self.state == "half_open" or len(self.failures) >= self.failure_threshold:
+                self.opened = now
+                self.set_state("open")
+
+    def get_delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def call(self, func, *args, **kwargs):
+        # An agent that already timed out doesn't start more work on its backend
+        check_deadline()
+        if not self.enabled:
+            return func(*args, **kwargs)
+        if not self.allow():
+            circuit_breaker_calls.inc(breaker=self.name, result="rejected")
+            raise CircuitOpenError(f"{self.name} is unavailable")
+
+        # A half open circuit only gets one attempt, the backend may still be down
+        retries = self.retries if self.state == "closed" else 0
+        for attempt in range(retries + 1):
+            try:
+                result = func(*args, **kwargs)
+            except self.ignore:
+                self.record_success()
+                raise
+            except Exception as e:
+                # The retries stop at the deadline of the agent, the backend may be slow rather than down
+                remaining = get_remaining()
+                if attempt < retries and isinstance(e, self.transient) and (remaining is None or remaining > 0):
+                    circuit_breaker_calls.inc(breaker=self.name, result="retry")
+                    delay = self.get_delay(attempt)
+                    time.sleep(min(delay, remaining) if remaining is not None else delay)
+                    continue
+                circuit_breaker_calls.inc(breaker=self.name, result="failure")
+                self.record_failure()
+                raise
+            circuit_breaker_calls.inc(breaker=self.name, result="success")
+            self.record_success()
+            return result
+
+    def status(self):
+        with self.lock:
+            now = time.monotonic()
+            return {
+                "state": self.state,
+                "failures": len([failure for failure in self.failures if now - failure < self.window]),
+                "retry_in": round(max(self.reset_timeout - (now - self.opened), 0), 1) if self.state == "open" else None
+            }
+
+
+class CircuitBreakers:
+    # Circuit breakers of the agents backends, configured as "<backend>" for every agent or "<agent>.<backend>" for just one
+    def __init__(self, enabled=True, default=None, backends=None):
+        self.configure(enabled, default, backends)
+
+    def configure(self, enabled=True, default=None, backends=None):
+        self.enabled = enabled
+        self.default = default or {}
+        self.backends = backends or {}
+        self.breakers = {}
+
+    def get(self, component, backend, **params):
+        # Each agent builds its own breaker, the last one of each backend is the one reported
+        name = f"{component}.{backend}"
+        settings = { **self.default, **self.backends.get(backend, {}), **self.backends.get(name, {}), **params }
+        self.breakers[name] = CircuitBreaker(name, enabled=self.enabled, **settings)
+        return self.breakers[name]
+
+    def status(self):
+        return { name: breaker.status() for name, breaker in self.breakers.items() }
+
+
+# Circuit breakers of this process
+circuit_breakers = CircuitBreakers()
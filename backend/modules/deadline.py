@@ -0,0 +1,23 @@
+from contextvars import ContextVar
+import time
+
+# Monotonic time when the running agent runs out of its budget, None if it has no deadline.
+# Worker threads started with asyncio.to_thread see the deadline of the agent that started them
+agent_deadline = ContextVar("agent_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    # Raised instead of starting backend work for an agent that already timed out
+    pass
+
+
+def get_remaining():
+    # Seconds left to the running agent, None if it has no deadline
+    deadline = agent_deadline.get()
+    return deadline - time.monotonic() if deadline is not None else None
+
+
+def check_deadline():
+    remaining = get_remaining()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded("the agent ran out of time")
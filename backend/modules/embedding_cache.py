@@ -0,0 +1,133 @@
+from .lru_cache import LRUCache
+from .metrics import embedding_cache_requests
+from langchain_core.embeddings import Embeddings
+import numpy as np
+import hashlib
+import sqlite3
+import threading
+import time
+
+def get_key(model, text, kind="query"):
+    # Texts that only differ in spacing get the same vector, the case is kept as it changes the embedding.
+    # Some models embed questions and documents differently, so the kind of text is part of the key
+    normalized = " ".join(text.split())
+    return hashlib.sha256(f"{model}\n{kind}\n{normalized}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    # Vectors of the embedded texts as float32 arrays. The most recent ones are kept in memory,
+    # and optionally in a SQLite file that survives restarts and is shared by the workers of the server
+    def __init__(self, path=None, max_entries=10000, max_disk_entries=10000):
+        self.memory = LRUCache(max_entries)
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self.lock = threading.Lock()
+        self.db = None
+        self.requests = { "memory_hit": 0, "disk_hit": 0, "miss": 0 }
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, vector BLOB NOT NULL, created REAL NOT NULL)")
+            self.db.commit()
+            self.prune()
+
+    def count(self, result):
+        with self.lock:
+            self.requests[result] += 1
+        embedding_cache_requests.inc(result=result)
+
+    def get_disk(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT vector FROM vectors WHERE key = ?", (key,)).fetchone()
+        return np.frombuffer(row[0], dtype=np.float32).copy() if row is not None else None
+
+    def get(self, key):
+        vector = self.memory.get(key)
+        if vector is not None:
+            self.count("memory_hit")
+            return vector
+        vector = self.get_disk(key) if self.db is not None else None
+        if vector is not None:
+            self.memory.set(key, vector)
+            self.count("disk_hit")
+            return vector
+        self.count("miss")
+        return None
+
+    def set(self, key, vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        self.memory.set(key, vector)
+        if self.db is not None:
+            with self.lock:
+                self.db.execute("INSERT OR REPLACE INTO vectors (key, vector, created) VALUES (?, ?, ?)", (key, vector.tobytes(), time.time()))
+                self.db.commit()
+        return vector
+
+    def prune(self):
+        # Drops the oldest vectors over the limit of the file
+        with self.lock:
+            self.db.execute("DELETE FROM vectors WHERE key NOT IN (SELECT key FROM vectors ORDER BY created DESC LIMIT ?)", (self.max_disk_entries,))
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            total = sum(self.requests.values())
+            hits = self.requests["memory_hit"] + self.requests["disk_hit"]
+            return { **self.requests, "hit_rate": round(hits / total, 3) if total > 0 else None }
+
+    def flush(self):
+        # Every write is committed, the file only needs to be pruned to its limit
+        if self.db is not None:
+            self.prune()
+
+    def clear(self):
+        self.memory.clear()
+        if self.db is not None:
+            with self.lock:
+                self.db.execute("DELETE FROM vectors")
+                self.db.commit()
+
+
+class CachedEmbeddings(Embeddings):
+    # Embeddings model that only calls the model for the texts it didn't embed before.
+    # The lookups are in memory or in a local SQLite file, so the async methods do them in the event loop
+    def __init__(self, embeddings, model, store):
+        self.embeddings = embeddings
+        self.model = model
+        self.store = store
+
+    def get_cached(self, texts):
+        keys = [get_key(self.model, text, "document") for text in texts]
+        return keys, [self.store.get(key) for key in keys]
+
+    def store_missing(self, keys, vectors, missing, embedded):
+        for index, vector in zip(missing, embedded):
+            vectors[index] = self.store.set(keys[index], vector)
+        return [vector.tolist() for vector in vectors]
+
+    def embed_documents(self, texts):
+        keys, vectors = self.get_cached(texts)
+        # The texts not cached are embedded in a single call
+        missing = [index for index, vector in enumerate(vectors) if vector is None]
+        embedded = self.embeddings.embed_documents([texts[index] for index in missing]) if missing else []
+        return self.store_missing(keys, vectors, missing, embedded)
+
+    async def aembed_documents(self, texts):
+        keys, vectors = self.get_cached(texts)
+        missing = [index for index, vector in enumerate(vectors) if vector is None]
+        embedded = await self.embeddings.aembed_documents([texts[index] for index in missing]) if missing else []
+        return self.store_missing(keys, vectors, missing, embedded)
+
+    def embed_query(self, text):
+        key = get_key(self.model, text)
+        vector = self.store.get(key)
+        if vector is None:
+            vector = self.store.set(key, self.embeddings.embed_query(text))
+        return vector.tolist()
+
+    async def aembed_query(self, text):
+        key = get_key(self.model, text)
+        vector = self.store.get(key)
+        if vector is None:
+            vector = self.store.set(key, await self.embeddings.aembed_query(text))
+        return vector.tolist()
@@ -1,41 +1,195 @@
 from .models import State
+from .metrics import agent_fallbacks
+from .deadline import agent_deadline
 from langchain_core.runnables import RunnableLambda
 from langgraph.graph import StateGraph
+import asyncio
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Answer recorded for an agent that didn't finish within its time budget
+TIMEOUT_ANSWER = "I don't know (timed out)"
 
 class Graph():
-    def __init__(self, supervisor, summarizer, agent_list): 
+    def __init__(self, supervisor, summarizer, agent_list, parallel=False, bypass_summarizer=False, summarizer_reserve=0, summarizer_reserve_fraction=0.25, speculative=False):
         self.builder = StateGraph(State)
-        
-        # The supervisor is made of 2 connected nodes
-        self.builder.add_node("supervisor_agent_filter_node", supervisor.get_relevant_agents)
-        self.builder.add_node("supervisor_agent_picker_node", supervisor.generate_answer)
-        self.builder.add_edge("supervisor_agent_filter_node", "supervisor_agent_picker_node")
-        
+        self.parallel = parallel
+
+        # Seconds of the request deadline kept aside for the summarizer
+        self.summarizer_reserve = summarizer_reserve
+        # Short deadlines keep at most this fraction of the time left for it, so the agents still get some time
+        self.summarizer_reserve_fraction = summarizer_reserve_fraction
+
+        # Map each agent node to its agent, used when reporting progress
+        self.agent_nodes = { f"{agent.name}_node": agent.name for agent in agent_list }
+
+        # The supervisor filter node picks the relevant agents for the question
+        # Every node that calls an LLM has a sync and an async implementation,
+        # so the graph can be run both with invoke and ainvoke
+        # In speculative mode, the agents start their first stage while the supervisor is still routing
+        self.builder.add_node("supervisor_agent_filter_node", RunnableLambda(supervisor.get_relevant_agents, afunc=self.with_speculation(supervisor, agent_list) if speculative else supervisor.aget_relevant_agents))
+
         # Add a node for the summarizer
-        self.builder.add_node("summarizer_node", summarizer.generate_answer)
-        
+        self.builder.add_node("summarizer_node", RunnableLambda(summarizer.generate_answer, afunc=summarizer.agenerate_answer))
+
         # Loop through each agent in the agent list and add a node for each agent.
         for agent in agent_list:
-            self.builder.add_node(f"{agent.name}_node", agent.generate_answer)
-        
+            self.builder.add_node(f"{agent.name}_node", RunnableLambda(agent.generate_answer, afunc=self.with_deadline(agent)))
+
+        # The join node is the single step where all the agents answers meet before the summary.
+        # It is needed when agents run in parallel, or to decide if the summary can be skipped
+        use_join = parallel or bypass_summarizer
+        if use_join:
+            self.builder.add_node("supervisor_join_node", supervisor.join_answers)
+
+        if parallel:
+            self.build_fan_out(supervisor, agent_list)
+        else:
+            self.build_sequential(supervisor, agent_list, "supervisor_join_node" if use_join else "summarizer_node")
+
+        if bypass_summarizer:
+            self.build_summarizer_bypass(summarizer)
+        elif use_join:
+            self.builder.add_edge("supervisor_join_node", "summarizer_node")
+
+        # Set the entry point of the graph to the supervisor node.
+        self.builder.set_entry_point("supervisor_agent_filter_node")
+
+        # Compile the graph structure into a runnable object.
+        self.graph = self.builder.compile()
+
+    def build_sequential(self, supervisor, agent_list, finish_node):
+        # The picker node sends the question to one relevant agent at a time
+        self.builder.add_node("supervisor_agent_picker_node", supervisor.generate_answer)
+        self.builder.add_edge("supervisor_agent_filter_node", "supervisor_agent_picker_node")
+
         # Add conditional edges from the supervisor to other nodes.
         # Edges lead to agent-specific nodes or to the summarizer node
         self.builder.add_conditional_edges(
             "supervisor_agent_picker_node",
             RunnableLambda(lambda inputs: inputs["next"]),
-            {**{ f"{agent.name}": f"{agent.name}_node" for agent in agent_list }, "FINISH": "summarizer_node"}
+            {**{ f"{agent.name}": f"{agent.name}_node" for agent in agent_list }, "FINISH": finish_node}
         )
-        
+
         # For each agent, add a direct edge back to the supervisor.
         # This allows the graph to loop back after processing an agent's node.
         for agent in agent_list:
             self.builder.add_edge(f"{agent.name}_node", "supervisor_agent_picker_node")
-        
-        # Set the entry point of the graph to the supervisor node.
-        self.builder.set_entry_point("supervisor_agent_filter_node")
-        
-        # Compile the graph structure into a runnable object.
-        self.graph = self.builder.compile()
 
-    def invoke(self, state):
-        return self.graph.invoke(state)
\ No newline at end of file
+    def build_fan_out(self, supervisor, agent_list):
+        # All the relevant agents are triggered at once from the filter node.
+        # If there are no relevant agents, go straight to the join node
+        self.builder.add_conditional_edges(
+            "supervisor_agent_filter_node",
+            RunnableLambda(supervisor.get_pending_agents),
+            {**{ f"{agent.name}": f"{agent.name}_node" for agent in agent_list }, "FINISH": "supervisor_join_node"}
+        )
+
+        # Each agent only writes its own answer, which is merged into the state by the reducer
+        for agent in agent_list:
+            self.builder.add_edge(f"{agent.name}_node", "supervisor_join_node")
+
+    def build_summarizer_bypass(self, summarizer):
+        # When only one agent provided a real answer, it is returned as is and the summarizer LLM call is skipped
+        self.builder.add_node("summarizer_bypass_node", summarizer.bypass)
+        self.builder.add_conditional_edges(
+            "supervisor_join_node",
+            RunnableLambda(summarizer.route_answers),
+            { "summarize": "summarizer_node", "bypass": "summarizer_bypass_node" }
+        )
+
+    def get_agent_budget(self, state: State):
+        # Splits the time left until the request deadline between the agents that still have to run
+        if state.get("deadline") is None:
+            return None
+        remaining = state["deadline"] - time.monotonic()
+        remaining -= min(self.summarizer_reserve, self.summarizer_reserve_fraction * max(remaining, 0))
+        if self.parallel:
+            pending = 1
+        else:
+            answered = state.get("agents") or {}
+            pending = max(len([agent for agent in state.get("relevant_agents", []) if agent not in answered]), 1)
+        return max(remaining / pending, 0)
+
+    def with_deadline(self, agent):
+        # Async agent node that gets cancelled when it runs out of its time budget
+        async def run_agent(state: State):
+            budget = self.get_agent_budget(state)
+            # Cancelling the agent doesn't stop the work it runs in threads, so the backends get the deadline too
+            token = agent_deadline.set(time.monotonic() + budget if budget is not None else None)
+            try:
+                return await asyncio.wait_for(agent.agenerate_answer(state), timeout=budget)
+            except asyncio.TimeoutError:
+                logger.info("%s says: timed out after %.1fs", agent.name, budget)
+                agent_fallbacks.inc(agent=agent.name, reason="timeout")
+                return { "agents": { agent.name: TIMEOUT_ANSWER }, "timed_out": [agent.name] }
+            finally:
+                agent_deadline.reset(token)
+        return run_agent
+
+    def with_speculation(self, supervisor, agent_list):
+        # Async routing node that prefetches data for every agent during the supervisor LLM call.
+        # Only the agents that have a prefetch stage take part
+        agents = [agent for agent in agent_list if hasattr(agent, "aprefetch")]
+
+        async def route_agents(state: State):
+            tasks = { agent.name: asyncio.create_task(agent.aprefetch(state)) for agent in agents }
+            try:
+                result = await supervisor.aget_relevant_agents(state)
+            except Exception:
+                for task in tasks.values():
+                    task.cancel()
+                raise
+
+            # Keep the work of the picked agents and drop the rest
+            picked = { name: task for name, task in tasks.items() if name in result["relevant_agents"] }
+            for name, task in tasks.items():
+                if name not in picked:
+                    task.cancel()
+
+            # The prefetch counts against the agents time budget, whatever is not ready by then is left to the agents
+            prefetched = {}
+            budget = self.get_agent_budget({ **state, **result })
+            if picked:
+                await asyncio.wait(picked.values(), timeout=budget)
+            for name, task in picked.items():
+                if not task.done():
+                    task.cancel()
+                    logger.info("%s says: prefetch timed out after %.1fs", name, budget)
+                elif task.exception() is not None:
+                    logger.error("%s says: ERROR prefetching %s", name, task.exception())
+                else:
+                    prefetched[name] = task.result()
+            logger.info("Supervisor says: prefetched data for %s", list(prefetched.keys()))
+            return { **result, "prefetched": prefetched }
+        return route_agents
+
+    def invoke(self, state, config=None):
+        return self.graph.invoke(state, config=config)
+
+    async def ainvoke(self, state, config=None):
+        return await self.graph.ainvoke(state, config=config)
+
+    async def astream(self, state, config=None):
+        # Runs the graph asynchronously and yields its progress as (event, data) tuples:
+        # the relevant agents, each agent answer, the summarizer tokens and finally the resulting state
+        streamed = False
+        async for event in self.graph.astream_events(state, config=config, version="v2"):
+            node = event.get("metadata", {}).get("langgraph_node")
+            if event["event"] == "on_chain_end" and not event["parent_ids"]:
+                yield "end", event["data"]["output"]
+            elif event["event"] == "on_chain_end" and event["name"] == node == "supervisor_agent_filter_node":
+                yield "agents", event["data"]["output"]["relevant_agents"]
+            elif event["event"] == "on_chain_end" and event["name"] == node and node in self.agent_nodes:
+                yield "agent", event["data"]["output"]["agents"]
+            elif event["event"] == "on_chat_model_stream" and node == "summarizer_node":
+                streamed = True
+                yield "token", event["data"]["chunk"].content
+            elif event["event"] == "on_chain_end" and event["name"] == node == "summarizer_node" and not streamed:
+                # A summary from the LLM responses cache comes without tokens, so it is sent in one piece
+                yield "token", event["data"]["output"]["answer"]
+            elif event["event"] == "on_chain_end" and event["name"] == node == "summarizer_bypass_node":
+                # The answer didn't need a summary, so it is sent in one piece
+                yield "token", event["data"]["output"]["answer"]
@@ -1,8 +1,11 @@
 from .models import State
-from langchain_openai import AzureChatOpenAI
+from .llm import get_llm
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnableLambda
+import logging
+
+logger = logging.getLogger(__name__)
 
 class Greeter:
     
@@ -10,12 +13,6 @@ class Greeter:
 
         self.agents = [agent.skills for agent in agent_list]
         
-        # Instantiate a pre-trained Large Language Model from Azure OpenAI
-        self.llm = AzureChatOpenAI(
-            deployment_name="gpt-4o",
-            api_version="2023-06-01-preview"
-        )
-
         # The system prompt guides the agent on how to respond
         self.system_prompt = (
             "You are an AI assistant for question-answering tasks. "
@@ -38,11 +35,16 @@ class Greeter:
             { "question": RunnableLambda(lambda inputs: inputs["question"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
             | self.prompt
-            | self.llm
+            | get_llm("greeter", "greeter_chain")
             | self.parser
-        )
+        ).with_config(run_name="greeter_chain")
 
     def generate_answer(self):
-        print("Greeting the user...")
+        logger.info("Greeting the user...")
         answer = self.chain.invoke({ "question": "hi! what can you do?" })
         return { "answer": answer }
+
+    async def agenerate_answer(self):
+        logger.info("Greeting the user...")
+        answer = await self.chain.ainvoke({ "question": "hi! what can you do?" })
+        return { "answer": answer }
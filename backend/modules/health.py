@@ -0,0 +1,85 @@
+from .metrics import agent_healthy, health_probe_duration
+import asyncio
+import datetime
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class HealthMonitor:
+    # Probes the backend of every agent in the background and keeps the latest status,
+    # so the health endpoint doesn't put load on the backends however often it is called
+    def __init__(self, agents, interval=30, timeout=5):
+        self.agents = agents
+        # Seconds between two rounds of probes
+        self.interval = interval
+        # Seconds each probe can take before the agent is reported as unhealthy
+        self.timeout = timeout
+        self.status = {}
+        # Probes still running in a worker thread, a backend that hangs doesn't get a new probe until the last one ends
+        self.probes = {}
+        self.task = None
+
+    async def probe(self, agent):
+        start = time.perf_counter()
+        probe = self.probes.get(agent.name)
+        if probe is None or probe.done():
+            probe = self.probes[agent.name] = asyncio.ensure_future(asyncio.to_thread(agent.check_connection))
+        try:
+            # The probe is shielded, so it keeps running when it times out and the next round can wait for it
+            result = await asyncio.wait_for(asyncio.shield(probe), timeout=self.timeout)
+            healthy, info = result["healthy"], result["info"]
+        except asyncio.TimeoutError:
+            healthy, info = False, f"timed out after {self.timeout}s"
+        except Exception as e:
+            healthy, info = False, e
+        latency = round(time.perf_counter() - start, 3)
+
+        agent_healthy.set(1 if healthy else 0, agent=agent.name)
+        health_probe_duration.observe(latency, agent=agent.name)
+        self.status[agent.name] = {
+            "agent": agent.name,
+            "healthy": healthy,
+            # The info may be an exception, it is sent as text
+            "info": info if isinstance(info, (str, int, float)) or info is None else str(info),
+            "checked_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "latency": latency
+        }
+        return self.status[agent.name]
+
+    async def probe_all(self):
+        # Every agent is probed at the same time, a slow backend doesn't delay the rest
+        await asyncio.gather(*(self.probe(agent) for agent in self.agents))
+        return self.get_status()
+
+    async def probe_pending(self):
+        # The agents not probed yet, e.g. right after startup, are probed before answering.
+        # A probe already running in the background is awaited instead of starting another one
+        await asyncio.gather(*(self.probe(agent) for agent in self.agents if agent.name not in self.status))
+        return self.get_status()
+
+    def get_status(self):
+        # Agents not probed yet are reported without a status
+        return [self.status.get(agent.name, { "agent": agent.name, "healthy": None, "info": "not checked yet", "checked_at": None, "latency": None }) for agent in self.agents]
+
+    async def run(self):
+        while True:
+            try:
+                await self.probe_all()
+            except Exception as e:
+                logger.error("Health monitor says: ERROR %s", e)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
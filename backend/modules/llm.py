@@ -0,0 +1,159 @@
+from .metrics import llm_in_flight, llm_prompt_tokens
+from .admission import admission
+from .prompt_budget import prompt_budget
+from langchain_openai import AzureChatOpenAI
+from langchain_core.callbacks import BaseCallbackHandler
+import threading
+import httpx
+
+class InFlightTracker(BaseCallbackHandler):
+    # Counts the LLM calls waiting for an answer on a deployment
+    run_inline = True
+
+    def __init__(self, deployment_name):
+        self.deployment_name = deployment_name
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def change(self, amount):
+        with self.lock:
+            self.count += amount
+        llm_in_flight.inc(amount, deployment=self.deployment_name)
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self.change(1)
+
+    def on_llm_end(self, response, **kwargs):
+        self.change(-1)
+
+    def on_llm_error(self, error, **kwargs):
+        self.change(-1)
+
+
+class AdmittedAzureChatOpenAI(AzureChatOpenAI):
+    # Chat model that waits for the admission controller before calling its deployment
+    def estimate_tokens(self, messages):
+        # Tokens of the prompt, plus the expected answer
+        prompt_tokens = sum(prompt_budget.count(str(message.content)) for message in messages)
+        llm_prompt_tokens.observe(prompt_tokens, deployment=self.deployment_name)
+        return prompt_tokens + (self.max_tokens or admission.completion_tokens)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        ticket = admission.acquire(self.deployment_name, self.estimate_tokens(messages))
+        tokens = None
+        try:
+            result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            tokens = get_total_tokens(result)
+            return result
+        finally:
+            admission.release(ticket, tokens)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        ticket = await admission.aacquire(self.deployment_name, self.estimate_tokens(messages))
+        tokens = None
+        try:
+            result = await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            tokens = get_total_tokens(result)
+            return result
+        finally:
+            admission.release(ticket, tokens)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        ticket = admission.acquire(self.deployment_name, self.estimate_tokens(messages))
+        try:
+            yield from super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+        finally:
+            admission.release(ticket)
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        ticket = await admission.aacquire(self.deployment_name, self.estimate_tokens(messages))
+        try:
+            async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                yield chunk
+        finally:
+            admission.release(ticket)
+
+
+def get_total_tokens(result):
+    return ((result.llm_output or {}).get("token_usage") or {}).get("total_tokens")
+
+
+# Model of the chains without their own entry in the models configuration
+DEFAULT_MODEL = { "deployment_name": "gpt-4o" }
+
+
+class LLMRegistry:
+    # Hands out the LLM clients of every component.
+    # There is one connection pool per deployment, with keep-alive connections, shared by all the clients of that deployment
+    def __init__(self, api_version="2023-06-01-preview", max_connections=50, max_keepalive_connections=20, keepalive_expiry=120, timeout=120, models=None, cache=None):
+        self.configure(api_version, max_connections, max_keepalive_connections, keepalive_expiry, timeout, models, cache)
+        self.clients = {}
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def configure(self, api_version="2023-06-01-preview", max_connections=50, max_keepalive_connections=20, keepalive_expiry=120, timeout=120, models=None, cache=None):
+        # Only applies to the clients created afterwards
+        self.api_version = api_version
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections, keepalive_expiry=keepalive_expiry)
+        self.timeout = timeout
+        # Deployment and generation parameters of each chain
+        self.models = models or {}
+        # Cache of the LLM responses, None to always call the LLM
+        self.cache = cache
+
+    def get_model(self, component=None, chain=None):
+        # A chain of one component can have its own model, otherwise it uses the model of its role in every component
+        chains = self.models.get("chains", {})
+        return chains.get(f"{component}.{chain}") or chains.get(chain) or self.models.get("default") or DEFAULT_MODEL
+
+    def get(self, deployment_name="gpt-4o", cache=True, cache_ttl=None, **params):
+        # Components asking for the same deployment, generation parameters and caching get the same client.
+        # A chain can opt out of the responses cache, or keep its responses for a different time
+        key = (deployment_name, cache, cache_ttl, tuple(sorted(params.items())))
+        with self.lock:
+            if key not in self.clients:
+                pool = self.get_pool(deployment_name)
+                self.clients[key] = AdmittedAzureChatOpenAI(
+                    deployment_name=deployment_name,
+                    api_version=self.api_version,
+                    http_client=pool["client"],
+                    http_async_client=pool["async_client"],
+                    callbacks=[pool["tracker"]],
+                    cache=self.get_cache(cache, cache_ttl),
+                    **params
+                )
+            return self.clients[key]
+
+    def get_cache(self, cache, cache_ttl):
+        if not cache or self.cache is None:
+            return False
+        return self.cache.with_ttl(cache_ttl) if cache_ttl is not None else self.cache
+
+    def get_pool(self, deployment_name):
+        if deployment_name not in self.pools:
+            self.pools[deployment_name] = {
+                "client": httpx.Client(limits=self.limits, timeout=self.timeout),
+                "async_client": httpx.AsyncClient(limits=self.limits, timeout=self.timeout),
+                "tracker": InFlightTracker(deployment_name)
+            }
+        return self.pools[deployment_name]
+
+    def in_flight(self):
+        # LLM calls waiting for an answer, per deployment
+        return { deployment_name: pool["tracker"].count for deployment_name, pool in self.pools.items() }
+
+    async def aclose(self):
+        for pool in self.pools.values():
+            pool["client"].close()
+            await pool["async_client"].aclose()
+        self.pools = {}
+        self.clients = {}
+
+
+# Clients of this process
+llm_registry = LLMRegistry()
+
+
+def get_llm(component=None, chain=None):
+    # LLM client configured for the chain of the component
+    return llm_registry.get(**llm_registry.get_model(component, chain))
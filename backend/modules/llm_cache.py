@@ -0,0 +1,115 @@
+from .lru_cache import LRUCache
+from .metrics import llm_cache_requests
+from langchain_core.caches import BaseCache
+from langchain_core.load import dumps, loads
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import time
+
+class ResponseStore:
+    # LLM responses kept in memory, for the most recent ones, and in a SQLite file that survives restarts
+    def __init__(self, path=None, max_entries=1000, max_disk_entries=100000):
+        self.memory = LRUCache(max_entries)
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self.lock = threading.Lock()
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, expires REAL)")
+            self.db.commit()
+            self.prune()
+
+    def get_memory(self, key):
+        entry = self.memory.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires < time.time():
+            return None
+        llm_cache_requests.inc(result="memory_hit")
+        return value
+
+    def get_disk(self, key):
+        if self.db is not None:
+            with self.lock:
+                row = self.db.execute("SELECT value, expires FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and (row[1] is None or row[1] >= time.time()):
+                value = loads(row[0])
+                self.memory.set(key, (value, row[1]))
+                llm_cache_requests.inc(result="disk_hit")
+                return value
+        llm_cache_requests.inc(result="miss")
+        return None
+
+    def get(self, key):
+        value = self.get_memory(key)
+        return value if value is not None else self.get_disk(key)
+
+    def set_memory(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl is not None else None
+        self.memory.set(key, (value, expires))
+        return expires
+
+    def set_disk(self, key, value, expires):
+        if self.db is None:
+            return
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO responses (key, value, created, expires) VALUES (?, ?, ?, ?)", (key, dumps(value), time.time(), expires))
+            self.db.commit()
+
+    def set(self, key, value, ttl=None):
+        self.set_disk(key, value, self.set_memory(key, value, ttl))
+
+    def prune(self):
+        # Drops the expired responses, and the oldest ones over the limit of the file
+        with self.lock:
+            self.db.execute("DELETE FROM responses WHERE expires IS NOT NULL AND expires < ?", (time.time(),))
+            self.db.execute("DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY created DESC LIMIT ?)", (self.max_disk_entries,))
+            self.db.commit()
+
+    def clear(self):
+        self.memory.clear()
+        if self.db is not None:
+            with self.lock:
+                self.db.execute("DELETE FROM responses")
+                self.db.commit()
+
+
+class LLMCache(BaseCache):
+    # Exact match cache of the chat models: the same deployment, generation parameters and rendered messages
+    # get the same response without calling the LLM. Every chain can keep its responses for a different time,
+    # all of them share the same store
+    def __init__(self, store, ttl=None):
+        self.store = store
+        # Seconds a response is kept, forever if None
+        self.ttl = ttl
+
+    def with_ttl(self, ttl):
+        return LLMCache(self.store, ttl)
+
+    def get_key(self, prompt, llm_string):
+        return hashlib.sha256(f"{llm_string}\n{prompt}".encode("utf-8")).hexdigest()
+
+    def lookup(self, prompt, llm_string):
+        return self.store.get(self.get_key(prompt, llm_string))
+
+    def update(self, prompt, llm_string, return_val):
+        self.store.set(self.get_key(prompt, llm_string), return_val, self.ttl)
+
+    def clear(self, **kwargs):
+        self.store.clear()
+
+    async def alookup(self, prompt, llm_string):
+        # Only the SQLite file is read in a thread, memory hits don't leave the event loop
+        key = self.get_key(prompt, llm_string)
+        value = self.store.get_memory(key)
+        return value if value is not None else await asyncio.to_thread(self.store.get_disk, key)
+
+    async def aupdate(self, prompt, llm_string, return_val):
+        key = self.get_key(prompt, llm_string)
+        expires = self.store.set_memory(key, return_val, self.ttl)
+        await asyncio.to_thread(self.store.set_disk, key, return_val, expires)
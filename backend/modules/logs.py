@@ -0,0 +1,72 @@
+from logging.handlers import QueueHandler, QueueListener
+import datetime
+import logging
+import json
+import queue
+import random
+import sys
+
+class PayloadFilter(logging.Filter):
+    # Cuts long messages, such as database schemas, documents or dataframes, to a maximum length
+    def __init__(self, max_length=1000):
+        super().__init__()
+        self.max_length = max_length
+
+    def filter(self, record):
+        message = record.getMessage()
+        if self.max_length is not None and len(message) > self.max_length:
+            message = f"{message[:self.max_length]}... [{len(message) - self.max_length} more characters]"
+        record.msg, record.args = message, None
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    # Keeps only a fraction of the records of each level, e.g. { "DEBUG": 0.1 } keeps one in ten debug records
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = { logging.getLevelName(level): rate for level, rate in (rates or {}).items() }
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno, 1)
+        return rate >= 1 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line, so the logs can be parsed by the log ingestion
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(level="INFO", levels=None, format="text", max_payload=1000, sample_rates=None):
+    # Records are filtered, sampled and cut in the thread that logs them, and written to stdout by a background thread,
+    # so a request never waits on stdout
+    records = queue.SimpleQueue()
+    queue_handler = QueueHandler(records)
+    queue_handler.addFilter(SamplingFilter(sample_rates))
+    queue_handler.addFilter(PayloadFilter(max_payload))
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if format == "json" else logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, QueueHandler):
+            root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    # Levels per module, e.g. { "modules.agent_sql": "DEBUG" }
+    for name, module_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    listener = QueueListener(records, stream_handler)
+    listener.start()
+    return listener
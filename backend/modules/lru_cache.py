@@ -0,0 +1,38 @@
+from collections import OrderedDict
+import threading
+import time
+
+class LRUCache:
+    # Thread safe dictionary that drops its least recently used entries when it is full, and its entries once they expire
+    def __init__(self, max_entries=1000, ttl=None):
+        self.max_entries = max_entries
+        # Seconds an entry is kept, forever if None
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl if self.ttl is not None else None)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,167 @@
+import os
+import threading
+
+# Buckets in seconds, wide enough for multi-second LLM calls
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+
+class Metric:
+    def __init__(self, name, description, metric_type, label_names):
+        self.name = name
+        self.description = description
+        self.metric_type = metric_type
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get_key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.label_names)
+
+    def format_labels(self, key, extra=None):
+        pairs = list(zip(self.label_names, key)) + (extra or [])
+        if len(pairs) == 0:
+            return ""
+        escaped = [(name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in pairs]
+        return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+    def render(self, extra=None):
+        # The extra labels are added to every series, e.g. the worker that exposes them
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.metric_type}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self.render_value(key, value, extra or []))
+        return lines
+
+    def render_value(self, key, value, extra):
+        return [f"{self.name}{self.format_labels(key, extra)} {value}"]
+
+
+class Counter(Metric):
+    def __init__(self, name, description, label_names=()):
+        super().__init__(name, description, "counter", label_names)
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    def __init__(self, name, description, label_names=()):
+        super().__init__(name, description, "gauge", label_names)
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, "histogram", label_names)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = { "buckets": [0] * len(self.buckets), "sum": 0, "count": 0 }
+            entry = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["buckets"][i] += 1
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def render_value(self, key, value, extra):
+        lines = [f"{self.name}_bucket{self.format_labels(key, extra + [('le', str(bound))])} {count}" for bound, count in zip(self.buckets, value["buckets"])]
+        lines.append(f"{self.name}_bucket{self.format_labels(key, extra + [('le', '+Inf')])} {value['count']}")
+        lines.append(f"{self.name}_sum{self.format_labels(key, extra)} {value['sum']}")
+        lines.append(f"{self.name}_count{self.format_labels(key, extra)} {value['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self, worker_label=None):
+        self.metrics = []
+        # Every worker of the server has its own values, labelled with its pid so the series can be summed when scraped
+        self.worker_label = worker_label
+
+    def counter(self, name, description, label_names=()):
+        return self.register(Counter(name, description, label_names))
+
+    def gauge(self, name, description, label_names=()):
+        return self.register(Gauge(name, description, label_names))
+
+    def histogram(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, description, label_names, buckets))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        # Prometheus text exposition format. The pid is read when rendering, the workers may be forked after the import
+        extra = [(self.worker_label, str(os.getpid()))] if self.worker_label else []
+        return "\n".join(line for metric in self.metrics for line in metric.render(extra)) + "\n"
+
+
+# Metrics of this process, exposed by /api/metrics
+registry = MetricsRegistry(worker_label="worker")
+
+request_duration = registry.histogram("chatbot_request_duration_seconds", "End-to-end latency of the answer endpoints.", ["endpoint"])
+node_duration = registry.histogram("chatbot_node_duration_seconds", "Latency of each graph node.", ["node"])
+chain_duration = registry.histogram("chatbot_chain_duration_seconds", "Latency of each LLM chain.", ["node", "chain"])
+llm_duration = registry.histogram("chatbot_llm_duration_seconds", "Latency of each LLM call.", ["node", "model"])
+io_duration = registry.histogram("chatbot_io_duration_seconds", "Latency of the calls to external backends.", ["operation"])
+llm_tokens = registry.counter("chatbot_llm_tokens_total", "LLM tokens used.", ["node", "type"])
+agent_fallbacks = registry.counter("chatbot_agent_fallbacks_total", "Agent answers replaced by the \"I don't know\" fallback.", ["agent", "reason"])
+agent_exceptions = registry.counter("chatbot_agent_exceptions_total", "Exceptions raised while an agent was answering.", ["agent"])
+coalesced_requests = registry.counter("chatbot_coalesced_requests_total", "Requests answered by an identical request already in flight.")
+answer_cache_requests = registry.counter("chatbot_answer_cache_requests_total", "Lookups in the semantic answer cache.", ["result"])
+routing_decisions = registry.counter("chatbot_routing_decisions_total", "Questions routed to the agents, by routing method.", ["method"])
+routing_cache_requests = registry.counter("chatbot_routing_cache_requests_total", "Lookups in the routing decisions cache.", ["result"])
+requests_in_flight = registry.gauge("chatbot_requests_in_flight", "Requests being answered right now.", ["endpoint"])
+llm_in_flight = registry.gauge("chatbot_llm_in_flight", "LLM calls waiting for an answer, by deployment.", ["deployment"])
+llm_queue_depth = registry.gauge("chatbot_llm_queue_depth", "LLM calls waiting for admission, by deployment.", ["deployment"])
+llm_queue_wait = registry.histogram("chatbot_llm_queue_wait_seconds", "Time LLM calls waited for admission.", ["deployment", "priority"])
+llm_cache_requests = registry.counter("chatbot_llm_cache_requests_total", "Lookups in the LLM responses cache.", ["result"])
+embedding_cache_requests = registry.counter("chatbot_embedding_cache_requests_total", "Lookups in the embeddings cache.", ["result"])
+llm_prompt_tokens = registry.histogram("chatbot_llm_prompt_tokens", "Tokens of the prompts sent to the LLM.", ["deployment"], TOKEN_BUCKETS)
+prompt_section_tokens = registry.histogram("chatbot_prompt_section_tokens", "Tokens of each variable section of the prompts, after fitting them to their budget.", ["chain", "section"], TOKEN_BUCKETS)
+prompt_truncations = registry.counter("chatbot_prompt_truncations_total", "Prompt sections cut down to fit their budget.", ["chain", "section"])
+circuit_breaker_state = registry.gauge("chatbot_circuit_breaker_state", "State of the circuit breaker of each backend: 0 closed, 1 half open, 2 open.", ["breaker"])
+circuit_breaker_calls = registry.counter("chatbot_circuit_breaker_calls_total", "Calls to the agents backends, by result.", ["breaker", "result"])
+agent_healthy = registry.gauge("chatbot_agent_healthy", "Result of the latest health probe of each agent backend: 1 healthy, 0 unhealthy.", ["agent"])
+health_probe_duration = registry.histogram("chatbot_health_probe_duration_seconds", "Latency of the health probes of the agents backends.", ["agent"])
+
+
+def observe_span(span):
+    # Turns a finished trace span into metrics
+    duration = span["end"] - span["start"]
+    node = span.get("node") or ""
+    if span["kind"] == "request":
+        request_duration.observe(duration, endpoint=span["name"])
+    elif span["kind"] == "node":
+        node_duration.observe(duration, node=span["name"])
+    elif span["kind"] == "chain":
+        chain_duration.observe(duration, node=node, chain=span["name"])
+    elif span["kind"] == "llm":
+        llm_duration.observe(duration, node=node, model=span["name"])
+        for token_type, count in (span.get("tokens") or {}).items():
+            llm_tokens.inc(count, node=node, type=token_type.replace("_tokens", ""))
+    elif span["kind"] == "io":
+        io_duration.observe(duration, operation=span["name"])
+
+
+def record_agent_error(agent):
+    agent_exceptions.inc(agent=agent)
+    agent_fallbacks.inc(agent=agent, reason="error")
@@ -1,21 +1,37 @@
-from pydantic import BaseModel
-from typing import TypedDict
+from pydantic import BaseModel, Field
+from typing import TypedDict, Annotated, Optional, Any
+import operator
+from .utils import merge_agents_output
 
 class QuestionModel(BaseModel):
     question: str
     session_id: str
+    # Seconds to answer, the agents that don't make it in time are left out
+    timeout: Optional[float] = Field(default=None, gt=0)
+    use_cache: bool = True
 
 class AnswerModel(QuestionModel):
     answer: str
     agents: dict
 
+class BatchModel(BaseModel):
+    questions: list[QuestionModel]
+    concurrency: Optional[int] = None
+    use_history: bool = False
+
 class FeedbackModel(AnswerModel):
     like: bool
     agents: None = None
 
 class State(TypedDict):
     question: str
-    agents: dict
+    agents: Annotated[dict, merge_agents_output]
     relevant_agents: list
     answer: str
-    history: list
\ No newline at end of file
+    history: list
+    deadline: float
+    timed_out: Annotated[list, operator.add]
+    unavailable: Annotated[list, operator.add]
+    prefetched: dict
+    embedding: Any
+    entry_answers: dict
@@ -0,0 +1,108 @@
+from .metrics import prompt_section_tokens, prompt_truncations
+from langchain_core.runnables import RunnableLambda
+import threading
+import tiktoken
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Sections of the prompts that grow with the conversation and the data, the rest of each prompt is fixed
+SECTIONS = ["history", "context", "schema", "result", "index", "endpoints", "agents_output"]
+
+# Appended to a truncated section, so the LLM knows the data is incomplete
+TRUNCATED = "\n[...truncated]"
+
+
+class PromptBudget:
+    # Keeps the variable sections of the prompts within a number of tokens configured per chain
+    def __init__(self, default=None, chains=None, encoding="o200k_base"):
+        self.configure(default, chains, encoding)
+        self.lock = threading.Lock()
+
+    def configure(self, default=None, chains=None, encoding="o200k_base"):
+        # Tokens of each section, e.g. { "history": 2000, "result": 3000 }, None for no limit
+        self.default = default or {}
+        # Budgets of the chain roles, as "<chain>" or "<component>.<chain>", over the default ones
+        self.chains = chains or {}
+        self.encoding_name = encoding
+        self.encoding = None
+
+    def get_encoding(self):
+        # Loaded on first use, as tiktoken may need to download it. Without it the tokens are estimated from the characters
+        if self.encoding is None:
+            with self.lock:
+                if self.encoding is None:
+                    try:
+                        self.encoding = tiktoken.get_encoding(self.encoding_name)
+                    except Exception as e:
+                        logger.error("Prompt budget says: ERROR %s", e)
+                        self.encoding = False
+        return self.encoding or None
+
+    def count(self, text):
+        encoding = self.get_encoding()
+        return len(encoding.encode(text, disallowed_special=())) if encoding else (len(text) + 3) // 4
+
+    def truncate(self, text, max_tokens):
+        # Keeps the beginning of the text, returns it with its tokens
+        encoding = self.get_encoding()
+        if encoding:
+            tokens = encoding.encode(text, disallowed_special=())
+            if len(tokens) <= max_tokens:
+                return text, len(tokens)
+            return encoding.decode(tokens[:max_tokens]) + TRUNCATED, max_tokens
+        if len(text) <= max_tokens * 4:
+            return text, (len(text) + 3) // 4
+        return text[:max_tokens * 4] + TRUNCATED, max_tokens
+
+    def truncate_history(self, history, max_tokens):
+        # Keeps the most recent entries that fit, the older ones matter less to the question
+        kept = []
+        total = 0
+        for entry in reversed(history):
+            tokens = self.count(str(entry))
+            if total + tokens > max_tokens:
+                break
+            kept.insert(0, entry)
+            total += tokens
+        if len(kept) == len(history):
+            return history, total
+        return kept, total
+
+    def get_budget(self, component, chain):
+        # Budgets of the chain role in every component, overridden by the ones of the chain in this component
+        return { **self.default, **self.chains.get(chain, {}), **self.chains.get(f"{component}.{chain}", {}) }
+
+    def fit_section(self, section, value, max_tokens):
+        # Returns the section within its budget, and its tokens.
+        # A section that fits is returned as it is, so the prompt renders exactly the same
+        if section == "history" and isinstance(value, list):
+            if max_tokens is None:
+                return value, self.count(str(value))
+            return self.truncate_history(value, max_tokens)
+        text = value if isinstance(value, str) else str(value)
+        if max_tokens is None:
+            return value, self.count(text)
+        truncated, tokens = self.truncate(text, max_tokens)
+        return (value if truncated is text else truncated), tokens
+
+    def fit(self, component, chain, inputs):
+        budget = self.get_budget(component, chain)
+        fitted = dict(inputs)
+        for section in SECTIONS:
+            if section not in inputs:
+                continue
+            fitted[section], tokens = self.fit_section(section, inputs[section], budget.get(section))
+            prompt_section_tokens.observe(tokens, chain=chain, section=section)
+            if fitted[section] is not inputs[section]:
+                prompt_truncations.inc(chain=chain, section=section)
+        return fitted
+
+
+# Prompt budgets of this process
+prompt_budget = PromptBudget()
+
+
+def budget_prompt(component, chain):
+    # Chain step that fits the prompt inputs within the budgets of the chain
+    return RunnableLambda(lambda inputs: prompt_budget.fit(component, chain, inputs))
@@ -0,0 +1,78 @@
+from .metrics import routing_decisions
+import numpy as np
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class EmbeddingRouter:
+    # Picks the agent for a question by comparing its embedding with the embeddings of the agents skills
+    # and example questions, without calling the LLM. When the choice is not clear it gives up,
+    # so that the supervisor can ask the LLM instead
+    def __init__(self, embed_query, embed_documents, agent_list, examples=None, strategy="centroid", top_k=5, min_similarity=0.7, min_margin=0.05):
+        # Async functions that return the embedding of a text and of a list of texts
+        self.embed_query = embed_query
+        self.embed_documents = embed_documents
+
+        # Every agent is described by its skills and, optionally, some questions it can answer
+        self.agent_names = [agent.name for agent in agent_list]
+        self.texts = [(index, text) for index, agent in enumerate(agent_list) for text in [agent.skills, *(examples or {}).get(agent.name, [])]]
+
+        # "centroid" compares the question with the average of each agent's texts,
+        # "top_k" with the k most similar texts of any agent
+        self.strategy = strategy
+        self.top_k = top_k
+
+        # Minimum similarity of the best agent, and minimum difference with the second one, to pick it
+        self.min_similarity = min_similarity
+        self.min_margin = min_margin
+
+        # Filled in by aload, as the embeddings model may not be ready at startup
+        self.matrix = None
+        self.labels = None
+        self.centroids = None
+        self.lock = asyncio.Lock()
+
+    async def aload(self):
+        # Embeds the agents texts once, the first time they are needed
+        if self.matrix is not None:
+            return
+        async with self.lock:
+            if self.matrix is not None:
+                return
+            vectors = normalize(np.asarray(await self.embed_documents([text for _, text in self.texts]), dtype=np.float32))
+            self.labels = np.array([index for index, _ in self.texts])
+            self.centroids = normalize(np.stack([vectors[self.labels == index].mean(axis=0) for index in range(len(self.agent_names))]))
+            self.matrix = vectors
+            logger.info("Router says: %s texts embedded for %s agents", len(self.texts), len(self.agent_names))
+
+    async def aembed(self, question):
+        return normalize(np.asarray(await self.embed_query(question), dtype=np.float32))
+
+    def route(self, vector):
+        # Returns the relevant agents, or None if the embeddings are not enough to decide
+        if self.matrix is None:
+            return None
+
+        if self.strategy == "top_k":
+            similarities = self.matrix @ vector
+            top = np.argsort(similarities)[::-1][:self.top_k]
+            scores = np.full(len(self.agent_names), -1.0, dtype=np.float32)
+            np.maximum.at(scores, self.labels[top], similarities[top])
+        else:
+            scores = self.centroids @ vector
+
+        ranking = np.argsort(scores)[::-1]
+        best = scores[ranking[0]]
+        second = scores[ranking[1]] if len(ranking) > 1 else -1.0
+        logger.info("Router says: best agent %s with similarity %.3f, margin %.3f", self.agent_names[ranking[0]], best, best - second)
+        if best < self.min_similarity or best - second < self.min_margin:
+            routing_decisions.inc(method="llm_fallback")
+            return None
+        routing_decisions.inc(method="embedding")
+        return [self.agent_names[ranking[0]]]
+
+
+def normalize(vectors):
+    # Normalized vectors make the cosine similarity a dot product
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
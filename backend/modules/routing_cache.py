@@ -0,0 +1,43 @@
+from .lru_cache import LRUCache
+from .metrics import routing_cache_requests
+from .utils import get_question_key
+import logging
+
+logger = logging.getLogger(__name__)
+
+class RoutingCache:
+    # Remembers which agents were picked for a question, given the same recent history
+    def __init__(self, max_entries=5000, ttl=None):
+        self.cache = LRUCache(max_entries, ttl)
+
+    def get(self, question, history):
+        agents = self.cache.get(get_question_key(question, history))
+        routing_cache_requests.inc(result="hit" if agents is not None else "miss")
+        return agents
+
+    def add(self, question, history, agents):
+        # An empty decision is not worth remembering
+        if len(agents) > 0:
+            self.cache.set(get_question_key(question, history), list(agents))
+
+    def warm(self, sessions, agent_names):
+        # Replays the decisions stored in the chat history of each session, oldest first.
+        # Every question is followed by the bot answer, which has an entry for each agent that took part
+        count = 0
+        for entries in sessions:
+            # A session with a question and no answer, e.g. a failed write, would shift the history of the next questions
+            if len(entries) % 2 != 0 or [entry.get("role") for entry in entries] != ["user", "bot"] * (len(entries) // 2):
+                continue
+            for index in range(0, len(entries), 2):
+                question, answer = entries[index], entries[index + 1]
+                agents = [name for name in agent_names if name in answer]
+                # The history is the same the question was routed with: the previous 2 question-answer pairs
+                history = entries[max(index - 4, 0):index]
+                if len(agents) > 0:
+                    self.add(question["content"], history, agents)
+                    count += 1
+        logger.info("Routing cache says: %s decisions loaded from the chat history", count)
+        return count
+
+    def __len__(self):
+        return len(self.cache)
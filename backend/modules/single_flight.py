@@ -0,0 +1,29 @@
+from .metrics import coalesced_requests
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+class SingleFlight:
+    # Concurrent calls with the same key share one execution instead of running it once each
+    def __init__(self):
+        self.in_flight = {}
+
+    async def run(self, key, func):
+        task = self.in_flight.get(key)
+        if task is not None:
+            coalesced_requests.inc()
+            logger.info("Single flight says: joining execution in flight for '%s'", key)
+        else:
+            task = asyncio.ensure_future(func())
+            self.in_flight[key] = task
+            # The entry is removed when the execution finishes, not when the first caller leaves,
+            # so that the other callers still get the result if the first one is cancelled
+            task.add_done_callback(lambda _: self.remove(key, task))
+
+        # A caller that is cancelled must not cancel the execution shared with the others
+        return await asyncio.shield(task)
+
+    def remove(self, key, task):
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
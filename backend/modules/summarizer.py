@@ -1,24 +1,28 @@
 from .models import State
-from langchain_openai import AzureChatOpenAI
+from .llm import get_llm
+from .prompt_budget import budget_prompt
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnableLambda
+import re
+import logging
+
+logger = logging.getLogger(__name__)
 
 class Summarizer:
     
-    def __init__(self): 
+    def __init__(self, config=None): 
 
-        # Instantiate a pre-trained Large Language Model from Azure OpenAI
-        self.llm = AzureChatOpenAI(
-            deployment_name="gpt-4o",
-            api_version="2023-06-01-preview"
-        )
+        # Answers matching any of these patterns are not considered when deciding to skip the summary
+        self.config = config if config is not None else {}
+        self.non_answer_patterns = [re.compile(pattern, re.IGNORECASE) for pattern in self.config.get("non_answer_patterns", [r"^\W*i don'?t know\b"])]
 
         # The system prompt guides the agent on how to respond
         self.system_prompt = (
             "You are an AI assistant tasked with summarizing a conversation between the following agents: {agents_output}. "
             "Given the following user question, your task is to analyze each of the responses and provide the best possible response to the user. "
             "Ignore agents that answered that they don't know or similar. "
+            "If an agent answered that it is unavailable and no other agent answered the question, tell the user that its data cannot be checked right now. "
             "Do not make up new information that is not explicitly in the workers response. "
         )
 
@@ -37,12 +41,35 @@ class Summarizer:
         self.chain = (
             { "question": RunnableLambda(lambda inputs: inputs["question"]), "agents_output": RunnableLambda(lambda inputs: inputs["agents_output"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
+            | budget_prompt("summarizer", "summarizer_chain")
             | self.prompt
-            | self.llm
+            | get_llm("summarizer", "summarizer_chain")
             | self.parser
-        )
+        ).with_config(run_name="summarizer_chain")
 
     def generate_answer(self, state: State):
-        print("Summarizing...")
+        logger.info("Summarizing...")
         answer = self.chain.invoke({ "question": state["question"], "agents_output": state["agents"] })
         return { "answer": answer }
+
+    async def agenerate_answer(self, state: State):
+        logger.info("Summarizing...")
+        answer = await self.chain.ainvoke({ "question": state["question"], "agents_output": state["agents"] })
+        return { "answer": answer }
+
+    def is_non_answer(self, answer):
+        return not isinstance(answer, str) or answer.strip() == "" or any(pattern.search(answer) for pattern in self.non_answer_patterns)
+
+    def get_substantive_answers(self, state: State):
+        return { agent: answer for agent, answer in (state.get("agents") or {}).items() if not self.is_non_answer(answer) }
+
+    def route_answers(self, state: State):
+        # When a single agent provided a real answer there is nothing to summarize
+        if len(self.get_substantive_answers(state)) == 1:
+            return "bypass"
+        return "summarize"
+
+    def bypass(self, state: State):
+        agent, answer = next(iter(self.get_substantive_answers(state).items()))
+        logger.info("Skipping summary, using the answer from %s", agent)
+        return { "answer": answer }
@@ -1,23 +1,37 @@
 from .models import State
-from langchain_openai import AzureChatOpenAI
+from .metrics import routing_decisions, agent_fallbacks
+from .circuit_breaker import UNAVAILABLE_ANSWER
+from .llm import get_llm
+from .prompt_budget import budget_prompt
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
+from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
+from langchain_core.exceptions import OutputParserException
 from langchain_core.runnables import RunnableLambda
+import logging
+
+logger = logging.getLogger(__name__)
 
 class Supervisor:
     
-    def __init__(self, agent_list): 
+    def __init__(self, agent_list, router=None, cache=None, fused=False): 
 
         # List with all the agents to supervise
         self.agents = [{
             "agent_name": agent.name,
             "agent_skills": agent.skills } for agent in agent_list]
 
-        # Instantiate a pre-trained Large Language Model from Azure OpenAI
-        self.llm = AzureChatOpenAI(
-            deployment_name="gpt-4o",
-            api_version="2023-06-01-preview"
-        )
+        # Agents whose backend is down are answered right away, instead of making the graph wait for them
+        self.availability = { agent.name: agent.is_available for agent in agent_list if hasattr(agent, "is_available") }
+
+        # Optional router that picks the agents without the LLM when the question is clear enough
+        self.router = router
+
+        # Optional cache of the routing decisions, repeated questions skip the routing altogether
+        self.cache = cache
+
+        # In fused mode, the routing LLM call also decides if each agent can answer right away,
+        # so the agents don't need to make that call themselves
+        self.fused = fused
 
         # The system prompt guides the agent on how to respond
         self.system_prompt = (
@@ -47,26 +61,178 @@ class Supervisor:
         self.chain = (
             { "question": RunnableLambda(lambda inputs: inputs["question"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
+            | budget_prompt("supervisor", "supervisor_chain")
             | self.prompt
-            | self.llm
+            | get_llm("supervisor", "supervisor_chain")
             | self.parser
+        ).with_config(run_name="supervisor_chain")
+
+        # The fused prompt asks for the relevant agents, and for each one the answer it can give right away
+        self.fused_system_prompt = (
+            f"You are a supervisor tasked with managing a conversation between the following agents: {str(self.agents).replace('{', '{{').replace('}', '}}')}. "
+            "Given an input question, think which would be the most capable agents to answer the question. "
+            "If you have doubts between two agents, then add them both. "
+            "NEVER provide an empty list. If you think none of the agents are capable, then add all of them. "
+            "Then, for each of those agents, analyze if the question can be answered based solely on the agent skills and the data from previous conversations. "
+            "In the chat history, the answer of each agent is under the agent name. "
+            "If there is a clear answer, provide it. "
+            "If you are not sure, or the user asked to look for more information, then answer with 'CONTINUE', nothing else. "
+            "Never make up information that is not in the provided data. "
+            "Respond only with a JSON object, nothing else, in this format: "
+            '{{"agents": [{{"name": "<agent name>", "answer": "<answer or CONTINUE>"}}]}}'
+            "\n\n"
+            "Chat history: {history}"
         )
 
+        self.fused_prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", self.fused_system_prompt),
+                ("human", "{question}"),
+            ]
+        )
+
+        self.fused_chain = (
+            { "question": RunnableLambda(lambda inputs: inputs["question"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
+            | budget_prompt("supervisor", "supervisor_fused_chain")
+            | self.fused_prompt
+            | get_llm("supervisor", "supervisor_fused_chain")
+            | JsonOutputParser()
+        ).with_config(run_name="supervisor_fused_chain")
+
     def get_relevant_agents(self, state: State):
-        print("Supervisor says: getting relevant agents...")
-        agents = self.chain.invoke({"question": state["question"], "agents": self.agents, "history": state["history"]})
-        if agents == "":
-            agents_list = []
-        else:
-            agents_list = agents.replace(" ", "").split(",")
-        print(f"Supervisor says: {agents_list}")
-        return { "relevant_agents": agents_list }
+        logger.info("Supervisor says: getting relevant agents...")
+        agents_list = self.get_cached_agents(state)
+
+        # Without an event loop, the router can only be used if the question is already embedded
+        if agents_list is None and self.router is not None and state.get("embedding") is not None:
+            agents_list = self.router.route(state["embedding"])
+
+        if agents_list is None:
+            routing_decisions.inc(method="llm")
+            if self.fused:
+                decision = self.route_fused(state)
+                if decision is not None:
+                    return decision
+            agents = self.chain.invoke({"question": state["question"], "agents": self.agents, "history": state["history"]})
+            if agents == "":
+                agents_list = []
+            else:
+                agents_list = agents.replace(" ", "").split(",")
+
+        self.cache_agents(state, agents_list)
+        logger.debug("Supervisor says: %s", agents_list)
+        return self.skip_unavailable({ "relevant_agents": agents_list })
+
+    async def aget_relevant_agents(self, state: State):
+        logger.info("Supervisor says: getting relevant agents...")
+        agents_list = self.get_cached_agents(state)
+
+        if agents_list is None and self.router is not None:
+            agents_list = await self.aroute(state)
+
+        if agents_list is None:
+            routing_decisions.inc(method="llm")
+            if self.fused:
+                decision = await self.aroute_fused(state)
+                if decision is not None:
+                    return decision
+            agents = await self.chain.ainvoke({"question": state["question"], "agents": self.agents, "history": state["history"]})
+            if agents == "":
+                agents_list = []
+            else:
+                agents_list = agents.replace(" ", "").split(",")
+
+        self.cache_agents(state, agents_list)
+        logger.debug("Supervisor says: %s", agents_list)
+        return self.skip_unavailable({ "relevant_agents": agents_list })
+
+    def route_fused(self, state: State):
+        # A reply that is not valid JSON falls back to the standard routing
+        try:
+            return self.parse_fused_decision(state, self.fused_chain.invoke({"question": state["question"], "history": state["history"]}))
+        except OutputParserException as e:
+            logger.error("Supervisor says: ERROR %s", e)
+            return None
+
+    async def aroute_fused(self, state: State):
+        try:
+            return self.parse_fused_decision(state, await self.fused_chain.ainvoke({"question": state["question"], "history": state["history"]}))
+        except OutputParserException as e:
+            logger.error("Supervisor says: ERROR %s", e)
+            return None
+
+    def parse_fused_decision(self, state: State, decision):
+        # Keeps the known agents, with their answer or 'CONTINUE' if they have to look for the answer
+        agent_names = [agent["agent_name"] for agent in self.agents]
+        entry_answers = {}
+        agents = decision.get("agents") if isinstance(decision, dict) else None
+        for agent in agents if isinstance(agents, list) else []:
+            if isinstance(agent, dict) and agent.get("name") in agent_names:
+                entry_answers[agent["name"]] = agent.get("answer") or "CONTINUE"
+        agents_list = list(entry_answers.keys())
+
+        # No known agent in the reply, the standard routing decides instead
+        if len(agents_list) == 0:
+            logger.info("Supervisor says: no agents in the fused decision %s", decision)
+            return None
+
+        self.cache_agents(state, agents_list)
+        logger.debug("Supervisor says: %s", entry_answers)
+        return self.skip_unavailable({ "relevant_agents": agents_list, "entry_answers": entry_answers })
+
+    def skip_unavailable(self, decision):
+        # The unavailable agents get their answer in the routing step, so no agent node runs for them.
+        # They stay in the relevant agents, so the summarizer knows that part of the answer is missing
+        unavailable = [agent for agent in decision["relevant_agents"] if agent in self.availability and not self.availability[agent]()]
+        if len(unavailable) == 0:
+            return decision
+        logger.info("Supervisor says: skipping unavailable agents %s", unavailable)
+        for agent in unavailable:
+            agent_fallbacks.inc(agent=agent, reason="unavailable")
+        return { **decision, "agents": { agent: UNAVAILABLE_ANSWER for agent in unavailable }, "unavailable": unavailable }
+
+    def get_cached_agents(self, state: State):
+        if self.cache is None:
+            return None
+        agents_list = self.cache.get(state["question"], state["history"])
+        if agents_list is not None:
+            routing_decisions.inc(method="cache")
+        return agents_list
+
+    def cache_agents(self, state: State, agents_list):
+        if self.cache is not None:
+            self.cache.add(state["question"], state["history"], agents_list)
+
+    async def aroute(self, state: State):
+        # The question embedding may come with the state, otherwise it is computed here
+        try:
+            await self.router.aload()
+            vector = state.get("embedding")
+            if vector is None:
+                vector = await self.router.aembed(state["question"])
+            return self.router.route(vector)
+        except Exception as e:
+            logger.error("Supervisor says: ERROR %s", e)
+            return None
 
     def generate_answer(self, state: State):
         if "agents" not in state:
             state["agents"] = {}
         for agent in state["relevant_agents"]:
             if agent not in state["agents"]:
-                print(f"Next agent: {agent}")
+                logger.info("Next agent: %s", agent)
                 return { "next": agent }
         return { "next": "FINISH" }
+
+    def get_pending_agents(self, state: State):
+        # Used in fan-out mode: every relevant agent that has not answered yet runs at the same time
+        agent_names = [agent["agent_name"] for agent in self.agents]
+        answered = state.get("agents") or {}
+        pending = [agent for agent in state["relevant_agents"] if agent in agent_names and agent not in answered]
+        logger.info("Next agents: %s", pending)
+        return pending if len(pending) > 0 else ["FINISH"]
+
+    def join_answers(self, state: State):
+        # Used in fan-out mode: single step where all the parallel agents meet before summarizing
+        logger.info("Supervisor says: received answers from %s", list((state.get('agents') or {}).keys()))
+        return {}
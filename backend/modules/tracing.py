@@ -0,0 +1,198 @@
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.runnables.config import ensure_config
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+class ExecutionTrace(BaseCallbackHandler):
+    # Recording a span is cheap, so the callbacks run in the event loop instead of a worker thread
+    run_inline = True
+
+    def __init__(self, request_id, name="request", on_span_end=None, on_end=None):
+        self.request_id = request_id
+        self.start_time = time.perf_counter()
+        self.lock = threading.Lock()
+        self.spans = {}
+
+        # Called with every finished span, e.g. to feed the metrics
+        self.on_span_end = on_span_end
+        # Called with the trace once the request is finished, e.g. to share it with the other workers
+        self.on_end = on_end
+
+        # Maps each LangChain run to the span it belongs to.
+        # Runs that are not worth a span of their own (prompts, parsers, lambdas) point to their parent span
+        self.runs = {}
+        self.owned_runs = set()
+
+        # Root span for the whole request
+        self.root_id = self.start_span(name, kind="request")
+
+    def start_span(self, name, kind="io", parent_id=None, node=None):
+        span_id = str(uuid.uuid4())
+        with self.lock:
+            self.spans[span_id] = {
+                "name": name,
+                "kind": kind,
+                "parent_id": parent_id if parent_id is not None else getattr(self, "root_id", None),
+                "node": node,
+                "start": time.perf_counter(),
+                "end": None
+            }
+        return span_id
+
+    def end_span(self, span_id, error=None, tokens=None):
+        with self.lock:
+            span = self.spans[span_id]
+            span["end"] = time.perf_counter()
+            if error is not None:
+                span["error"] = str(error)
+            if tokens is not None:
+                span["tokens"] = tokens
+        if self.on_span_end is not None:
+            self.on_span_end(span)
+
+    def end(self, error=None):
+        self.end_span(self.root_id, error=error)
+        if self.on_end is not None:
+            self.on_end(self)
+
+    @contextmanager
+    def span(self, name, kind="io", parent_run_id=None, node=None):
+        span_id = self.start_span(name, kind, self.runs.get(parent_run_id), node)
+        try:
+            yield span_id
+        except Exception as e:
+            self.end_span(span_id, error=e)
+            raise
+        self.end_span(span_id)
+
+    def start_run(self, name, kind, run_id, parent_run_id, metadata=None):
+        parent_id = self.runs.get(parent_run_id)
+        if kind is None:
+            self.runs[run_id] = parent_id
+            return
+        self.runs[run_id] = self.start_span(name, kind, parent_id, (metadata or {}).get("langgraph_node"))
+        self.owned_runs.add(run_id)
+
+    def end_run(self, run_id, error=None, tokens=None):
+        if run_id in self.owned_runs:
+            self.end_span(self.runs[run_id], error=error, tokens=tokens)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        name = kwargs.get("name") or (serialized or {}).get("name", "chain")
+        if parent_run_id is None:
+            kind = "graph"
+        elif (metadata or {}).get("langgraph_node") == name and not name.startswith("__"):
+            kind = "node"
+        elif name.endswith("_chain"):
+            kind = "chain"
+        else:
+            kind = None
+        self.start_run(name, kind, run_id, parent_run_id, metadata)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self.end_run(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self.end_run(run_id, error=error)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        self.start_run(kwargs.get("name") or (serialized or {}).get("name", "llm"), "llm", run_id, parent_run_id, metadata)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        self.start_run(kwargs.get("name") or (serialized or {}).get("name", "llm"), "llm", run_id, parent_run_id, metadata)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self.end_run(run_id, tokens=get_token_usage(response))
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self.end_run(run_id, error=error)
+
+    def to_dict(self):
+        # Builds the span tree, with times in milliseconds since the start of the request
+        with self.lock:
+            nodes = {}
+            for span_id, span in self.spans.items():
+                nodes[span_id] = {
+                    "name": span["name"],
+                    "kind": span["kind"],
+                    "start_ms": round((span["start"] - self.start_time) * 1000, 2),
+                    "duration_ms": round((span["end"] - span["start"]) * 1000, 2) if span["end"] is not None else None,
+                    **{ key: span[key] for key in ("error", "tokens") if key in span },
+                    "children": []
+                }
+            for span_id, span in self.spans.items():
+                if span["parent_id"] is not None:
+                    nodes[span["parent_id"]]["children"].append(nodes[span_id])
+        return { "request_id": self.request_id, "trace": nodes[self.root_id] }
+
+
+class TraceStore:
+    # Keeps the latest traces in memory, the oldest ones are dropped when it is full.
+    # The finished traces are also written to a SQLite file shared by the workers of the server,
+    # so a trace is found whichever worker answered the request
+    def __init__(self, max_traces=500, path=None):
+        self.max_traces = max_traces
+        self.traces = OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS traces (request_id TEXT PRIMARY KEY, trace TEXT NOT NULL, created REAL NOT NULL)")
+            self.db.commit()
+
+    def add(self, trace: ExecutionTrace):
+        with self.lock:
+            self.traces[trace.request_id] = trace
+            while len(self.traces) > self.max_traces:
+                self.traces.popitem(last=False)
+
+    def save(self, trace: ExecutionTrace):
+        if self.db is None:
+            return
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO traces (request_id, trace, created) VALUES (?, ?, ?)", (trace.request_id, json.dumps(trace.to_dict()), time.time()))
+            self.db.execute("DELETE FROM traces WHERE request_id NOT IN (SELECT request_id FROM traces ORDER BY created DESC LIMIT ?)", (self.max_traces,))
+            self.db.commit()
+
+    def get(self, request_id):
+        # The requests still running are only in the memory of the worker answering them
+        with self.lock:
+            trace = self.traces.get(request_id)
+            if trace is None and self.db is not None:
+                row = self.db.execute("SELECT trace FROM traces WHERE request_id = ?", (request_id,)).fetchone()
+                return json.loads(row[0]) if row is not None else None
+        return trace.to_dict() if trace is not None else None
+
+
+def get_token_usage(response):
+    # Azure OpenAI reports the usage in the LLM output, streamed responses in the message metadata
+    usage = (response.llm_output or {}).get("token_usage")
+    if usage:
+        return { key: usage[key] for key in ("prompt_tokens", "completion_tokens", "total_tokens") if key in usage }
+    for generations in response.generations:
+        for generation in generations:
+            metadata = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if metadata:
+                return { "prompt_tokens": metadata["input_tokens"], "completion_tokens": metadata["output_tokens"], "total_tokens": metadata["total_tokens"] }
+    return None
+
+
+@contextmanager
+def trace_span(name, kind="io"):
+    # Records a span in the trace of the current request, if there is one.
+    # The trace and the parent span are found through the LangChain run executing this code
+    callbacks = ensure_config().get("callbacks")
+    handlers = getattr(callbacks, "handlers", callbacks) or []
+    trace = next((handler for handler in handlers if isinstance(handler, ExecutionTrace)), None)
+    if trace is None:
+        yield None
+        return
+    node = ensure_config().get("metadata", {}).get("langgraph_node")
+    with trace.span(name, kind, parent_run_id=getattr(callbacks, "parent_run_id", None), node=node) as span_id:
+        yield span_id
@@ -1,3 +1,7 @@
+from langchain_core.prompts import ChatPromptTemplate
+import hashlib
+import json
+
 def filter_agent_history(history, agent_name):
     filtered_history = []
 
@@ -13,4 +17,31 @@ def filter_agent_history(history, agent_name):
             # Keep user entries as is.
             filtered_history.append(entry)
 
-    return filtered_history
\ No newline at end of file
+    return filtered_history
+
+def merge_agents_output(current, update):
+    # Reducer for the agents output in the graph state.
+    # Each agent writes only its own entry, so parallel updates can be merged safely.
+    return {**(current or {}), **(update or {})}
+
+def normalize_question(question):
+    # Questions that only differ in case or spacing are considered the same
+    return " ".join(question.lower().split())
+
+def get_history_fingerprint(history):
+    # Hash of the conversation as the supervisor and the agents read it
+    normalized = [{ key: " ".join(str(value).lower().split()) for key, value in entry.items() } for entry in history or []]
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+def get_question_key(question, history):
+    return f"{normalize_question(question)}|{get_history_fingerprint(history)}"
+
+def build_prompt(system_prompt, human_prompt="{question}"):
+    # The prompt puts together the system prompt with the user question.
+    # It is built once per chain, the templates are parsed here and not on every call
+    return ChatPromptTemplate.from_messages(
+        [
+            ("system", system_prompt),
+            ("human", human_prompt),
+        ]
+    )
@@ -0,0 +1,112 @@
+import pytest
+import asyncio
+import threading
+from unittest.mock import patch
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_openai import AzureChatOpenAI
+from modules.admission import AdmissionController, llm_priority
+from modules.llm import AdmittedAzureChatOpenAI
+from modules import metrics
+
+def test_acquire_release():
+    controller = AdmissionController(deployments={ "gpt-4o": { "max_concurrency": 2 } })
+    first = controller.acquire("gpt-4o", 10)
+    second = controller.acquire("gpt-4o", 10)
+    assert controller.status()["gpt-4o"] == { "active": 2, "waiting": 0, "tokens_last_minute": 20 }
+
+    # The third call waits until a slot is free
+    admitted = threading.Event()
+    thread = threading.Thread(target=lambda: admitted.set() if controller.acquire("gpt-4o", 10) else None)
+    thread.start()
+    assert not admitted.wait(0.1)
+    assert controller.status()["gpt-4o"]["waiting"] == 1
+
+    controller.release(first)
+    thread.join(1)
+    assert admitted.is_set()
+    assert controller.status()["gpt-4o"]["active"] == 2
+    controller.release(second)
+
+def test_workers():
+    # Every worker gets its share of the deployment limits
+    controller = AdmissionController(deployments={ "gpt-4o": { "max_concurrency": 24, "tokens_per_minute": 150000 } }, default={ "max_concurrency": 2, "tokens_per_minute": None }, workers=4)
+    queue = controller.get_queue("gpt-4o")
+    assert (queue.max_concurrency, queue.tokens_per_minute) == (6, 37500)
+    queue = controller.get_queue("gpt-4o-mini")
+    assert (queue.max_concurrency, queue.tokens_per_minute) == (1, None)
+
+def test_disabled():
+    controller = AdmissionController(enabled=False)
+    assert controller.acquire("gpt-4o", 10) is None
+    controller.release(None)
+
+def test_priority():
+    controller = AdmissionController(deployments={ "gpt-4o": { "max_concurrency": 1 } })
+    order = []
+
+    async def call(priority, name):
+        llm_priority.set(priority)
+        admission = await controller.aacquire("gpt-4o", 10)
+        order.append(name)
+        await asyncio.sleep(0.01)
+        controller.release(admission)
+
+    async def run():
+        blocker = await controller.aacquire("gpt-4o", 10)
+        tasks = [asyncio.create_task(call("batch", "batch")), asyncio.create_task(call("greeting", "greeting"))]
+        await asyncio.sleep(0.01)
+        tasks.append(asyncio.create_task(call("interactive", "ask")))
+        await asyncio.sleep(0.01)
+        controller.release(blocker)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order == ["ask", "greeting", "batch"]
+
+def test_tokens_per_minute():
+    controller = AdmissionController(deployments={ "gpt-4o": { "tokens_per_minute": 100 } })
+
+    async def run():
+        first = await controller.aacquire("gpt-4o", 80)
+        controller.release(first)
+        # The tokens of the first call are still in the window
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(controller.aacquire("gpt-4o", 80), 0.1)
+        assert controller.status()["gpt-4o"]["waiting"] == 0
+
+        # Once they leave the window the call goes through
+        controller.queues["gpt-4o"].window = 0.2
+        assert await asyncio.wait_for(controller.aacquire("gpt-4o", 80), 1) is not None
+
+    asyncio.run(run())
+
+def test_real_usage():
+    controller = AdmissionController(deployments={ "gpt-4o": { "tokens_per_minute": 100 } })
+    admission = controller.acquire("gpt-4o", 500)
+    controller.release(admission, 30)
+    assert controller.status()["gpt-4o"]["tokens_last_minute"] == 30
+    controller.release(controller.acquire("gpt-4o", 60))
+    assert controller.status()["gpt-4o"]["tokens_last_minute"] == 90
+
+def test_queue_metrics():
+    controller = AdmissionController(deployments={ "metrics-test": { "max_concurrency": 1 } })
+    admission = controller.acquire("metrics-test", 10)
+    controller.release(admission)
+    assert metrics.llm_queue_depth.values[("metrics-test",)] == 0
+    assert metrics.llm_queue_wait.values[("metrics-test", "interactive")]["count"] == 1
+
+def test_admitted_llm(monkeypatch):
+    monkeypatch.setenv("AZURE_OPENAI_ENDPOINT", "https://example.openai.azure.com")
+    monkeypatch.setenv("AZURE_OPENAI_API_KEY", "key")
+    llm = AdmittedAzureChatOpenAI(deployment_name="gpt-4o", api_version="2023-06-01-preview")
+    result = ChatResult(generations=[ChatGeneration(message=AIMessage(content="answer"))], llm_output={ "token_usage": { "total_tokens": 42 } })
+    controller = AdmissionController()
+
+    with patch('modules.llm.admission', controller), \
+         patch.object(AzureChatOpenAI, '_agenerate', return_value=result) as mock_generate:
+        answer = asyncio.run(llm.ainvoke([HumanMessage(content="question")]))
+
+    assert answer.content == "answer"
+    mock_generate.assert_called_once()
+    assert controller.status()["gpt-4o"] == { "active": 0, "waiting": 0, "tokens_last_minute": 42 }
@@ -1,9 +1,12 @@
 import pytest
-from unittest.mock import MagicMock, patch
+import asyncio
+from unittest.mock import MagicMock, AsyncMock, patch
 from modules.models import State
-from modules.agent_api import AgentApi
+from modules.agent_api import AgentApi, CodeError
+from modules.circuit_breaker import CircuitOpenError
 import yaml
 import json
+import requests
 
 @pytest.fixture
 def config():
@@ -62,12 +65,16 @@ paths:
     }
 
 @pytest.fixture
-def agent_api(config, test_variables):
-    with patch('modules.agent_api.AzureChatOpenAI') as MockLLM, \
+def mock_llm():
+    return MagicMock()
+
+@pytest.fixture
+def agent_api(config, test_variables, mock_llm):
+    with patch('modules.agent_api.get_llm') as MockLLM, \
          patch('modules.agent_api.requests') as MockRequests:
         
         # Mock LLM and API specification
-        MockLLM.return_value = MagicMock()
+        MockLLM.return_value = mock_llm
         MockRequests.get.return_value.text = test_variables["mock_spec_json"]
          
         return AgentApi(config)
@@ -75,7 +82,13 @@ def agent_api(config, test_variables):
 def test_check_connection_success(agent_api):
     with patch('modules.agent_api.requests') as MockRequests:
       MockRequests.get.return_value.status_code = 200
-      assert agent_api.check_connection()["healthy"] is True
+      MockRequests.get.return_value.json.return_value = {"resources": {"core": {"limit": 60, "remaining": 42}}}
+      assert agent_api.check_connection() == {"healthy": True, "info": "Agent up and running, 42 API calls left"}
+      assert MockRequests.get.call_args[0][0] == "https://api.github.com/rate_limit"
+
+      # An API out of quota can't answer questions
+      MockRequests.get.return_value.json.return_value = {"resources": {"core": {"limit": 60, "remaining": 0}}}
+      assert agent_api.check_connection()["healthy"] is False
 
 def test_check_connection_failure(agent_api):
      with patch('modules.agent_api.requests') as MockRequests:
@@ -101,9 +114,9 @@ def test_get_spec(agent_api, test_variables):
         assert base_url == "https://api.example.com/v1"
         assert len(endpoints) == 2
 
-def test_get_relevant_endpoints(agent_api, test_variables):
+def test_get_relevant_endpoints(agent_api, test_variables, mock_llm):
     # Mock LLM response
-    agent_api.llm.side_effect = ["/endpoint1, /endpoint2", ""]
+    mock_llm.side_effect = ["/endpoint1, /endpoint2", ""]
 
     # Test when the LLM provides a list of endpoints
     endpoints = agent_api.get_relevant_endpoints(test_variables["mock_question"], test_variables["mock_history"])
@@ -114,11 +127,30 @@ def test_get_relevant_endpoints(agent_api, test_variables):
     assert endpoints == []
 
     # Assert that the user question and the list of endpoints were used when choosing relevant endpoints
-    assert test_variables["mock_question"] in agent_api.llm.call_args_list[0][0][0].messages[1].content
-    assert str([('GET', '/endpoint1', 'Endpoint 1'), ('GET', '/endpoint2', 'Endpoint 2')]) in agent_api.llm.call_args_list[0][0][0].messages[0].content
+    assert test_variables["mock_question"] in mock_llm.call_args_list[0][0][0].messages[1].content
+    assert str([('GET', '/endpoint1', 'Endpoint 1'), ('GET', '/endpoint2', 'Endpoint 2')]) in mock_llm.call_args_list[0][0][0].messages[0].content
 
     # Assert the agent is aware of the chat history
-    assert str(test_variables["mock_history"]) in agent_api.llm.call_args_list[0][0][0].messages[0].content
+    assert str(test_variables["mock_history"]) in mock_llm.call_args_list[0][0][0].messages[0].content
+
+def test_lazy_connect(config, test_variables):
+    with patch('modules.agent_api.get_llm'), \
+         patch('modules.agent_api.requests') as MockRequests:
+        agent_api = AgentApi(config, lazy=True)
+
+        # Assert the specification is not downloaded until it is needed
+        MockRequests.get.assert_not_called()
+        assert agent_api.is_ready() is False
+
+        MockRequests.get.return_value.text = test_variables["mock_spec_json"]
+        agent_api.endpoint_selector_chain = MagicMock(invoke=MagicMock(return_value=""))
+        agent_api.get_relevant_endpoints(test_variables["mock_question"], [])
+        agent_api.get_relevant_endpoints(test_variables["mock_question"], [])
+
+        # Assert it is downloaded only once
+        MockRequests.get.assert_called_once()
+        assert agent_api.base_url == "https://api.example.com/v1"
+        assert agent_api.is_ready() is True
 
 def test_get_endpoint_details(agent_api, test_variables):
 
@@ -130,22 +162,22 @@ def test_get_endpoint_details(agent_api, test_variables):
     assert "/endpoint1" in details
     assert "/endpoint2" in details
 
-def test_generate_code(agent_api, test_variables):
+def test_generate_code(agent_api, test_variables, mock_llm):
     # Mock LLM response
-    agent_api.llm.side_effect = [test_variables["mock_raw_code"], test_variables["mock_fixed_code"]]
+    mock_llm.side_effect = [test_variables["mock_raw_code"], test_variables["mock_fixed_code"]]
     
     # Call the method under test
     generated_code = agent_api.generate_code(test_variables["mock_question"], test_variables["mock_context"], test_variables["mock_history"])
     
     # Assert that the user question and the endpoint details were used when generating the code
-    assert test_variables["mock_question"] in agent_api.llm.call_args_list[0][0][0].messages[1].content
-    assert test_variables["mock_context"] in agent_api.llm.call_args_list[0][0][0].messages[0].content
+    assert test_variables["mock_question"] in mock_llm.call_args_list[0][0][0].messages[1].content
+    assert test_variables["mock_context"] in mock_llm.call_args_list[0][0][0].messages[0].content
 
     # Assert that the previously generated code was used when looking for mistakes
-    assert test_variables["mock_raw_code"] in agent_api.llm.call_args_list[1][0][0].messages[1].content
+    assert test_variables["mock_raw_code"] in mock_llm.call_args_list[1][0][0].messages[1].content
 
     # Assert the agent is aware of the chat history
-    assert str(test_variables["mock_history"]) in agent_api.llm.call_args_list[0][0][0].messages[0].content
+    assert str(test_variables["mock_history"]) in mock_llm.call_args_list[0][0][0].messages[0].content
 
     # Assert generated code
     assert generated_code == test_variables["mock_cleaned_code"]
@@ -157,7 +189,7 @@ def test_run_code(agent_api, test_variables):
     # Assertions to verify expected behavior
     assert result == test_variables["mock_code_result"]
 
-def test_generate_answer_complete_flow(agent_api, test_variables, config):
+def test_generate_answer_complete_flow(agent_api, test_variables, config, mock_llm):
     with patch('modules.agent_api.filter_agent_history') as MockFilterAgentHistory:
         MockFilterAgentHistory.return_value = test_variables["mock_history"]
 
@@ -168,26 +200,26 @@ def test_generate_answer_complete_flow(agent_api, test_variables, config):
         agent_api.run_code = MagicMock(return_value=test_variables["mock_code_result"])
         
         # Mock LLM response (the entry point asks for more information)
-        agent_api.llm.side_effect = ["CONTINUE", test_variables["mock_answer"]]
+        mock_llm.side_effect = ["CONTINUE", test_variables["mock_answer"]]
         
         # Call the method under test
         answer = agent_api.generate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]}))
 
         # Assert that the user question, the generated code and the code result were used when generating an answer
-        assert test_variables["mock_question"] in agent_api.llm.call_args_list[0][0][0].messages[1].content
-        assert test_variables["mock_question"] in agent_api.llm.call_args_list[1][0][0].messages[1].content
-        assert test_variables["mock_cleaned_code"] not in agent_api.llm.call_args_list[0][0][0].messages[0].content
-        assert test_variables["mock_cleaned_code"] in agent_api.llm.call_args_list[1][0][0].messages[0].content
-        assert str(test_variables["mock_code_result"]) not in agent_api.llm.call_args_list[0][0][0].messages[0].content
-        assert str(test_variables["mock_code_result"]) in agent_api.llm.call_args_list[1][0][0].messages[0].content
+        assert test_variables["mock_question"] in mock_llm.call_args_list[0][0][0].messages[1].content
+        assert test_variables["mock_question"] in mock_llm.call_args_list[1][0][0].messages[1].content
+        assert test_variables["mock_cleaned_code"] not in mock_llm.call_args_list[0][0][0].messages[0].content
+        assert test_variables["mock_cleaned_code"] in mock_llm.call_args_list[1][0][0].messages[0].content
+        assert str(test_variables["mock_code_result"]) not in mock_llm.call_args_list[0][0][0].messages[0].content
+        assert str(test_variables["mock_code_result"]) in mock_llm.call_args_list[1][0][0].messages[0].content
 
         # Assert the agent is aware of its own skills
-        assert config["agent_directive"] in agent_api.llm.call_args_list[0][0][0].messages[0].content
-        assert config["agent_directive"] not in agent_api.llm.call_args_list[1][0][0].messages[0].content
+        assert config["agent_directive"] in mock_llm.call_args_list[0][0][0].messages[0].content
+        assert config["agent_directive"] not in mock_llm.call_args_list[1][0][0].messages[0].content
         
         # Assert the agent is aware of the chat history
-        assert str(test_variables["mock_history"]) in agent_api.llm.call_args_list[0][0][0].messages[0].content
-        assert str(test_variables["mock_history"]) in agent_api.llm.call_args_list[1][0][0].messages[0].content
+        assert str(test_variables["mock_history"]) in mock_llm.call_args_list[0][0][0].messages[0].content
+        assert str(test_variables["mock_history"]) in mock_llm.call_args_list[1][0][0].messages[0].content
 
         # Assert that the chat history was filtered
         MockFilterAgentHistory.assert_called_once_with(test_variables["mock_history"], "agent_api")
@@ -196,7 +228,7 @@ def test_generate_answer_complete_flow(agent_api, test_variables, config):
         assert "agent_api" in answer["agents"]
         assert answer["agents"]["agent_api"] == test_variables["mock_answer"]
 
-def test_generate_answer_skip_flow(agent_api, test_variables, config):
+def test_generate_answer_skip_flow(agent_api, test_variables, config, mock_llm):
     with patch('modules.agent_api.filter_agent_history') as MockFilterAgentHistory:
         MockFilterAgentHistory.return_value = test_variables["mock_history"]
 
@@ -207,13 +239,13 @@ def test_generate_answer_skip_flow(agent_api, test_variables, config):
         agent_api.run_code = MagicMock(return_value=test_variables["mock_code_result"])
         
         # Mock LLM response (the entry point provides the answer right away)
-        agent_api.llm.return_value = test_variables["mock_answer"]
+        mock_llm.return_value = test_variables["mock_answer"]
         
         # Call the method under test
         answer = agent_api.generate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]}))
 
         # Assert that the LLM was called only once
-        agent_api.llm.assert_called_once()
+        mock_llm.assert_called_once()
 
         # Assert no other methods were called
         agent_api.get_relevant_endpoints.assert_not_called()
@@ -232,4 +264,58 @@ def test_generate_answer_error(agent_api, test_variables):
     answer = agent_api.generate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]}))
 
     assert "agent_api" in answer["agents"]
-    assert answer["agents"]["agent_api"] == "I don't know"
\ No newline at end of file
+    assert answer["agents"]["agent_api"] == "I don't know"
+
+
+def test_agenerate_code(agent_api, test_variables, mock_llm):
+    # Mock LLM response
+    mock_llm.side_effect = [test_variables["mock_raw_code"], test_variables["mock_fixed_code"]]
+
+    # Call the method under test
+    generated_code = asyncio.run(agent_api.agenerate_code(test_variables["mock_question"], test_variables["mock_context"], test_variables["mock_history"]))
+
+    # Assert that the previously generated code was used when looking for mistakes
+    assert test_variables["mock_raw_code"] in mock_llm.call_args_list[1][0][0].messages[1].content
+
+    # Assert generated code
+    assert generated_code == test_variables["mock_cleaned_code"]
+
+def test_agenerate_answer_complete_flow(agent_api, test_variables, mock_llm):
+    # Mock already tested methods
+    agent_api.aget_relevant_endpoints = AsyncMock(return_value=test_variables["mock_relevant_endpoints"])
+    agent_api.get_endpoint_details = MagicMock(return_value=test_variables["mock_context"])
+    agent_api.agenerate_code = AsyncMock(return_value=test_variables["mock_cleaned_code"])
+    agent_api.run_code = MagicMock(return_value=test_variables["mock_code_result"])
+
+    # Mock LLM response (the entry point asks for more information)
+    mock_llm.side_effect = ["CONTINUE", test_variables["mock_answer"]]
+
+    # Call the method under test
+    answer = asyncio.run(agent_api.agenerate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]})))
+
+    # Assert the whole flow was followed
+    agent_api.aget_relevant_endpoints.assert_awaited_once()
+    agent_api.get_endpoint_details.assert_called_once_with(test_variables["mock_relevant_endpoints"])
+    agent_api.agenerate_code.assert_awaited_once()
+    agent_api.run_code.assert_called_once_with(test_variables["mock_cleaned_code"])
+
+    # Assert the final answer
+    assert answer == {"agents": {"agent_api": test_variables["mock_answer"]}}
+
+def test_run_code_breaker(agent_api):
+    # Errors of the generated code don't count against the API
+    for _ in range(agent_api.breaker.failure_threshold):
+        with pytest.raises(CodeError):
+            agent_api.run_code("result = 1 / 0")
+    assert agent_api.breaker.state == "closed"
+
+    # Connection errors are retried and open the circuit
+    code = "import requests\nraise requests.ConnectionError('refused')"
+    with patch('modules.circuit_breaker.time.sleep') as mock_sleep:
+        for _ in range(agent_api.breaker.failure_threshold):
+            with pytest.raises(requests.ConnectionError):
+                agent_api.run_code(code)
+    assert mock_sleep.call_count == agent_api.breaker.failure_threshold * agent_api.breaker.retries
+    assert agent_api.breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        agent_api.run_code("result = 1")
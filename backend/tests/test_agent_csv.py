@@ -1,5 +1,6 @@
 import pytest
-from unittest.mock import MagicMock, patch
+import asyncio
+from unittest.mock import MagicMock, AsyncMock, patch
 from modules.models import State
 from modules.agent_csv import AgentCsv
 import pandas as pd
@@ -30,13 +31,17 @@ def test_variables():
     }
 
 @pytest.fixture
-def agent_csv(config):
+def mock_llm():
+    return MagicMock()
+
+@pytest.fixture
+def agent_csv(config, mock_llm):
     with patch('modules.agent_csv.BlobServiceClient') as MockBlob, \
-         patch('modules.agent_csv.AzureChatOpenAI') as MockLLM:
+         patch('modules.agent_csv.get_llm') as MockLLM:
         
         # Mock the blob client and LLM
         MockBlob.return_value = MagicMock(from_connection_string=MagicMock())
-        MockLLM.return_value = MagicMock()
+        MockLLM.return_value = mock_llm
         
         return AgentCsv(config)
     
@@ -73,9 +78,9 @@ def test_get_index(agent_csv, test_variables):
     assert isinstance(index, pd.DataFrame)
     assert index.equals(pd.DataFrame({"col1": ["val1"], "col2": ["val2"]}))
 
-def test_get_relevant_files(agent_csv, test_variables):
+def test_get_relevant_files(agent_csv, test_variables, mock_llm):
     # Mock LLM response
-    agent_csv.llm.side_effect = ["file1.csv, file2.csv", ""]
+    mock_llm.side_effect = ["file1.csv, file2.csv", ""]
 
     # Test when the LLM provides a list of files
     files = agent_csv.get_relevant_files(test_variables["mock_question"], test_variables["mock_index"], test_variables["mock_history"])
@@ -86,11 +91,11 @@ def test_get_relevant_files(agent_csv, test_variables):
     assert files == []
 
     # Assert that the user question and the index were used when choosing relevant files
-    assert test_variables["mock_question"] in agent_csv.llm.call_args_list[0][0][0].messages[1].content
-    assert test_variables["mock_index"] in agent_csv.llm.call_args_list[0][0][0].messages[0].content
+    assert test_variables["mock_question"] in mock_llm.call_args_list[0][0][0].messages[1].content
+    assert test_variables["mock_index"] in mock_llm.call_args_list[0][0][0].messages[0].content
 
     # Assert the agent is aware of the chat history
-    assert str(test_variables["mock_history"]) in agent_csv.llm.call_args_list[0][0][0].messages[0].content
+    assert str(test_variables["mock_history"]) in mock_llm.call_args_list[0][0][0].messages[0].content
 
 def test_get_files_head(agent_csv, test_variables):
     # Mock Azure Blob Storage responses
@@ -109,22 +114,22 @@ def test_get_files_head(agent_csv, test_variables):
     assert files_head["file1.csv"][0]["col1"] == "val1"
     assert files_head["file2.csv"][0]["col1"] == "val1"
 
-def test_generate_code(agent_csv, test_variables):
+def test_generate_code(agent_csv, test_variables, mock_llm):
     # Mock LLM response
-    agent_csv.llm.side_effect = [test_variables["mock_raw_code"], test_variables["mock_fixed_code"]]
+    mock_llm.side_effect = [test_variables["mock_raw_code"], test_variables["mock_fixed_code"]]
     
     # Call the method under test
     generated_code = agent_csv.generate_code(test_variables["mock_question"], test_variables["mock_context"], test_variables["mock_history"])
     
     # Assert that the user question and the csv extract were used when generating the code
-    assert test_variables["mock_question"] in agent_csv.llm.call_args_list[0][0][0].messages[1].content
-    assert test_variables["mock_context"] in agent_csv.llm.call_args_list[0][0][0].messages[0].content
+    assert test_variables["mock_question"] in mock_llm.call_args_list[0][0][0].messages[1].content
+    assert test_variables["mock_context"] in mock_llm.call_args_list[0][0][0].messages[0].content
 
     # Assert that the previously generated code was used when looking for mistakes
-    assert test_variables["mock_raw_code"] in agent_csv.llm.call_args_list[1][0][0].messages[1].content
+    assert test_variables["mock_raw_code"] in mock_llm.call_args_list[1][0][0].messages[1].content
 
     # Assert the agent is aware of the chat history
-    assert str(test_variables["mock_history"]) in agent_csv.llm.call_args_list[0][0][0].messages[0].content
+    assert str(test_variables["mock_history"]) in mock_llm.call_args_list[0][0][0].messages[0].content
 
     # Assert generated code
     assert generated_code == test_variables["mock_cleaned_code"]
@@ -136,7 +141,7 @@ def test_run_code(agent_csv, test_variables):
     # Assertions to verify expected behavior
     assert result == test_variables["mock_code_result"]
 
-def test_generate_answer_complete_flow(agent_csv, test_variables, config):
+def test_generate_answer_complete_flow(agent_csv, test_variables, config, mock_llm):
     with patch('modules.agent_csv.filter_agent_history') as MockFilterAgentHistory:
         MockFilterAgentHistory.return_value = test_variables["mock_history"]
 
@@ -148,26 +153,26 @@ def test_generate_answer_complete_flow(agent_csv, test_variables, config):
         agent_csv.run_code = MagicMock(return_value=test_variables["mock_code_result"])
         
         # Mock LLM response (the entry point asks for more information)
-        agent_csv.llm.side_effect = ["CONTINUE", test_variables["mock_answer"]]
+        mock_llm.side_effect = ["CONTINUE", test_variables["mock_answer"]]
         
         # Call the method under test
         answer = agent_csv.generate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]}))
 
         # Assert that the user question, the generated code and the code result were used when generating an answer
-        assert test_variables["mock_question"] in agent_csv.llm.call_args_list[0][0][0].messages[1].content
-        assert test_variables["mock_question"] in agent_csv.llm.call_args_list[1][0][0].messages[1].content
-        assert test_variables["mock_cleaned_code"] not in agent_csv.llm.call_args_list[0][0][0].messages[0].content
-        assert test_variables["mock_cleaned_code"] in agent_csv.llm.call_args_list[1][0][0].messages[0].content
-        assert str(test_variables["mock_code_result"]) not in agent_csv.llm.call_args_list[0][0][0].messages[0].content
-        assert str(test_variables["mock_code_result"]) in agent_csv.llm.call_args_list[1][0][0].messages[0].content
+        assert test_variables["mock_question"] in mock_llm.call_args_list[0][0][0].messages[1].content
+        assert test_variables["mock_question"] in mock_llm.call_args_list[1][0][0].messages[1].content
+        assert test_variables["mock_cleaned_code"] not in mock_llm.call_args_list[0][0][0].messages[0].content
+        assert test_variables["mock_cleaned_code"] in mock_llm.call_args_list[1][0][0].messages[0].content
+        assert str(test_variables["mock_code_result"]) not in mock_llm.call_args_list[0][0][0].messages[0].content
+        assert str(test_variables["mock_code_result"]) in mock_llm.call_args_list[1][0][0].messages[0].content
 
         # Assert the agent is aware of its own skills
-        assert config["agent_directive"] in agent_csv.llm.call_args_list[0][0][0].messages[0].content
-        assert config["agent_directive"] not in agent_csv.llm.call_args_list[1][0][0].messages[0].content
+        assert config["agent_directive"] in mock_llm.call_args_list[0][0][0].messages[0].content
+        assert config["agent_directive"] not in mock_llm.call_args_list[1][0][0].messages[0].content
         
         # Assert the agent is aware of the chat history
-        assert str(test_variables["mock_history"]) in agent_csv.llm.call_args_list[0][0][0].messages[0].content
-        assert str(test_variables["mock_history"]) in agent_csv.llm.call_args_list[1][0][0].messages[0].content
+        assert str(test_variables["mock_history"]) in mock_llm.call_args_list[0][0][0].messages[0].content
+        assert str(test_variables["mock_history"]) in mock_llm.call_args_list[1][0][0].messages[0].content
 
         # Assert that the chat history was filtered
         MockFilterAgentHistory.assert_called_once_with(test_variables["mock_history"], "agent_csv")
@@ -176,7 +181,7 @@ def test_generate_answer_complete_flow(agent_csv, test_variables, config):
         assert "agent_csv" in answer["agents"]
         assert answer["agents"]["agent_csv"] == test_variables["mock_answer"]
 
-def test_generate_answer_skip_flow(agent_csv, test_variables, config):
+def test_generate_answer_skip_flow(agent_csv, test_variables, config, mock_llm):
     with patch('modules.agent_csv.filter_agent_history') as MockFilterAgentHistory:
         MockFilterAgentHistory.return_value = test_variables["mock_history"]
 
@@ -188,13 +193,13 @@ def test_generate_answer_skip_flow(agent_csv, test_variables, config):
         agent_csv.run_code = MagicMock(return_value=test_variables["mock_code_result"])
         
         # Mock LLM response (the entry point provides the answer right away)
-        agent_csv.llm.return_value = test_variables["mock_answer"]
+        mock_llm.return_value = test_variables["mock_answer"]
         
         # Call the method under test
         answer = agent_csv.generate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]}))
 
         # Assert that the LLM was called only once
-        agent_csv.llm.assert_called_once()
+        mock_llm.assert_called_once()
 
         # Assert no other methods were called
         agent_csv.get_index.assert_not_called()
@@ -214,4 +219,44 @@ def test_generate_answer_error(agent_csv, test_variables):
     answer = agent_csv.generate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]}))
 
     assert "agent_csv" in answer["agents"]
-    assert answer["agents"]["agent_csv"] == "I don't know"
\ No newline at end of file
+    assert answer["agents"]["agent_csv"] == "I don't know"
+
+
+def test_agenerate_answer_complete_flow(agent_csv, test_variables, mock_llm):
+    # Mock already tested methods
+    agent_csv.get_index = MagicMock(return_value=test_variables["mock_index"])
+    agent_csv.aget_relevant_files = AsyncMock(return_value=test_variables["mock_relevant_files"])
+    agent_csv.get_files_head = MagicMock(return_value=test_variables["mock_context"])
+    agent_csv.agenerate_code = AsyncMock(return_value=test_variables["mock_cleaned_code"])
+    agent_csv.run_code = MagicMock(return_value=test_variables["mock_code_result"])
+
+    # Mock LLM response (the entry point asks for more information)
+    mock_llm.side_effect = ["CONTINUE", test_variables["mock_answer"]]
+
+    # Call the method under test
+    answer = asyncio.run(agent_csv.agenerate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]})))
+
+    # Assert the whole flow was followed
+    agent_csv.get_index.assert_called_once()
+    agent_csv.aget_relevant_files.assert_awaited_once()
+    agent_csv.get_files_head.assert_called_once_with(test_variables["mock_relevant_files"])
+    agent_csv.agenerate_code.assert_awaited_once()
+    agent_csv.run_code.assert_called_once_with(test_variables["mock_cleaned_code"])
+
+    # Assert the final answer
+    assert answer == {"agents": {"agent_csv": test_variables["mock_answer"]}}
+
+def test_aprefetch(agent_csv, test_variables):
+    agent_csv.get_index = MagicMock(return_value=test_variables["mock_index"])
+    assert asyncio.run(agent_csv.aprefetch({"question": test_variables["mock_question"]})) == {"index": test_variables["mock_index"]}
+
+def test_chain_models(config):
+    with patch('modules.agent_csv.BlobServiceClient'), \
+         patch('modules.agent_csv.get_llm') as MockLLM:
+        AgentCsv(config)
+
+    # Each chain asks for the model of its role, so cheap steps can run on a smaller deployment
+    chains = [call[0] for call in MockLLM.call_args_list]
+    assert ("agent_csv", "file_selector_chain") in chains
+    assert ("agent_csv", "code_reviewer_chain") in chains
+    assert ("agent_csv", "answer_generator_chain") in chains
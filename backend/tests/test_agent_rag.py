@@ -1,5 +1,6 @@
 import pytest
-from unittest.mock import MagicMock, patch
+import asyncio
+from unittest.mock import MagicMock, AsyncMock, patch
 from modules.models import State
 from modules.agent_rag import AgentRag
 
@@ -25,15 +26,19 @@ def test_variables():
     }
 
 @pytest.fixture
-def agent_rag(config):
+def mock_llm():
+    return MagicMock()
+
+@pytest.fixture
+def agent_rag(config, mock_llm):
     with patch('modules.agent_rag.AzureOpenAIEmbeddings') as MockEmbeddings, \
          patch('modules.agent_rag.AzureSearch') as MockAzureSearch, \
-         patch('modules.agent_rag.AzureChatOpenAI') as MockLLM:
+         patch('modules.agent_rag.get_llm') as MockLLM:
         
         # Mock the embeddings, vector store, and LLM
         MockEmbeddings.return_value = MagicMock(embed_query=MagicMock())
         MockAzureSearch.return_value = MagicMock(similarity_search=MagicMock())
-        MockLLM.return_value = MagicMock()
+        MockLLM.return_value = mock_llm
         
         return AgentRag(config)
 
@@ -81,7 +86,30 @@ def test_retrieve_context(agent_rag, test_variables):
     # Assert constructed context
     assert context == test_variables["mock_context"]
 
-def test_generate_answer_complete_flow(agent_rag, test_variables, config):
+def test_lazy_connect(config, test_variables):
+    with patch('modules.agent_rag.get_llm'):
+        agent_rag = AgentRag(config, lazy=True)
+
+    # Assert the vector store is not connected until it is needed
+    assert agent_rag.vstore is None
+    assert agent_rag.is_ready() is False
+
+    agent_rag.connect = MagicMock(return_value=MagicMock(similarity_search=MagicMock(return_value=test_variables["mock_relevant_docs"])))
+    assert agent_rag.retrieve_context(test_variables["mock_question"]) == test_variables["mock_context"]
+    agent_rag.retrieve_context(test_variables["mock_question"])
+
+    # Assert it connects only once
+    agent_rag.connect.assert_called_once()
+    assert agent_rag.is_ready() is True
+
+def test_aembed_query(agent_rag, test_variables):
+    agent_rag.embeddings = MagicMock(aembed_query=AsyncMock(return_value=[0.1, 0.2]))
+
+    # Assert the question is embedded with the model of the vector store
+    assert asyncio.run(agent_rag.aembed_query(test_variables["mock_question"])) == [0.1, 0.2]
+    agent_rag.embeddings.aembed_query.assert_awaited_once_with(test_variables["mock_question"])
+
+def test_generate_answer_complete_flow(agent_rag, test_variables, config, mock_llm):
     with patch('modules.agent_rag.filter_agent_history') as MockFilterAgentHistory:
         MockFilterAgentHistory.return_value = test_variables["mock_history"]
         
@@ -89,7 +117,7 @@ def test_generate_answer_complete_flow(agent_rag, test_variables, config):
         agent_rag.retrieve_context = MagicMock(return_value=test_variables["mock_context"])
         
         # Mock LLM response (the entry point asks for more information)
-        agent_rag.llm.side_effect = ["CONTINUE", test_variables["mock_answer"]]
+        mock_llm.side_effect = ["CONTINUE", test_variables["mock_answer"]]
 
         # Call the method under test
         answer = agent_rag.generate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]}))
@@ -98,18 +126,18 @@ def test_generate_answer_complete_flow(agent_rag, test_variables, config):
         agent_rag.retrieve_context.assert_called_once_with(test_variables["mock_question"])
         
         # Assert that the user question and the context were used when generating an answer
-        assert test_variables["mock_question"] in agent_rag.llm.call_args_list[0][0][0].messages[1].content
-        assert test_variables["mock_question"] in agent_rag.llm.call_args_list[1][0][0].messages[1].content
-        assert test_variables["mock_context"] not in agent_rag.llm.call_args_list[0][0][0].messages[0].content
-        assert test_variables["mock_context"] in agent_rag.llm.call_args_list[1][0][0].messages[0].content
+        assert test_variables["mock_question"] in mock_llm.call_args_list[0][0][0].messages[1].content
+        assert test_variables["mock_question"] in mock_llm.call_args_list[1][0][0].messages[1].content
+        assert test_variables["mock_context"] not in mock_llm.call_args_list[0][0][0].messages[0].content
+        assert test_variables["mock_context"] in mock_llm.call_args_list[1][0][0].messages[0].content
 
         # Assert the agent is aware of its own skills
-        assert config["agent_directive"] in agent_rag.llm.call_args_list[0][0][0].messages[0].content
-        assert config["agent_directive"] not in agent_rag.llm.call_args_list[1][0][0].messages[0].content
+        assert config["agent_directive"] in mock_llm.call_args_list[0][0][0].messages[0].content
+        assert config["agent_directive"] not in mock_llm.call_args_list[1][0][0].messages[0].content
 
         # Assert the agent is aware of the chat history
-        assert str(test_variables["mock_history"]) in agent_rag.llm.call_args_list[0][0][0].messages[0].content
-        assert str(test_variables["mock_history"]) in agent_rag.llm.call_args_list[1][0][0].messages[0].content
+        assert str(test_variables["mock_history"]) in mock_llm.call_args_list[0][0][0].messages[0].content
+        assert str(test_variables["mock_history"]) in mock_llm.call_args_list[1][0][0].messages[0].content
 
         # Assert that the chat history was filtered
         MockFilterAgentHistory.assert_called_once_with(test_variables["mock_history"], "agent_rag")
@@ -118,7 +146,7 @@ def test_generate_answer_complete_flow(agent_rag, test_variables, config):
         assert "agent_rag" in answer["agents"]
         assert answer["agents"]["agent_rag"] == test_variables["mock_answer"]
 
-def test_generate_answer_skip_flow(agent_rag, test_variables, config):
+def test_generate_answer_skip_flow(agent_rag, test_variables, config, mock_llm):
     with patch('modules.agent_rag.filter_agent_history') as MockFilterAgentHistory:
         MockFilterAgentHistory.return_value = test_variables["mock_history"]
 
@@ -126,13 +154,13 @@ def test_generate_answer_skip_flow(agent_rag, test_variables, config):
         agent_rag.retrieve_context = MagicMock(return_value=test_variables["mock_context"])
 
         # Mock LLM response (the entry point provides the answer right away)
-        agent_rag.llm.return_value = test_variables["mock_answer"]
+        mock_llm.return_value = test_variables["mock_answer"]
 
         # Call the method under test
         answer = agent_rag.generate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]}))
 
         # Assert that the LLM was called only once
-        agent_rag.llm.assert_called_once()
+        mock_llm.assert_called_once()
 
         # Assert no other methods were called
         agent_rag.retrieve_context.assert_not_called()
@@ -149,3 +177,84 @@ def test_generate_answer_error(agent_rag, test_variables):
 
     assert "agent_rag" in answer["agents"]
     assert answer["agents"]["agent_rag"] == "I don't know"
+
+
+def test_agenerate_answer_complete_flow(agent_rag, test_variables, mock_llm):
+    # Mock context retrieval
+    agent_rag.retrieve_context = MagicMock(return_value=test_variables["mock_context"])
+
+    # Mock LLM response (the entry point asks for more information)
+    mock_llm.side_effect = ["CONTINUE", test_variables["mock_answer"]]
+
+    # Call the method under test
+    answer = asyncio.run(agent_rag.agenerate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]})))
+
+    # Assert that a call to retrieve context was done and used when generating an answer
+    agent_rag.retrieve_context.assert_called_once_with(test_variables["mock_question"])
+    assert test_variables["mock_context"] in mock_llm.call_args_list[1][0][0].messages[0].content
+
+    # Assert the final answer
+    assert answer == {"agents": {"agent_rag": test_variables["mock_answer"]}}
+
+def test_agenerate_answer_fused(agent_rag, test_variables, mock_llm):
+    agent_rag.retrieve_context = MagicMock(return_value=test_variables["mock_context"])
+    mock_llm.side_effect = [test_variables["mock_answer"]]
+
+    # The supervisor already decided that the agent has to look for the answer
+    state = State({"question": test_variables["mock_question"], "history": test_variables["mock_history"], "entry_answers": {"agent_rag": "CONTINUE"}})
+    answer = asyncio.run(agent_rag.agenerate_answer(state))
+
+    # Assert the entry point chain was skipped
+    mock_llm.assert_called_once()
+    agent_rag.retrieve_context.assert_called_once()
+    assert answer == {"agents": {"agent_rag": test_variables["mock_answer"]}}
+
+    # Assert an answer from the supervisor is returned as is
+    state["entry_answers"] = {"agent_rag": "Paris"}
+    assert agent_rag.generate_answer(state) == {"agents": {"agent_rag": "Paris"}}
+    mock_llm.assert_called_once()
+
+def test_agenerate_answer_error(agent_rag, test_variables, mock_llm):
+    # Mock to raise an error
+    mock_llm.side_effect = ["CONTINUE", test_variables["mock_answer"]]
+    agent_rag.retrieve_context = MagicMock(side_effect=Exception("Mocked exception"))
+
+    answer = asyncio.run(agent_rag.agenerate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]})))
+
+    assert answer == {"agents": {"agent_rag": "I don't know"}}
+
+def test_aprefetch(agent_rag, test_variables):
+    agent_rag.retrieve_context = MagicMock(return_value=test_variables["mock_context"])
+    assert asyncio.run(agent_rag.aprefetch({"question": test_variables["mock_question"]})) == {"context": test_variables["mock_context"]}
+
+    # Errors while prefetching are not raised, the agent will try again if picked
+    agent_rag.retrieve_context = MagicMock(side_effect=Exception("Mocked exception"))
+    assert asyncio.run(agent_rag.aprefetch({"question": test_variables["mock_question"]})) == {}
+
+def test_agenerate_answer_prefetched(agent_rag, test_variables, mock_llm):
+    agent_rag.retrieve_context = MagicMock()
+    mock_llm.side_effect = ["CONTINUE", test_variables["mock_answer"]]
+
+    # Call the method under test with the context already retrieved
+    state = State({"question": test_variables["mock_question"], "history": test_variables["mock_history"], "prefetched": {"agent_rag": {"context": test_variables["mock_context"]}}})
+    answer = asyncio.run(agent_rag.agenerate_answer(state))
+
+    # Assert the prefetched context was used
+    agent_rag.retrieve_context.assert_not_called()
+    assert test_variables["mock_context"] in mock_llm.call_args_list[1][0][0].messages[0].content
+    assert answer == {"agents": {"agent_rag": test_variables["mock_answer"]}}
+
+def test_connect_embedding_cache(config):
+    from modules.embedding_cache import CachedEmbeddings, EmbeddingStore
+    store = EmbeddingStore()
+    with patch('modules.agent_rag.AzureOpenAIEmbeddings') as MockEmbeddings, \
+         patch('modules.agent_rag.AzureSearch') as MockAzureSearch, \
+         patch('modules.agent_rag.get_llm'):
+        MockEmbeddings.return_value = MagicMock(model="ada-002", embed_query=MagicMock(return_value=[0.5, 0.25]))
+        agent_rag = AgentRag(config, embedding_cache=store)
+
+    # The vector store embeds the questions through the cache
+    assert isinstance(agent_rag.embeddings, CachedEmbeddings)
+    embed = MockAzureSearch.call_args.kwargs["embedding_function"]
+    assert embed("question") == embed("question") == [0.5, 0.25]
+    MockEmbeddings.return_value.embed_query.assert_called_once_with("question")
@@ -1,7 +1,10 @@
 import pytest
-from unittest.mock import MagicMock, patch
+import asyncio
+import time
+from unittest.mock import MagicMock, AsyncMock, patch
 from modules.models import State
 from modules.agent_sql import AgentSql
+from modules.deadline import agent_deadline
 
 @pytest.fixture
 def config():
@@ -28,13 +31,17 @@ def test_variables():
     }
 
 @pytest.fixture
-def agent_sql(config):
+def mock_llm():
+    return MagicMock()
+
+@pytest.fixture
+def agent_sql(config, mock_llm):
     with patch('modules.agent_sql.SQLDatabase') as MockSQL, \
-         patch('modules.agent_sql.AzureChatOpenAI') as MockLLM:
+         patch('modules.agent_sql.get_llm') as MockLLM:
         
         # Mock the SQL connection and LLM
         MockSQL.return_value = MagicMock(from_uri=MagicMock())
-        MockLLM.return_value = MagicMock()
+        MockLLM.return_value = mock_llm
         
         return AgentSql(config)
 
@@ -66,22 +73,35 @@ def test_get_schema(agent_sql, test_variables):
         "SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME, DATA_TYPE FROM INFORMATION_SCHEMA.COLUMNS"
     )
 
-def test_generate_query(agent_sql, test_variables):
+def test_lazy_connect(config):
+    with patch('modules.agent_sql.get_llm'):
+        agent_sql = AgentSql(config, lazy=True)
+
+    # Assert the database is not connected until it is needed
+    assert agent_sql.db is None
+    assert agent_sql.is_ready() is False
+
+    agent_sql.connect = MagicMock(return_value=MagicMock(run=MagicMock(return_value="schema")))
+    assert agent_sql.get_schema() == "schema"
+    agent_sql.connect.assert_called_once()
+    assert agent_sql.is_ready() is True
+
+def test_generate_query(agent_sql, test_variables, mock_llm):
     # Mock LLM response
-    agent_sql.llm.side_effect = [test_variables["mock_raw_query"], test_variables["mock_fixed_query"]]
+    mock_llm.side_effect = [test_variables["mock_raw_query"], test_variables["mock_fixed_query"]]
     
     # Call the method under test
     generated_query = agent_sql.generate_query(test_variables["mock_question"], test_variables["mock_schema"], test_variables["mock_history"])
     
     # Assert that the user question and the schema were used when generating the query
-    assert test_variables["mock_question"] in agent_sql.llm.call_args_list[0][0][0].messages[1].content
-    assert str(test_variables["mock_schema"]) in agent_sql.llm.call_args_list[0][0][0].messages[0].content
+    assert test_variables["mock_question"] in mock_llm.call_args_list[0][0][0].messages[1].content
+    assert str(test_variables["mock_schema"]) in mock_llm.call_args_list[0][0][0].messages[0].content
 
     # Assert that the previously generated query was used when looking for mistakes
-    assert test_variables["mock_raw_query"] in agent_sql.llm.call_args_list[1][0][0].messages[1].content
+    assert test_variables["mock_raw_query"] in mock_llm.call_args_list[1][0][0].messages[1].content
 
     # Assert the agent is aware of the chat history
-    assert str(test_variables["mock_history"]) in agent_sql.llm.call_args_list[0][0][0].messages[0].content
+    assert str(test_variables["mock_history"]) in mock_llm.call_args_list[0][0][0].messages[0].content
 
     # Assert generated query
     assert generated_query == test_variables["mock_cleaned_query"]
@@ -97,7 +117,7 @@ def test_run_query(agent_sql, test_variables):
     assert result == test_variables["mock_query_result"]
     agent_sql.db.run.assert_called_once_with(test_variables["mock_cleaned_query"])
 
-def test_generate_answer_complete_flow(agent_sql, test_variables, config):
+def test_generate_answer_complete_flow(agent_sql, test_variables, config, mock_llm):
     with patch('modules.agent_sql.filter_agent_history') as MockFilterAgentHistory:
         MockFilterAgentHistory.return_value = test_variables["mock_history"]
         
@@ -108,26 +128,26 @@ def test_generate_answer_complete_flow(agent_sql, test_variables, config):
         agent_sql.run_query = MagicMock(return_value=test_variables["mock_query_result"])
         
         # Mock LLM response (the entry point asks for more information)
-        agent_sql.llm.side_effect = ["CONTINUE", test_variables["mock_answer"]]
+        mock_llm.side_effect = ["CONTINUE", test_variables["mock_answer"]]
         
         # Call the method under test
         answer = agent_sql.generate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]}))
 
         # Assert that the user question, the generated query and the query result were used when generating an answer
-        assert test_variables["mock_question"] in agent_sql.llm.call_args_list[0][0][0].messages[1].content
-        assert test_variables["mock_question"] in agent_sql.llm.call_args_list[1][0][0].messages[1].content
-        assert test_variables["mock_cleaned_query"] not in agent_sql.llm.call_args_list[0][0][0].messages[0].content
-        assert test_variables["mock_cleaned_query"] in agent_sql.llm.call_args_list[1][0][0].messages[0].content
-        assert str(test_variables["mock_query_result"]) not in agent_sql.llm.call_args_list[0][0][0].messages[0].content
-        assert str(test_variables["mock_query_result"]) in agent_sql.llm.call_args_list[1][0][0].messages[0].content
+        assert test_variables["mock_question"] in mock_llm.call_args_list[0][0][0].messages[1].content
+        assert test_variables["mock_question"] in mock_llm.call_args_list[1][0][0].messages[1].content
+        assert test_variables["mock_cleaned_query"] not in mock_llm.call_args_list[0][0][0].messages[0].content
+        assert test_variables["mock_cleaned_query"] in mock_llm.call_args_list[1][0][0].messages[0].content
+        assert str(test_variables["mock_query_result"]) not in mock_llm.call_args_list[0][0][0].messages[0].content
+        assert str(test_variables["mock_query_result"]) in mock_llm.call_args_list[1][0][0].messages[0].content
 
         # Assert the agent is aware of its own skills
-        assert config["agent_directive"] in agent_sql.llm.call_args_list[0][0][0].messages[0].content
-        assert config["agent_directive"] not in agent_sql.llm.call_args_list[1][0][0].messages[0].content
+        assert config["agent_directive"] in mock_llm.call_args_list[0][0][0].messages[0].content
+        assert config["agent_directive"] not in mock_llm.call_args_list[1][0][0].messages[0].content
         
         # Assert the agent is aware of the chat history
-        assert str(test_variables["mock_history"]) in agent_sql.llm.call_args_list[0][0][0].messages[0].content
-        assert str(test_variables["mock_history"]) in agent_sql.llm.call_args_list[1][0][0].messages[0].content
+        assert str(test_variables["mock_history"]) in mock_llm.call_args_list[0][0][0].messages[0].content
+        assert str(test_variables["mock_history"]) in mock_llm.call_args_list[1][0][0].messages[0].content
 
         # Assert that the chat history was filtered
         MockFilterAgentHistory.assert_called_once_with(test_variables["mock_history"], "agent_sql")
@@ -136,7 +156,7 @@ def test_generate_answer_complete_flow(agent_sql, test_variables, config):
         assert "agent_sql" in answer["agents"]
         assert answer["agents"]["agent_sql"] == test_variables["mock_answer"]
 
-def test_generate_answer_skip_flow(agent_sql, test_variables, config):
+def test_generate_answer_skip_flow(agent_sql, test_variables, config, mock_llm):
     with patch('modules.agent_sql.filter_agent_history') as MockFilterAgentHistory:
         MockFilterAgentHistory.return_value = test_variables["mock_history"]
         
@@ -147,13 +167,13 @@ def test_generate_answer_skip_flow(agent_sql, test_variables, config):
         agent_sql.run_query = MagicMock(return_value=test_variables["mock_query_result"])
         
         # Mock LLM response (the entry point provides the answer right away)
-        agent_sql.llm.return_value = test_variables["mock_answer"]
+        mock_llm.return_value = test_variables["mock_answer"]
         
         # Call the method under test
         answer = agent_sql.generate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]}))
 
         # Assert that the LLM was called only once
-        agent_sql.llm.assert_called_once()
+        mock_llm.assert_called_once()
 
         # Assert no other methods were called
         agent_sql.check_connection.assert_not_called()
@@ -172,4 +192,90 @@ def test_generate_answer_error(agent_sql, test_variables):
     answer = agent_sql.generate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]}))
 
     assert "agent_sql" in answer["agents"]
-    assert answer["agents"]["agent_sql"] == "I don't know"
\ No newline at end of file
+    assert answer["agents"]["agent_sql"] == "I don't know"
+
+
+def test_agenerate_query(agent_sql, test_variables, mock_llm):
+    # Mock LLM response
+    mock_llm.side_effect = [test_variables["mock_raw_query"], test_variables["mock_fixed_query"]]
+
+    # Call the method under test
+    generated_query = asyncio.run(agent_sql.agenerate_query(test_variables["mock_question"], test_variables["mock_schema"], test_variables["mock_history"]))
+
+    # Assert that the previously generated query was used when looking for mistakes
+    assert test_variables["mock_raw_query"] in mock_llm.call_args_list[1][0][0].messages[1].content
+
+    # Assert generated query
+    assert generated_query == test_variables["mock_cleaned_query"]
+
+def test_agenerate_answer_complete_flow(agent_sql, test_variables, mock_llm):
+    # Mock already tested methods
+    agent_sql.check_connection = MagicMock(return_value={"healthy": True})
+    agent_sql.get_schema = MagicMock(return_value=test_variables["mock_schema"])
+    agent_sql.agenerate_query = AsyncMock(return_value=test_variables["mock_cleaned_query"])
+    agent_sql.run_query = MagicMock(return_value=test_variables["mock_query_result"])
+
+    # Mock LLM response (the entry point asks for more information)
+    mock_llm.side_effect = ["CONTINUE", test_variables["mock_answer"]]
+
+    # Call the method under test
+    answer = asyncio.run(agent_sql.agenerate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]})))
+
+    # Assert the whole flow was followed, without probing the connection on every question
+    agent_sql.check_connection.assert_not_called()
+    agent_sql.get_schema.assert_called_once()
+    agent_sql.agenerate_query.assert_awaited_once()
+    agent_sql.run_query.assert_called_once_with(test_variables["mock_cleaned_query"])
+    assert str(test_variables["mock_query_result"]) in mock_llm.call_args_list[1][0][0].messages[0].content
+
+    # Assert the final answer
+    assert answer == {"agents": {"agent_sql": test_variables["mock_answer"]}}
+
+def test_agenerate_answer_prefetched(agent_sql, test_variables, mock_llm):
+    agent_sql.check_connection = MagicMock()
+    agent_sql.get_schema = MagicMock()
+    agent_sql.agenerate_query = AsyncMock(return_value=test_variables["mock_cleaned_query"])
+    agent_sql.run_query = MagicMock(return_value=test_variables["mock_query_result"])
+    mock_llm.side_effect = ["CONTINUE", test_variables["mock_answer"]]
+
+    # Call the method under test with the schema already retrieved
+    state = State({"question": test_variables["mock_question"], "history": test_variables["mock_history"], "prefetched": {"agent_sql": {"schema": test_variables["mock_schema"]}}})
+    answer = asyncio.run(agent_sql.agenerate_answer(state))
+
+    # Assert the prefetched schema was used
+    agent_sql.check_connection.assert_not_called()
+    agent_sql.get_schema.assert_not_called()
+    assert agent_sql.agenerate_query.call_args[0][1] == test_variables["mock_schema"]
+    assert answer == {"agents": {"agent_sql": test_variables["mock_answer"]}}
+
+def test_run_query_circuit_breaker(agent_sql, test_variables):
+    from sqlalchemy.exc import OperationalError, ProgrammingError
+    agent_sql.breaker.backoff = 0
+
+    # A lost connection is retried
+    agent_sql.db.run = MagicMock(side_effect=[OperationalError("SELECT", {}, Exception("lost")), test_variables["mock_query_result"]])
+    assert agent_sql.run_query(test_variables["mock_cleaned_query"]) == test_variables["mock_query_result"]
+
+    # A wrong query is not the database fault
+    agent_sql.breaker.failure_threshold = 1
+    agent_sql.db.run = MagicMock(side_effect=ProgrammingError("SELECT", {}, Exception("invalid column")))
+    with pytest.raises(ProgrammingError):
+        agent_sql.run_query(test_variables["mock_cleaned_query"])
+    assert agent_sql.is_available() is True
+    agent_sql.db.run.assert_called_once()
+
+def test_set_statement_timeout(agent_sql):
+    conn = MagicMock()
+    conn.connection.driver_connection.timeout = 0
+
+    # The statements of an agent with a deadline stop when it runs out of time
+    token = agent_deadline.set(time.monotonic() + 2.5)
+    try:
+        agent_sql.set_statement_timeout(conn, None, "SELECT 1", None, None, False)
+    finally:
+        agent_deadline.reset(token)
+    assert conn.connection.driver_connection.timeout == 3
+
+    # The pooled connection gets no timeout for the next statements without a deadline
+    agent_sql.set_statement_timeout(conn, None, "SELECT 1", None, None, False)
+    assert conn.connection.driver_connection.timeout == 0
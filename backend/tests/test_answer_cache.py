@@ -0,0 +1,108 @@
+import pytest
+import asyncio
+import numpy as np
+from unittest.mock import AsyncMock, patch
+from modules.answer_cache import SemanticCache, InvalidationLog
+
+@pytest.fixture
+def cache():
+    return SemanticCache(AsyncMock(return_value=[3.0, 4.0]), similarity_threshold=0.9, ttl=60, max_entries=2)
+
+def vector(*values):
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def test_aembed(cache):
+    # Assert the embedding is normalized
+    result = asyncio.run(cache.aembed("What is the capital of France?"))
+    assert result.dtype == np.float32
+    assert np.allclose(result, [0.6, 0.8])
+
+def test_lookup(cache):
+    assert cache.lookup(vector(1, 0)) is None
+    cache.add("What is the capital of France?", vector(1, 0), "Paris", {"agent_rag": "Paris"})
+
+    # Assert only similar enough questions match
+    assert cache.lookup(vector(1, 0.1)) == { "answer": "Paris", "agents": {"agent_rag": "Paris"} }
+    assert cache.lookup(vector(1, 1)) is None
+
+def test_lookup_expired(cache):
+    cache.add("What is the capital of France?", vector(1, 0), "Paris", {"agent_rag": "Paris"})
+
+    with patch('modules.answer_cache.time') as MockTime:
+        MockTime.monotonic.return_value = cache.entries[0]["expires"] + 1
+        assert cache.lookup(vector(1, 0)) is None
+    assert len(cache.entries) == 0
+
+def test_lru_eviction(cache):
+    cache.add("first", vector(1, 0), "first answer", {})
+    cache.add("second", vector(0, 1), "second answer", {})
+
+    # The first one is used, so the second one is the least recently used
+    cache.lookup(vector(1, 0))
+    cache.add("third", vector(1, 1), "third answer", {})
+
+    assert [entry["question"] for entry in cache.entries.values()] == ["first", "third"]
+
+def test_invalidate(cache):
+    cache.add("first", vector(1, 0), "first answer", {"agent_rag": "answer"})
+    cache.add("second", vector(0, 1), "second answer", {"agent_sql": "answer"})
+
+    # Assert only the answers of the agent are dropped
+    assert cache.invalidate("agent_rag") == 1
+    assert [entry["question"] for entry in cache.entries.values()] == ["second"]
+
+    # Assert all the answers are dropped
+    assert cache.invalidate() == 1
+    assert len(cache.entries) == 0
+
+def test_is_cacheable(cache):
+    # Any question asked within a conversation may depend on it, not only the ones referring to it
+    assert cache.is_cacheable([]) is True
+    assert cache.is_cacheable([{"role": "user", "content": "my name is Bob"}]) is False
+
+def test_default_threshold():
+    # Questions that only differ in an entity, like "sales in March" and "sales in May", are very similar but need another answer
+    cache = SemanticCache(AsyncMock())
+    march = vector(1, 0)
+    may = vector(0.96, np.sqrt(1 - 0.96 ** 2))
+    assert float(march @ may) > 0.95
+    cache.add("What were the sales in March?", march, "100", {"agent_sql": "100"})
+    assert cache.lookup(may) is None
+    assert cache.lookup(vector(1, 0.01)) == { "answer": "100", "agents": {"agent_sql": "100"} }
+
+def test_preallocated_vectors(cache):
+    cache.add("first", vector(1, 0), "first answer", {})
+    vectors = cache.vectors
+    assert vectors.shape == (2, 2)
+
+    # Lookups and evictions reuse the same matrix, a new entry takes the row of the evicted one
+    cache.add("second", vector(0, 1), "second answer", {})
+    cache.lookup(vector(0, 1))
+    cache.add("third", vector(1, 1), "third answer", {})
+    assert cache.vectors is vectors
+    assert cache.entries[2]["row"] == 0
+    assert cache.lookup(vector(1, 0)) is None
+    assert cache.lookup(vector(1, 1))["answer"] == "third answer"
+
+def test_shared_invalidations(tmp_path):
+    # Two workers share the invalidations file
+    path = str(tmp_path / "cache_invalidations.sqlite")
+    first = SemanticCache(AsyncMock(), invalidations=InvalidationLog(path, check_interval=0))
+    second = SemanticCache(AsyncMock(), invalidations=InvalidationLog(path, check_interval=0))
+    for cache in (first, second):
+        cache.add("question 1", [1.0, 0.0], "answer 1", {"agent_1": "answer 1"})
+        cache.add("question 2", [0.0, 1.0], "answer 2", {"agent_2": "answer 2"})
+
+    # The answers of an agent dropped by one worker are dropped by the other one before its next lookup
+    assert first.invalidate("agent_1") == 1
+    assert second.lookup(np.array([1.0, 0.0], dtype=np.float32)) is None
+    assert second.lookup(np.array([0.0, 1.0], dtype=np.float32))["answer"] == "answer 2"
+
+    # A worker doesn't apply its own invalidations again
+    first.add("question 1", [1.0, 0.0], "answer 1", {"agent_1": "answer 1"})
+    assert first.lookup(np.array([1.0, 0.0], dtype=np.float32))["answer"] == "answer 1"
+
+    # Without an agent every answer is dropped
+    second.invalidate()
+    assert first.lookup(np.array([0.0, 1.0], dtype=np.float32)) is None
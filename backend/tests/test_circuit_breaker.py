@@ -0,0 +1,107 @@
+import pytest
+import time
+from unittest.mock import MagicMock, patch
+from modules.circuit_breaker import CircuitBreaker, CircuitBreakers, CircuitOpenError
+from modules.deadline import agent_deadline, DeadlineExceeded
+from modules import metrics
+
+@pytest.fixture
+def breaker():
+    return CircuitBreaker("agent_test.database", failure_threshold=2, reset_timeout=30, retries=2, backoff=0)
+
+def test_retry_transient(breaker):
+    func = MagicMock(side_effect=[ConnectionError("reset"), TimeoutError("slow"), "result"])
+    assert breaker.call(func, "query") == "result"
+    assert func.call_count == 3
+    assert breaker.status()["failures"] == 0
+
+def test_no_retry(breaker):
+    # Errors that are not transient fail right away
+    func = MagicMock(side_effect=ValueError("wrong"))
+    with pytest.raises(ValueError):
+        breaker.call(func)
+    func.assert_called_once()
+    assert breaker.status()["failures"] == 1
+
+def test_backoff(breaker):
+    breaker.backoff, breaker.max_backoff = 1, 3
+    with patch('modules.circuit_breaker.random.uniform', side_effect=lambda low, high: high):
+        assert [breaker.get_delay(attempt) for attempt in range(4)] == [1, 2, 3, 3]
+
+def test_open(breaker):
+    func = MagicMock(side_effect=ValueError("down"))
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            breaker.call(func)
+
+    # Once open, the backend is not called at all
+    assert breaker.is_available() is False
+    with pytest.raises(CircuitOpenError):
+        breaker.call(func)
+    assert func.call_count == 2
+    assert breaker.status()["state"] == "open"
+    assert metrics.circuit_breaker_state.values[("agent_test.database",)] == 2
+
+def test_half_open(breaker):
+    breaker.retries = 0
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            breaker.call(MagicMock(side_effect=ConnectionError("down")))
+
+    with patch('modules.circuit_breaker.time.monotonic', return_value=breaker.opened + 31):
+        assert breaker.is_available() is True
+
+        # A single trial call fails, so the circuit opens again
+        with pytest.raises(ConnectionError):
+            breaker.call(MagicMock(side_effect=ConnectionError("still down")))
+        assert breaker.is_available() is False
+
+    with patch('modules.circuit_breaker.time.monotonic', return_value=breaker.opened + 31):
+        assert breaker.call(MagicMock(return_value="up")) == "up"
+    assert breaker.status() == { "state": "closed", "failures": 0, "retry_in": None }
+
+def test_ignore(breaker):
+    # Errors that are not the backend fault don't count
+    breaker.ignore = (KeyError,)
+    for _ in range(3):
+        with pytest.raises(KeyError):
+            breaker.call(MagicMock(side_effect=KeyError("file")))
+    assert breaker.is_available() is True
+
+def test_deadline(breaker):
+    func = MagicMock(side_effect=ConnectionError("reset"))
+
+    # An agent out of time doesn't call its backend
+    token = agent_deadline.set(time.monotonic() - 1)
+    try:
+        with pytest.raises(DeadlineExceeded):
+            breaker.call(func)
+        func.assert_not_called()
+    finally:
+        agent_deadline.reset(token)
+
+    # The transient errors are not retried past the deadline
+    token = agent_deadline.set(time.monotonic() + 0.05)
+    sleep = time.sleep
+    try:
+        with patch('modules.circuit_breaker.time.sleep', side_effect=lambda delay: sleep(0.1)):
+            with pytest.raises(ConnectionError):
+                breaker.call(func)
+    finally:
+        agent_deadline.reset(token)
+    assert func.call_count == 2
+
+def test_disabled():
+    breaker = CircuitBreaker("agent_test.api", enabled=False, failure_threshold=1)
+    func = MagicMock(side_effect=ConnectionError("down"))
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            breaker.call(func)
+    assert func.call_count == 2
+
+def test_registry():
+    breakers = CircuitBreakers(default={ "retries": 1 }, backends={ "database": { "reset_timeout": 10 }, "agent_sql.database": { "failure_threshold": 3 } })
+    breaker = breakers.get("agent_sql", "database", ignore=(KeyError,))
+    assert (breaker.retries, breaker.reset_timeout, breaker.failure_threshold, breaker.ignore) == (1, 10, 3, (KeyError,))
+    assert breakers.get("agent_rag", "vector_store").reset_timeout == 30
+    assert breakers.status()["agent_sql.database"]["state"] == "closed"
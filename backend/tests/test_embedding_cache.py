@@ -0,0 +1,81 @@
+import asyncio
+import numpy as np
+from unittest.mock import MagicMock, AsyncMock
+from modules.embedding_cache import CachedEmbeddings, EmbeddingStore, get_key
+from modules import metrics
+
+def make_embeddings():
+    return MagicMock(
+        embed_query=MagicMock(side_effect=lambda text: [float(len(text)), 0.5]),
+        embed_documents=MagicMock(side_effect=lambda texts: [[float(len(text)), 0.5] for text in texts]),
+        aembed_query=AsyncMock(side_effect=lambda text: [float(len(text)), 0.5])
+    )
+
+def test_get_key():
+    # Spacing doesn't matter, the model and the case do
+    assert get_key("ada-002", " What is  RAG?\n") == get_key("ada-002", "What is RAG?")
+    assert get_key("ada-002", "What is RAG?") != get_key("ada-002", "what is rag?")
+    assert get_key("ada-002", "What is RAG?") != get_key("models/embedding-001", "What is RAG?")
+    # Questions and documents are embedded separately
+    assert get_key("ada-002", "What is RAG?") != get_key("ada-002", "What is RAG?", "document")
+
+def test_embed_query():
+    embeddings = make_embeddings()
+    cached = CachedEmbeddings(embeddings, "ada-002", EmbeddingStore())
+
+    assert cached.embed_query("question") == [8.0, 0.5]
+    assert cached.embed_query("question ") == [8.0, 0.5]
+    assert asyncio.run(cached.aembed_query("question")) == [8.0, 0.5]
+    embeddings.embed_query.assert_called_once_with("question")
+    embeddings.aembed_query.assert_not_awaited()
+
+    # Vectors are kept as compact float32 arrays
+    vector = cached.store.get(get_key("ada-002", "question"))
+    assert vector.dtype == np.float32
+    assert cached.store.stats() == { "memory_hit": 3, "disk_hit": 0, "miss": 1, "hit_rate": 0.75 }
+    assert metrics.embedding_cache_requests.values[("memory_hit",)] >= 3
+
+def test_embed_documents():
+    embeddings = make_embeddings()
+    cached = CachedEmbeddings(embeddings, "ada-002", EmbeddingStore())
+    cached.embed_documents(["b"])
+    cached.embed_query("a")
+
+    # Only the documents not cached are embedded, in a single call
+    assert cached.embed_documents(["a", "b", "ccc"]) == [[1.0, 0.5], [1.0, 0.5], [3.0, 0.5]]
+    embeddings.embed_documents.assert_called_with(["a", "ccc"])
+
+def test_disk(tmp_path):
+    path = str(tmp_path / "embedding_cache.sqlite")
+    store = EmbeddingStore(path, max_disk_entries=2)
+    store.set("key1", [1.0, 2.0])
+    store.set("key2", [3.0, 4.0])
+
+    # A new store, as after a restart, reads the vectors from the file
+    store = EmbeddingStore(path, max_disk_entries=2)
+    assert store.get("key1").tolist() == [1.0, 2.0]
+    assert store.stats()["disk_hit"] == 1
+
+    # The oldest vectors over the limit are dropped
+    store.set("key3", [5.0, 6.0])
+    store.flush()
+    store = EmbeddingStore(path, max_disk_entries=2)
+    assert store.get("key1") is None
+    assert store.get("key2").tolist() == [3.0, 4.0]
+    assert store.get("key3").tolist() == [5.0, 6.0]
+
+def test_disk_shared(tmp_path):
+    # The workers of the server share the file, each one reads the vectors of the others by their key
+    path = str(tmp_path / "embedding_cache.sqlite")
+    first, second = EmbeddingStore(path), EmbeddingStore(path)
+    first.set("key1", [1.0, 1.0, 1.0])
+    second.set("key2", [2.0, 2.0, 2.0])
+    first.set("key3", [3.0, 3.0, 3.0])
+    assert second.get("key1").tolist() == [1.0, 1.0, 1.0]
+    assert second.get("key2").tolist() == [2.0, 2.0, 2.0]
+    assert first.get("key2").tolist() == [2.0, 2.0, 2.0]
+    assert second.get("key4") is None
+
+    # Vectors of another size come from another embeddings model, they have other keys
+    first.set("key5", [1.0, 2.0])
+    assert second.get("key5").tolist() == [1.0, 2.0]
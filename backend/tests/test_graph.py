@@ -1,7 +1,15 @@
 import pytest
-from unittest.mock import MagicMock, patch, call
-from modules.models import State
-from modules.graph import Graph
+import asyncio
+import time
+import threading
+from unittest.mock import MagicMock, AsyncMock, patch, call, ANY
+from langchain_core.caches import InMemoryCache
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from pydantic import ValidationError
+from modules.models import State, QuestionModel
+from modules.graph import Graph, TIMEOUT_ANSWER
+from modules.deadline import check_deadline, DeadlineExceeded
+from modules.summarizer import Summarizer
 
 @pytest.fixture
 def mock_supervisor():
@@ -42,14 +50,23 @@ def test_graph_initialization(mock_supervisor, mock_summarizer, mock_agents):
 
         # Verify nodes are added
         calls_add_node = [
-            call("supervisor_agent_filter_node", mock_supervisor.get_relevant_agents),
+            call("supervisor_agent_filter_node", MockRunnableLambda.return_value),
             call("supervisor_agent_picker_node", mock_supervisor.generate_answer),
-            call("summarizer_node", mock_summarizer.generate_answer),
-            call("agent1_node", mock_agents[0].generate_answer),
-            call("agent2_node", mock_agents[1].generate_answer),
+            call("summarizer_node", MockRunnableLambda.return_value),
+            call("agent1_node", MockRunnableLambda.return_value),
+            call("agent2_node", MockRunnableLambda.return_value),
         ]
         MockStateGraph.return_value.add_node.assert_has_calls(calls_add_node, any_order=True)
 
+        # Verify the nodes that call an LLM have both a sync and an async implementation
+        calls_runnable_lambda = [
+            call(mock_supervisor.get_relevant_agents, afunc=mock_supervisor.aget_relevant_agents),
+            call(mock_summarizer.generate_answer, afunc=mock_summarizer.agenerate_answer),
+            call(mock_agents[0].generate_answer, afunc=ANY),
+            call(mock_agents[1].generate_answer, afunc=ANY),
+        ]
+        MockRunnableLambda.assert_has_calls(calls_runnable_lambda, any_order=True)
+
         # Verify conditional edges
         MockStateGraph.return_value.add_conditional_edges.assert_called_once_with(
             "supervisor_agent_picker_node",
@@ -70,4 +87,305 @@ def test_graph_initialization(mock_supervisor, mock_summarizer, mock_agents):
 
         # Verify entry point and graph compilation
         MockStateGraph.return_value.set_entry_point.assert_called_once_with("supervisor_agent_filter_node")
-        MockStateGraph.return_value.compile.assert_called_once()
\ No newline at end of file
+        MockStateGraph.return_value.compile.assert_called_once()
+
+def test_graph_initialization_fan_out(mock_supervisor, mock_summarizer, mock_agents):
+    with patch("modules.graph.StateGraph") as MockStateGraph, \
+         patch("modules.graph.RunnableLambda") as MockRunnableLambda:
+
+        MockStateGraph.return_value = MagicMock()
+
+        # Create the Graph instance in fan-out mode
+        Graph(mock_supervisor, mock_summarizer, mock_agents, parallel=True)
+
+        # Verify nodes are added, there is no picker node
+        calls_add_node = [
+            call("supervisor_agent_filter_node", MockRunnableLambda.return_value),
+            call("supervisor_join_node", mock_supervisor.join_answers),
+            call("summarizer_node", MockRunnableLambda.return_value),
+            call("agent1_node", MockRunnableLambda.return_value),
+            call("agent2_node", MockRunnableLambda.return_value),
+        ]
+        MockStateGraph.return_value.add_node.assert_has_calls(calls_add_node, any_order=True)
+        assert call("supervisor_agent_picker_node", mock_supervisor.generate_answer) not in MockStateGraph.return_value.add_node.call_args_list
+
+        # Verify all the agents are reachable at once from the filter node
+        MockRunnableLambda.assert_any_call(mock_supervisor.get_pending_agents)
+        MockStateGraph.return_value.add_conditional_edges.assert_called_once_with(
+            "supervisor_agent_filter_node",
+            MockRunnableLambda.return_value,
+            {
+                "agent1": "agent1_node",
+                "agent2": "agent2_node",
+                "FINISH": "supervisor_join_node",
+            }
+        )
+
+        # Verify every agent goes to the join node, and the join node to the summarizer
+        calls_add_edge = [
+            call("agent1_node", "supervisor_join_node"),
+            call("agent2_node", "supervisor_join_node"),
+            call("supervisor_join_node", "summarizer_node"),
+        ]
+        MockStateGraph.return_value.add_edge.assert_has_calls(calls_add_edge, any_order=True)
+
+        # Verify entry point and graph compilation
+        MockStateGraph.return_value.set_entry_point.assert_called_once_with("supervisor_agent_filter_node")
+        MockStateGraph.return_value.compile.assert_called_once()
+
+def test_graph_fan_out_invoke(mock_summarizer, mock_agents):
+    # Agents report their answers concurrently, each one only with its own entry
+    supervisor = MagicMock()
+    supervisor.get_relevant_agents.return_value = {"relevant_agents": ["agent1", "agent2"]}
+    supervisor.get_pending_agents.return_value = ["agent1", "agent2"]
+    supervisor.join_answers.return_value = {}
+    mock_agents[0].generate_answer.return_value = {"agents": {"agent1": "answer 1"}}
+    mock_agents[1].generate_answer.return_value = {"agents": {"agent2": "answer 2"}}
+    mock_summarizer.generate_answer.return_value = {"answer": "final answer"}
+
+    graph = Graph(supervisor, mock_summarizer, mock_agents, parallel=True)
+    result = graph.invoke({"question": "test question", "history": []})
+
+    # Assert both answers were merged and the summarizer ran once
+    assert result["agents"] == {"agent1": "answer 1", "agent2": "answer 2"}
+    assert result["answer"] == "final answer"
+    supervisor.join_answers.assert_called_once()
+    mock_summarizer.generate_answer.assert_called_once()
+
+
+def test_graph_ainvoke(mock_summarizer, mock_agents):
+    # The async implementations are used when the graph runs with ainvoke
+    supervisor = MagicMock()
+    supervisor.aget_relevant_agents = AsyncMock(return_value={"relevant_agents": ["agent1"]})
+    supervisor.get_pending_agents.return_value = ["agent1"]
+    supervisor.join_answers.return_value = {}
+    mock_agents[0].agenerate_answer = AsyncMock(return_value={"agents": {"agent1": "async answer"}})
+    mock_summarizer.agenerate_answer = AsyncMock(return_value={"answer": "final answer"})
+
+    graph = Graph(supervisor, mock_summarizer, mock_agents, parallel=True)
+    result = asyncio.run(graph.ainvoke({"question": "test question", "history": []}))
+
+    assert result["agents"] == {"agent1": "async answer"}
+    assert result["answer"] == "final answer"
+    supervisor.get_relevant_agents.assert_not_called()
+    mock_agents[0].generate_answer.assert_not_called()
+    mock_summarizer.generate_answer.assert_not_called()
+
+def test_graph_astream(mock_agents):
+    supervisor = MagicMock()
+    supervisor.aget_relevant_agents = AsyncMock(return_value={"relevant_agents": ["agent1", "agent2"]})
+    supervisor.get_pending_agents.return_value = ["agent1", "agent2"]
+    supervisor.join_answers.return_value = {}
+    mock_agents[0].agenerate_answer = AsyncMock(return_value={"agents": {"agent1": "answer 1"}})
+    mock_agents[1].agenerate_answer = AsyncMock(return_value={"agents": {"agent2": "answer 2"}})
+
+    # Use a summarizer backed by a fake model that streams its answer
+    with patch('modules.summarizer.get_llm') as MockLLM:
+        MockLLM.return_value = GenericFakeChatModel(messages=iter(["final answer"]))
+        summarizer = Summarizer()
+
+    graph = Graph(supervisor, summarizer, mock_agents, parallel=True)
+
+    async def collect():
+        return [event async for event in graph.astream({"question": "test question", "history": []})]
+    events = asyncio.run(collect())
+
+    # Assert the supervisor decision is reported first
+    assert events[0] == ("agents", ["agent1", "agent2"])
+
+    # Assert each agent answer is reported
+    assert ("agent", {"agent1": "answer 1"}) in events
+    assert ("agent", {"agent2": "answer 2"}) in events
+
+    # Assert the summarizer answer is streamed token by token
+    tokens = [data for event, data in events if event == "token"]
+    assert len(tokens) > 1
+    assert "".join(tokens) == "final answer"
+
+    # Assert the final state comes last
+    assert events[-1][0] == "end"
+    assert events[-1][1]["answer"] == "final answer"
+    assert events[-1][1]["agents"] == {"agent1": "answer 1", "agent2": "answer 2"}
+
+def test_graph_astream_cached(mock_agents):
+    supervisor = MagicMock()
+    supervisor.aget_relevant_agents = AsyncMock(return_value={"relevant_agents": ["agent1"]})
+    supervisor.get_pending_agents.return_value = ["agent1"]
+    supervisor.join_answers.return_value = {}
+    mock_agents[0].agenerate_answer = AsyncMock(return_value={"agents": {"agent1": "answer 1"}})
+
+    # The summarizer model answers from the LLM responses cache the second time
+    with patch('modules.summarizer.get_llm') as MockLLM:
+        MockLLM.return_value = GenericFakeChatModel(messages=iter(["final answer"]), cache=InMemoryCache())
+        summarizer = Summarizer()
+    graph = Graph(supervisor, summarizer, mock_agents, parallel=True)
+
+    async def collect():
+        return [event async for event in graph.astream({"question": "test question", "history": []})]
+    assert "".join(data for event, data in asyncio.run(collect()) if event == "token") == "final answer"
+
+    # Assert the cached answer is sent as a single token
+    events = asyncio.run(collect())
+    assert [data for event, data in events if event == "token"] == ["final answer"]
+    assert events[-1][1]["answer"] == "final answer"
+
+def test_graph_summarizer_bypass(mock_agents):
+    supervisor = MagicMock()
+    supervisor.get_relevant_agents.return_value = {"relevant_agents": ["agent1", "agent2"]}
+    supervisor.generate_answer.side_effect = [{"next": "agent1"}, {"next": "agent2"}, {"next": "FINISH"}]
+    supervisor.join_answers.return_value = {}
+    mock_agents[0].generate_answer.return_value = {"agents": {"agent1": "answer 1"}}
+    mock_agents[1].generate_answer.return_value = {"agents": {"agent2": "I don't know"}}
+
+    with patch('modules.summarizer.get_llm') as MockLLM:
+        MockLLM.return_value = MagicMock()
+        summarizer = Summarizer()
+
+    # Only one agent provided a real answer, so the summarizer LLM is not called
+    graph = Graph(supervisor, summarizer, mock_agents, bypass_summarizer=True)
+    result = graph.invoke({"question": "test question", "history": []})
+
+    assert result["answer"] == "answer 1"
+    MockLLM.return_value.assert_not_called()
+    supervisor.join_answers.assert_called_once()
+
+def test_graph_agent_deadline(mock_summarizer, mock_agents):
+    supervisor = MagicMock()
+    supervisor.aget_relevant_agents = AsyncMock(return_value={"relevant_agents": ["agent1", "agent2"]})
+    supervisor.get_pending_agents.return_value = ["agent1", "agent2"]
+    supervisor.join_answers.return_value = {}
+    mock_summarizer.agenerate_answer = AsyncMock(return_value={"answer": "final answer"})
+
+    # The second agent takes longer than the time available
+    async def slow_answer(state):
+        await asyncio.sleep(5)
+        return {"agents": {"agent2": "answer 2"}}
+    mock_agents[0].agenerate_answer = AsyncMock(return_value={"agents": {"agent1": "answer 1"}})
+    mock_agents[1].agenerate_answer = slow_answer
+
+    graph = Graph(supervisor, mock_summarizer, mock_agents, parallel=True, summarizer_reserve=0.1)
+    result = asyncio.run(graph.ainvoke({"question": "test question", "history": [], "deadline": time.monotonic() + 0.3}))
+
+    # Assert the slow agent was cut off and the summarizer used what arrived in time
+    assert result["agents"] == {"agent1": "answer 1", "agent2": TIMEOUT_ANSWER}
+    assert result["timed_out"] == ["agent2"]
+    assert result["answer"] == "final answer"
+
+def test_graph_agent_deadline_thread(mock_summarizer, mock_agents):
+    supervisor = MagicMock()
+    supervisor.aget_relevant_agents = AsyncMock(return_value={"relevant_agents": ["agent1"]})
+    supervisor.get_pending_agents.return_value = ["agent1"]
+    supervisor.join_answers.return_value = {}
+    mock_summarizer.agenerate_answer = AsyncMock(return_value={"answer": "final answer"})
+
+    # The agent keeps working in a thread after it is cancelled, and then calls its backend
+    finished = threading.Event()
+    errors = []
+    def work():
+        time.sleep(0.3)
+        try:
+            check_deadline()
+        except DeadlineExceeded as e:
+            errors.append(e)
+        finished.set()
+    async def answer(state):
+        await asyncio.to_thread(work)
+        return {"agents": {"agent1": "answer 1"}}
+    mock_agents[0].agenerate_answer = answer
+
+    graph = Graph(supervisor, mock_summarizer, mock_agents, parallel=True)
+    result = asyncio.run(graph.ainvoke({"question": "test question", "history": [], "deadline": time.monotonic() + 0.1}))
+    assert result["timed_out"] == ["agent1"]
+
+    # Assert the thread sees the deadline of the agent, so the backend is not called
+    assert finished.wait(1)
+    assert len(errors) == 1
+
+def test_get_agent_budget(mock_supervisor, mock_summarizer, mock_agents):
+    deadline = time.monotonic() + 100
+
+    # Agents running in parallel can use all the time left, except the summarizer reserve
+    graph = Graph(mock_supervisor, mock_summarizer, mock_agents, parallel=True, summarizer_reserve=10)
+    assert 89 < graph.get_agent_budget({"deadline": deadline, "relevant_agents": ["agent1", "agent2"]}) <= 90
+
+    # Agents running one after another share the time left
+    graph = Graph(mock_supervisor, mock_summarizer, mock_agents, summarizer_reserve=10)
+    assert 44 < graph.get_agent_budget({"deadline": deadline, "relevant_agents": ["agent1", "agent2"]}) <= 45
+    assert 89 < graph.get_agent_budget({"deadline": deadline, "relevant_agents": ["agent1", "agent2"], "agents": {"agent1": "answer 1"}}) <= 90
+
+    # There is no limit without a deadline
+    assert graph.get_agent_budget({"relevant_agents": ["agent1", "agent2"]}) is None
+
+def test_get_agent_budget_short_timeout(mock_supervisor, mock_summarizer, mock_agents):
+    # A timeout below the summarizer reserve still leaves most of the time to the agents
+    graph = Graph(mock_supervisor, mock_summarizer, mock_agents, parallel=True, summarizer_reserve=10)
+    assert 3.5 < graph.get_agent_budget({"deadline": time.monotonic() + 5, "relevant_agents": ["agent1"]}) <= 3.75
+
+def test_question_timeout():
+    # Requests can't ask for a timeout the agents could never meet
+    with pytest.raises(ValidationError):
+        QuestionModel(question="test question", session_id="1", timeout=0)
+
+def test_graph_speculative_routing(mock_summarizer, mock_agents):
+    supervisor = MagicMock()
+    supervisor.get_pending_agents.return_value = ["agent1"]
+    supervisor.join_answers.return_value = {}
+    mock_summarizer.agenerate_answer = AsyncMock(return_value={"answer": "final answer"})
+    mock_agents[0].agenerate_answer = AsyncMock(return_value={"agents": {"agent1": "answer 1"}})
+
+    # Both agents start prefetching while the supervisor is routing
+    prefetch_started = []
+    prefetch_cancelled = []
+    async def prefetch(name, delay):
+        prefetch_started.append(name)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            prefetch_cancelled.append(name)
+            raise
+        return {"context": f"{name} context"}
+    mock_agents[0].aprefetch = lambda state: prefetch("agent1", 0.1)
+    mock_agents[1].aprefetch = lambda state: prefetch("agent2", 5)
+
+    async def route(state):
+        await asyncio.sleep(0.05)
+        assert prefetch_started == ["agent1", "agent2"]
+        return {"relevant_agents": ["agent1"]}
+    supervisor.aget_relevant_agents = route
+
+    graph = Graph(supervisor, mock_summarizer, mock_agents, parallel=True, speculative=True)
+    result = asyncio.run(graph.ainvoke({"question": "test question", "history": []}))
+
+    # Assert the work of the picked agent is kept and the rest is cancelled
+    assert result["prefetched"] == {"agent1": {"context": "agent1 context"}}
+    assert prefetch_cancelled == ["agent2"]
+    assert mock_agents[0].agenerate_answer.call_args[0][0]["prefetched"] == {"agent1": {"context": "agent1 context"}}
+
+def test_graph_speculative_routing_deadline(mock_summarizer, mock_agents):
+    supervisor = MagicMock()
+    supervisor.get_pending_agents.return_value = ["agent1"]
+    supervisor.join_answers.return_value = {}
+    supervisor.aget_relevant_agents = AsyncMock(return_value={"relevant_agents": ["agent1"]})
+    mock_summarizer.agenerate_answer = AsyncMock(return_value={"answer": "final answer"})
+    mock_agents[0].agenerate_answer = AsyncMock(return_value={"agents": {"agent1": "answer 1"}})
+
+    # The prefetch of the picked agent hangs
+    prefetch_cancelled = []
+    async def prefetch(state):
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            prefetch_cancelled.append("agent1")
+            raise
+    mock_agents[0].aprefetch = prefetch
+    mock_agents[1].aprefetch = AsyncMock(return_value={})
+
+    graph = Graph(supervisor, mock_summarizer, mock_agents, parallel=True, speculative=True)
+    start = time.monotonic()
+    result = asyncio.run(graph.ainvoke({"question": "test question", "history": [], "deadline": time.monotonic() + 0.3}))
+
+    # Assert the prefetch is dropped within the deadline and the agent still answers
+    assert time.monotonic() - start < 1
+    assert result["prefetched"] == {}
+    assert prefetch_cancelled == ["agent1"]
+    mock_agents[0].agenerate_answer.assert_called_once()
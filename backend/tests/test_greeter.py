@@ -1,12 +1,17 @@
 import pytest
+import asyncio
 from unittest.mock import MagicMock, patch
 from modules.greeter import Greeter
 
 @pytest.fixture
-def greeter():
-    with patch('modules.greeter.AzureChatOpenAI') as MockLLM:
+def mock_llm():
+    return MagicMock()
+
+@pytest.fixture
+def greeter(mock_llm):
+    with patch('modules.greeter.get_llm') as MockLLM:
         # Mock the LLM
-        MockLLM.return_value = MagicMock()
+        MockLLM.return_value = mock_llm
         # Mock available agents
         MockAgent1 = MagicMock()
         MockAgent2 = MagicMock()
@@ -18,17 +23,27 @@ def greeter():
 
         return Greeter(agents)
 
-def test_generate_answer(greeter):
+def test_generate_answer(greeter, mock_llm):
     # Mock LLM response
     mock_answer = "This is a test answer"
-    greeter.llm.return_value = mock_answer
+    mock_llm.return_value = mock_answer
 
     # Call the method under test
     response = greeter.generate_answer()
     
     # Assert that the skills of each agent were used when generating an answer
-    assert "Agent 1 skills" in greeter.llm.call_args[0][0].messages[0].content
-    assert "Agent 2 skills" in greeter.llm.call_args[0][0].messages[0].content
+    assert "Agent 1 skills" in mock_llm.call_args[0][0].messages[0].content
+    assert "Agent 2 skills" in mock_llm.call_args[0][0].messages[0].content
+
+    # Assert the final answer
+    assert response == {"answer": mock_answer}
+
+def test_agenerate_answer(greeter, mock_llm):
+    # Mock LLM response
+    mock_llm.return_value = "This is a test answer"
+
+    # Call the method under test
+    response = asyncio.run(greeter.agenerate_answer())
 
     # Assert the final answer
-    assert response == {"answer": mock_answer}
\ No newline at end of file
+    assert response == {"answer": "This is a test answer"}
@@ -0,0 +1,58 @@
+import asyncio
+import time
+from unittest.mock import MagicMock
+from modules.health import HealthMonitor
+from modules import metrics
+
+def make_agent(name, check_connection):
+    agent = MagicMock(check_connection=check_connection)
+    agent.name = name
+    return agent
+
+def test_probe_all():
+    agents = [
+        make_agent("agent_up", MagicMock(return_value={ "healthy": True, "info": "up and running" })),
+        make_agent("agent_down", MagicMock(return_value={ "healthy": False, "info": Exception("refused") })),
+        make_agent("agent_error", MagicMock(side_effect=Exception("boom")))
+    ]
+    monitor = HealthMonitor(agents)
+    assert monitor.get_status()[0]["checked_at"] is None
+
+    status = asyncio.run(monitor.probe_all())
+    assert [(agent["agent"], agent["healthy"], agent["info"]) for agent in status] == [("agent_up", True, "up and running"), ("agent_down", False, "refused"), ("agent_error", False, "boom")]
+    assert all(agent["checked_at"] is not None and agent["latency"] >= 0 for agent in status)
+    assert metrics.agent_healthy.values[("agent_up",)] == 1
+    assert metrics.agent_healthy.values[("agent_down",)] == 0
+
+def test_probe_timeout():
+    # The slow probes run at the same time, each with its own timeout
+    slow = MagicMock(side_effect=lambda: time.sleep(0.3) or { "healthy": True, "info": "" })
+    agents = [make_agent("agent_slow", slow), make_agent("agent_slow_2", slow)]
+    monitor = HealthMonitor(agents, timeout=0.1)
+
+    async def run():
+        start = time.perf_counter()
+        status = await monitor.probe_all()
+        elapsed = time.perf_counter() - start
+
+        # A backend that still hangs doesn't get a second probe
+        await monitor.probe(agents[0])
+        return status, elapsed
+
+    status, elapsed = asyncio.run(run())
+    assert elapsed < 0.25
+    assert status[0] == { **status[0], "healthy": False, "info": "timed out after 0.1s" }
+    assert slow.call_count == 2
+
+def test_start_stop():
+    agent = make_agent("agent_up", MagicMock(return_value={ "healthy": True, "info": "" }))
+    monitor = HealthMonitor([agent], interval=0.01)
+
+    async def run():
+        monitor.start()
+        await asyncio.sleep(0.05)
+        await monitor.stop()
+
+    asyncio.run(run())
+    assert agent.check_connection.call_count >= 2
+    assert monitor.task is None
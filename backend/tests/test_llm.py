@@ -0,0 +1,83 @@
+import pytest
+import asyncio
+from unittest.mock import patch
+from modules.llm import LLMRegistry, InFlightTracker, get_llm
+from modules import metrics
+
+@pytest.fixture
+def registry():
+    with patch('modules.llm.AdmittedAzureChatOpenAI') as MockLLM:
+        MockLLM.side_effect = lambda **kwargs: kwargs
+        yield LLMRegistry(max_connections=10, max_keepalive_connections=5)
+
+def test_same_client(registry):
+    assert registry.get("gpt-4o") is registry.get("gpt-4o")
+    assert registry.get("gpt-4o", max_tokens=100) is registry.get("gpt-4o", max_tokens=100)
+    assert registry.get("gpt-4o", max_tokens=100) is not registry.get("gpt-4o")
+
+def test_pool_per_deployment(registry):
+    default = registry.get("gpt-4o")
+    limited = registry.get("gpt-4o", max_tokens=100)
+    mini = registry.get("gpt-4o-mini")
+
+    # Clients of the same deployment share the connection pool
+    assert default["http_async_client"] is limited["http_async_client"]
+    assert default["http_client"] is limited["http_client"]
+    assert default["http_async_client"] is not mini["http_async_client"]
+    assert limited["max_tokens"] == 100
+    assert default["api_version"] == "2023-06-01-preview"
+    assert len(registry.pools) == 2
+
+def test_in_flight(registry):
+    registry.get("gpt-4o")
+    tracker = registry.pools["gpt-4o"]["tracker"]
+    tracker.on_chat_model_start({}, [])
+    tracker.on_chat_model_start({}, [])
+    assert registry.in_flight() == { "gpt-4o": 2 }
+
+    tracker.on_llm_end(None)
+    tracker.on_llm_error(Exception())
+    assert registry.in_flight() == { "gpt-4o": 0 }
+
+def test_in_flight_gauge():
+    tracker = InFlightTracker("gauge-test")
+    tracker.on_chat_model_start({}, [])
+    assert metrics.llm_in_flight.values[("gauge-test",)] == 1
+    tracker.on_llm_end(None)
+    assert metrics.llm_in_flight.values[("gauge-test",)] == 0
+
+def test_aclose(registry):
+    client = registry.get("gpt-4o")
+    asyncio.run(registry.aclose())
+    assert client["http_async_client"].is_closed
+    assert client["http_client"].is_closed
+    assert registry.pools == {}
+    assert registry.get("gpt-4o") is not client
+
+def test_get_model():
+    registry = LLMRegistry(models={
+        "default": { "deployment_name": "gpt-4o" },
+        "chains": {
+            "entry_point_chain": { "deployment_name": "gpt-4o-mini", "max_tokens": 50 },
+            "agent_csv.entry_point_chain": { "deployment_name": "gpt-4o" }
+        }
+    })
+    assert registry.get_model("agent_rag", "entry_point_chain") == { "deployment_name": "gpt-4o-mini", "max_tokens": 50 }
+    assert registry.get_model("agent_csv", "entry_point_chain") == { "deployment_name": "gpt-4o" }
+    assert registry.get_model("agent_rag", "answer_generator_chain") == { "deployment_name": "gpt-4o" }
+
+    # Without configuration every chain keeps the default model
+    assert LLMRegistry().get_model("supervisor", "supervisor_chain") == { "deployment_name": "gpt-4o" }
+
+def test_get_llm():
+    registry = LLMRegistry(models={ "chains": { "entry_point_chain": { "deployment_name": "gpt-4o-mini", "max_tokens": 50 } } })
+    with patch('modules.llm.llm_registry', registry), \
+         patch('modules.llm.AdmittedAzureChatOpenAI') as MockLLM:
+        MockLLM.side_effect = lambda **kwargs: kwargs
+        entry_llm = get_llm("agent_rag", "entry_point_chain")
+        answer_llm = get_llm("agent_rag", "answer_generator_chain")
+
+    assert entry_llm["deployment_name"] == "gpt-4o-mini"
+    assert entry_llm["max_tokens"] == 50
+    assert answer_llm["deployment_name"] == "gpt-4o"
+    assert "max_tokens" not in answer_llm
@@ -0,0 +1,106 @@
+import pytest
+import asyncio
+from unittest.mock import patch
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_openai import AzureChatOpenAI
+from modules.llm_cache import LLMCache, ResponseStore
+from modules.llm import LLMRegistry
+from modules import metrics
+
+@pytest.fixture
+def generations():
+    return [ChatGeneration(message=AIMessage(content="answer"))]
+
+def test_lookup_update(generations):
+    cache = LLMCache(ResponseStore())
+    assert cache.lookup("prompt", "gpt-4o") is None
+
+    cache.update("prompt", "gpt-4o", generations)
+    assert cache.lookup("prompt", "gpt-4o") == generations
+
+    # Another model or prompt is another entry
+    assert cache.lookup("prompt", "gpt-4o-mini") is None
+    assert cache.lookup("other prompt", "gpt-4o") is None
+
+def test_ttl(generations):
+    cache = LLMCache(ResponseStore(), ttl=60)
+    cache.update("prompt", "gpt-4o", generations)
+    with patch('modules.llm_cache.time.time', return_value=10**12):
+        assert cache.lookup("prompt", "gpt-4o") is None
+
+    # Every chain can keep its responses for its own time in the same store
+    forever = cache.with_ttl(None)
+    assert forever.store is cache.store
+    forever.update("prompt", "gpt-4o", generations)
+    with patch('modules.llm_cache.time.time', return_value=10**12):
+        assert forever.lookup("prompt", "gpt-4o")[0].text == "answer"
+
+def test_disk(tmp_path, generations):
+    path = str(tmp_path / "llm_cache.sqlite")
+    LLMCache(ResponseStore(path)).update("prompt", "gpt-4o", generations)
+
+    # A new store, as after a restart, reads the responses from the file
+    cache = LLMCache(ResponseStore(path))
+    assert cache.lookup("prompt", "gpt-4o")[0].message.content == "answer"
+    assert metrics.llm_cache_requests.values[("disk_hit",)] >= 1
+
+    # The response is then kept in memory
+    cache.store.db = None
+    assert cache.lookup("prompt", "gpt-4o")[0].message.content == "answer"
+
+    cache = LLMCache(ResponseStore(path))
+    cache.clear()
+    assert LLMCache(ResponseStore(path)).lookup("prompt", "gpt-4o") is None
+
+def test_prune(tmp_path, generations):
+    path = str(tmp_path / "llm_cache.sqlite")
+    store = ResponseStore(path, max_disk_entries=2)
+    for index in range(3):
+        store.set(f"key{index}", generations)
+    store.set("expired", generations, ttl=-1)
+
+    store.prune()
+    keys = [row[0] for row in store.db.execute("SELECT key FROM responses")]
+    assert sorted(keys) == ["key1", "key2"]
+
+def test_async(tmp_path, generations):
+    cache = LLMCache(ResponseStore(str(tmp_path / "llm_cache.sqlite")))
+
+    async def run():
+        assert await cache.alookup("prompt", "gpt-4o") is None
+        await cache.aupdate("prompt", "gpt-4o", generations)
+        return await cache.alookup("prompt", "gpt-4o")
+
+    assert asyncio.run(run()) == generations
+    assert LLMCache(ResponseStore(str(tmp_path / "llm_cache.sqlite"))).lookup("prompt", "gpt-4o")[0].text == "answer"
+
+def test_chat_model(monkeypatch):
+    monkeypatch.setenv("AZURE_OPENAI_ENDPOINT", "https://example.openai.azure.com")
+    monkeypatch.setenv("AZURE_OPENAI_API_KEY", "key")
+    registry = LLMRegistry(cache=LLMCache(ResponseStore()))
+    result = ChatResult(generations=[ChatGeneration(message=AIMessage(content="answer"))])
+
+    with patch.object(AzureChatOpenAI, '_agenerate', return_value=result) as mock_generate:
+        llm = registry.get("gpt-4o")
+        first = asyncio.run(llm.ainvoke([HumanMessage(content="question")]))
+        second = asyncio.run(llm.ainvoke([HumanMessage(content="question")]))
+        assert first.content == second.content == "answer"
+        mock_generate.assert_called_once()
+
+        # A chain that opts out always calls the LLM
+        uncached = registry.get("gpt-4o", cache=False)
+        asyncio.run(uncached.ainvoke([HumanMessage(content="question")]))
+        assert mock_generate.call_count == 2
+
+def test_registry_cache():
+    cache = LLMCache(ResponseStore(), ttl=100)
+    with patch('modules.llm.AdmittedAzureChatOpenAI') as MockLLM:
+        MockLLM.side_effect = lambda **kwargs: kwargs
+        registry = LLMRegistry(cache=cache)
+        assert registry.get("gpt-4o")["cache"] is cache
+        assert registry.get("gpt-4o", cache=False)["cache"] is False
+        assert registry.get("gpt-4o", cache_ttl=10)["cache"].ttl == 10
+
+        # Without a cache configured no chain is cached
+        assert LLMRegistry().get("gpt-4o")["cache"] is False
@@ -0,0 +1,48 @@
+import json
+import logging
+from logging.handlers import QueueHandler
+from unittest.mock import patch
+from modules.logs import PayloadFilter, SamplingFilter, JsonFormatter, setup_logging
+
+def make_record(message, *args, level=logging.INFO):
+    return logging.LogRecord("modules.agent_sql", level, __file__, 1, message, args, None)
+
+def test_payload_filter():
+    record = make_record("Agent says:\n %s", "x" * 20)
+    assert PayloadFilter(max_length=15).filter(record)
+    assert record.getMessage() == "Agent says:\n xx... [18 more characters]"
+
+    # Short messages are left as they are
+    record = make_record("Agent says: %s", "ok")
+    PayloadFilter(max_length=15).filter(record)
+    assert record.getMessage() == "Agent says: ok"
+
+def test_sampling_filter():
+    sampling = SamplingFilter({ "DEBUG": 0.1 })
+    with patch('modules.logs.random.random', return_value=0.5):
+        assert not sampling.filter(make_record("payload", level=logging.DEBUG))
+        assert sampling.filter(make_record("message", level=logging.INFO))
+    with patch('modules.logs.random.random', return_value=0.05):
+        assert sampling.filter(make_record("payload", level=logging.DEBUG))
+
+def test_json_formatter():
+    entry = json.loads(JsonFormatter().format(make_record("Agent says: %s", "hi", level=logging.ERROR)))
+    assert entry["level"] == "ERROR"
+    assert entry["logger"] == "modules.agent_sql"
+    assert entry["message"] == "Agent says: hi"
+
+def test_setup_logging(capsys):
+    listener = setup_logging(level="WARNING", levels={ "modules.test_logs": "DEBUG" }, format="json", max_payload=10)
+    try:
+        logging.getLogger("modules.test_logs").debug("%s", "y" * 20)
+        logging.getLogger("modules.other").info("hidden")
+    finally:
+        # Stopping the listener writes the records still in the queue
+        listener.stop()
+        root = logging.getLogger()
+        for handler in [handler for handler in root.handlers if isinstance(handler, QueueHandler)]:
+            root.removeHandler(handler)
+        logging.getLogger("modules.test_logs").setLevel(logging.NOTSET)
+
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line)["message"] for line in lines] == ["yyyyyyyyyy... [10 more characters]"]
@@ -0,0 +1,43 @@
+from unittest.mock import patch
+from modules.lru_cache import LRUCache
+
+def test_get_set():
+    cache = LRUCache(max_entries=2)
+    cache.set("key", "value")
+    assert cache.get("key") == "value"
+    assert cache.get("unknown") is None
+    assert cache.get("unknown", "default") == "default"
+
+def test_lru_eviction():
+    cache = LRUCache(max_entries=2)
+    cache.set("first", 1)
+    cache.set("second", 2)
+
+    # The first one is used, so the second one is the least recently used
+    cache.get("first")
+    cache.set("third", 3)
+
+    assert cache.get("second") is None
+    assert cache.get("first") == 1
+    assert cache.get("third") == 3
+    assert len(cache) == 2
+
+def test_ttl():
+    cache = LRUCache(ttl=10)
+    with patch('modules.lru_cache.time') as MockTime:
+        MockTime.monotonic.return_value = 100
+        cache.set("key", "value")
+
+        MockTime.monotonic.return_value = 105
+        assert cache.get("key") == "value"
+
+        # Assert expired entries are dropped
+        MockTime.monotonic.return_value = 111
+        assert cache.get("key") is None
+        assert len(cache) == 0
+
+def test_clear():
+    cache = LRUCache()
+    cache.set("key", "value")
+    cache.clear()
+    assert len(cache) == 0
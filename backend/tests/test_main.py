@@ -1,7 +1,15 @@
 import pytest
-from unittest.mock import MagicMock, patch, call
-from main import generate_answer, store_feedback, get_feedback_count, get_chat_history, add_to_chat_history, delete_chat_history, ping_agents
-from modules.models import QuestionModel, AnswerModel, FeedbackModel
+from unittest.mock import MagicMock, AsyncMock, patch, call, ANY
+from main import generate_answer, store_feedback, get_feedback_count, get_chat_history, add_to_chat_history, delete_chat_history, ping_agents, aget_chat_history, aadd_to_chat_history, stream_answer, get_trace, get_metrics, ready, warm_up, build_component, invalidate_cache, batch_answer, warm_routing_cache
+from modules.tracing import TraceStore
+from modules.single_flight import SingleFlight
+from modules.answer_cache import SemanticCache
+from modules.routing_cache import RoutingCache
+from modules.health import HealthMonitor
+from fastapi import HTTPException
+import asyncio
+import json
+from modules.models import QuestionModel, AnswerModel, FeedbackModel, BatchModel
 from datetime import datetime
 
 
@@ -12,14 +20,22 @@ def mock_setup():
     mock_setup["graph"] = MagicMock()
     mock_setup["feedback_table"] = MagicMock()
     mock_setup["history_table"] = MagicMock()
+    mock_setup["async_history_table"] = MagicMock(create_entity=AsyncMock())
+    mock_setup["trace_store"] = TraceStore()
+    mock_setup["timings"] = {}
+    mock_setup["single_flight"] = SingleFlight()
+    mock_setup["answer_cache"] = SemanticCache(AsyncMock(return_value=[1.0, 0.0]))
+    mock_setup["summarizer"] = MagicMock(is_non_answer=MagicMock(return_value=False))
     MockAgent1 = MagicMock(check_connection=MagicMock())
     MockAgent2 = MagicMock(check_connection=MagicMock())
     agent_1 = MockAgent1.return_value
     agent_1.name = "agent1"
     agent_1.check_connection.return_value = {"healthy": True, "info": ""}
+    agent_1.is_ready.return_value = True
     agent_2 = MockAgent2.return_value
     agent_2.name = "agent2"
     agent_2.check_connection.return_value = {"healthy": False, "info": ""} 
+    agent_2.is_ready.return_value = False
     mock_setup["agents"] = [agent_1, agent_2]
     return mock_setup
 
@@ -42,10 +58,21 @@ class MockEntity(dict):
         self.__dict__ = self
 
 def test_ping_agents(mock_setup):
-    response = ping_agents(setup=mock_setup)
+    mock_setup["health_monitor"] = HealthMonitor(mock_setup["agents"])
+
+    # The agents not probed yet are probed before answering, they are never reported without a status
+    response = asyncio.run(ping_agents(setup=mock_setup))
     assert len(response) == 2
-    assert response[0] == {"agent": "agent1", "healthy": True, "info":""}
-    assert response[1] == {"agent": "agent2", "healthy": False, "info":""}
+    assert response[0] == {"agent": "agent1", "healthy": True, "info": "", "checked_at": ANY, "latency": ANY}
+    assert response[1] == {"agent": "agent2", "healthy": False, "info": "", "checked_at": ANY, "latency": ANY}
+
+    # Then the cached status is served
+    assert asyncio.run(ping_agents(setup=mock_setup)) == response
+    mock_setup["agents"][0].check_connection.assert_called_once()
+
+    # The agents are probed again when asked to refresh
+    asyncio.run(ping_agents(refresh=True, setup=mock_setup))
+    assert mock_setup["agents"][0].check_connection.call_count == 2
 
 def test_generate_answer(mock_setup):
     mock_question = "What is the capital of France?"
@@ -53,16 +80,26 @@ def test_generate_answer(mock_setup):
     mock_history = [{"role": "user", "content": "hi!"}, {"role": "bot", "content": "hi! how can I help you?"}]
     mock_session_id = "1234"
     mock_graph = mock_setup["graph"]
-    mock_graph.invoke.return_value = { "question": mock_question, "answer": mock_answer, "agents": {"agent_1": "agent answer", "agent_2": "agent answer"} }
+    mock_graph.ainvoke = AsyncMock(return_value={ "question": mock_question, "answer": mock_answer, "agents": {"agent_1": "agent answer", "agent_2": "agent answer"} })
     
     # Mock the interactions with the chat history
-    with patch('main.get_chat_history') as MockGetChatHistory, \
-         patch('main.add_to_chat_history') as MockAddToChatHistory:
+    with patch('main.aget_chat_history', new_callable=AsyncMock) as MockGetChatHistory, \
+         patch('main.aadd_to_chat_history', new_callable=AsyncMock) as MockAddToChatHistory:
         MockGetChatHistory.return_value = mock_history
         MockAddToChatHistory.return_value = None
 
         # Call the endpoint under test
-        response = generate_answer(body=QuestionModel(session_id=mock_session_id, question=mock_question), setup=mock_setup)
+        response = asyncio.run(generate_answer(body=QuestionModel(session_id=mock_session_id, question=mock_question), setup=mock_setup))
+
+        # Assert that the graph was run asynchronously
+        # The question is asked within a conversation, so the shared answer cache is not used
+        mock_graph.ainvoke.assert_awaited_once_with({ "question": mock_question, "history": mock_history, "deadline": ANY }, config={ "callbacks": [ANY] })
+
+        # Assert the request can be traced
+        assert "request_id" in response
+        trace = get_trace(response["request_id"], setup=mock_setup)
+        assert trace["request_id"] == response["request_id"]
+        assert [span["name"] for span in trace["trace"]["children"]] == ["history_read", "history_write"]
 
         # Assert that the returned value has the final answer
         assert "answer" in response
@@ -73,12 +110,239 @@ def test_generate_answer(mock_setup):
         assert "agent_1" in response["agents"]
         assert "agent_2" in response["agents"]
 
+        # Assert the agents that ran out of time are reported
+        assert response["timed_out"] == []
+
         # Assert that a call to retrieve the chat history was made
         MockGetChatHistory.assert_called_once()
 
         # Assert that a call to store the new chat in the history was made
         MockAddToChatHistory.assert_called_once()        
 
+def test_stream_answer(mock_setup):
+    mock_question = "What is the capital of France?"
+    mock_session_id = "1234"
+    mock_agents = {"agent_1": "agent answer"}
+
+    # Mock the graph progress
+    async def mock_astream(state, config=None):
+        yield "agents", ["agent_1"]
+        yield "agent", mock_agents
+        yield "token", "Par"
+        yield "token", "is"
+        yield "end", { "question": mock_question, "answer": "Paris", "agents": mock_agents }
+    mock_setup["graph"].astream = MagicMock(side_effect=mock_astream)
+
+    with patch('main.aget_chat_history', new_callable=AsyncMock) as MockGetChatHistory, \
+         patch('main.aadd_to_chat_history', new_callable=AsyncMock) as MockAddToChatHistory:
+        MockGetChatHistory.return_value = []
+
+        # Call the endpoint under test and consume the whole stream
+        async def collect():
+            response = await stream_answer(body=QuestionModel(session_id=mock_session_id, question=mock_question), setup=mock_setup)
+            return response, [chunk async for chunk in response.body_iterator]
+        response, chunks = asyncio.run(collect())
+
+        # Assert the response is a stream of events
+        assert response.media_type == "text/event-stream"
+        assert chunks[0] == 'event: agents\ndata: ["agent_1"]\n\n'
+        assert chunks[1] == 'event: agent\ndata: {"agent_1": "agent answer"}\n\n'
+        assert chunks[2] == 'event: token\ndata: "Par"\n\n'
+        assert chunks[3] == 'event: token\ndata: "is"\n\n'
+
+        # Assert the last event has the same payload as /api/ask
+        assert chunks[4].startswith("event: answer\n")
+        assert json.loads(chunks[4].split("data: ")[1]) == {"question": mock_question, "answer": "Paris", "session_id": mock_session_id, "agents": mock_agents, "timed_out": [], "unavailable": [], "request_id": ANY, "cached": False}
+
+        # Assert that the new chat was stored in the history
+        MockAddToChatHistory.assert_awaited_once()
+
+def test_batch_answer(mock_setup):
+    # The first question is slower, so its answer comes last
+    async def run_graph(state, config):
+        if state["question"] == "slow question":
+            await asyncio.sleep(0.05)
+        if state["question"] == "bad question":
+            raise ValueError("Mocked exception")
+        return { "question": state["question"], "answer": f"answer to {state['question']}", "agents": {"agent_1": "answer"} }
+    mock_setup["graph"].ainvoke = AsyncMock(side_effect=run_graph)
+    questions = [QuestionModel(session_id="1", question=question, use_cache=False) for question in ["slow question", "fast question", "bad question"]]
+
+    with patch('main.aget_chat_history', new_callable=AsyncMock) as MockGetChatHistory, \
+         patch('main.aadd_to_chat_history', new_callable=AsyncMock) as MockAddToChatHistory:
+        async def collect(body):
+            response = await batch_answer(body=body, setup=mock_setup)
+            return [chunk async for chunk in response.body_iterator]
+        chunks = asyncio.run(collect(BatchModel(questions=questions, concurrency=3)))
+
+        # Assert the answers are streamed as they complete, with the position of their question
+        events = [(chunk.split("\n")[0], json.loads(chunk.split("data: ")[1])) for chunk in chunks]
+        assert [(event, data["index"]) for event, data in events] == [("event: answer", 1), ("event: error", 2), ("event: answer", 0)]
+        assert events[2][1]["answer"] == "answer to slow question"
+        assert events[1][1]["detail"] == "Error: Mocked exception"
+
+        # Assert the history is not used unless requested
+        MockGetChatHistory.assert_not_awaited()
+        MockAddToChatHistory.assert_not_awaited()
+
+        asyncio.run(collect(BatchModel(questions=questions[:2], use_history=True)))
+        assert MockGetChatHistory.await_count == 2
+        assert MockAddToChatHistory.await_count == 2
+
+def test_batch_answer_concurrency(mock_setup):
+    running = []
+    max_running = []
+
+    async def run_graph(state, config):
+        running.append(1)
+        max_running.append(len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+        return { "question": state["question"], "answer": "answer", "agents": {} }
+    mock_setup["graph"].ainvoke = AsyncMock(side_effect=run_graph)
+    questions = [QuestionModel(session_id="1", question=f"question {i}", use_cache=False) for i in range(6)]
+
+    async def collect():
+        response = await batch_answer(body=BatchModel(questions=questions, concurrency=2), setup=mock_setup)
+        return [chunk async for chunk in response.body_iterator]
+
+    # Assert no more than the requested number of questions run at the same time
+    assert len(asyncio.run(collect())) == 6
+    assert max(max_running) == 2
+
+def test_batch_answer_too_large(mock_setup):
+    questions = [QuestionModel(session_id="1", question="question")] * 2
+    with patch.dict('main.batch_config', {"max_questions": 1}):
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(batch_answer(body=BatchModel(questions=questions), setup=mock_setup))
+    assert error.value.status_code == 400
+
+def test_generate_answer_coalesced(mock_setup):
+    mock_history = [{"role": "user", "content": "hi!"}, {"role": "bot", "content": "hi! how can I help you?"}]
+
+    async def run_graph(state, config):
+        await asyncio.sleep(0.05)
+        return { "question": state["question"], "answer": "Paris", "agents": {"agent_1": "Paris"} }
+    mock_setup["graph"].ainvoke = AsyncMock(side_effect=run_graph)
+
+    async def ask_concurrently():
+        return await asyncio.gather(
+            generate_answer(body=QuestionModel(session_id="1", question="What is the capital of France?"), setup=mock_setup),
+            generate_answer(body=QuestionModel(session_id="2", question="what is the capital  of France?"), setup=mock_setup)
+        )
+
+    with patch('main.aget_chat_history', new_callable=AsyncMock) as MockGetChatHistory, \
+         patch('main.aadd_to_chat_history', new_callable=AsyncMock) as MockAddToChatHistory:
+        MockGetChatHistory.return_value = mock_history
+        responses = asyncio.run(ask_concurrently())
+
+        # Assert the graph ran once for both questions, and each one got its own history record
+        mock_setup["graph"].ainvoke.assert_awaited_once()
+        assert [response["answer"] for response in responses] == ["Paris", "Paris"]
+        assert [response["session_id"] for response in responses] == ["1", "2"]
+        assert MockAddToChatHistory.await_count == 2
+
+def test_generate_answer_cached(mock_setup):
+    mock_graph = mock_setup["graph"]
+    mock_graph.ainvoke = AsyncMock(return_value={ "question": "What is the capital of France?", "answer": "Paris", "agents": {"agent_1": "Paris"} })
+
+    # The answer cache is opt-in
+    with patch.dict('main.cache_config', { "enabled": True }), \
+         patch('main.aget_chat_history', new_callable=AsyncMock) as MockGetChatHistory, \
+         patch('main.aadd_to_chat_history', new_callable=AsyncMock) as MockAddToChatHistory:
+        MockGetChatHistory.return_value = []
+        first = asyncio.run(generate_answer(body=QuestionModel(session_id="1", question="What is the capital of France?"), setup=mock_setup))
+        second = asyncio.run(generate_answer(body=QuestionModel(session_id="2", question="Which is the capital of France?"), setup=mock_setup))
+
+        # Assert the second question is answered from the cache, and still written to the history
+        mock_graph.ainvoke.assert_awaited_once()
+        assert first["cached"] is False
+        assert second["cached"] is True
+        assert second["answer"] == "Paris"
+        assert second["agents"] == {"agent_1": "Paris"}
+        assert MockAddToChatHistory.await_count == 2
+
+        # Assert the cache can be skipped
+        third = asyncio.run(generate_answer(body=QuestionModel(session_id="3", question="What is the capital of France?", use_cache=False), setup=mock_setup))
+        assert third["cached"] is False
+
+        # Assert questions asked within a conversation are neither answered from the cache nor cached
+        MockGetChatHistory.return_value = [{"role": "user", "content": "my name is Bob"}]
+        mock_graph.ainvoke.return_value = { "question": "What is my name?", "answer": "Bob", "agents": {"agent_1": "Bob"} }
+        fourth = asyncio.run(generate_answer(body=QuestionModel(session_id="1", question="What is the capital of France?"), setup=mock_setup))
+        assert fourth["cached"] is False
+        assert mock_graph.ainvoke.await_count == 3
+        asyncio.run(generate_answer(body=QuestionModel(session_id="1", question="What is my name?"), setup=mock_setup))
+        assert len(mock_setup["answer_cache"].entries) == 1
+
+def test_invalidate_cache(mock_setup):
+    mock_setup["answer_cache"].add("question", [1.0, 0.0], "answer", {"agent_1": "answer"})
+    assert invalidate_cache("agent_2", setup=mock_setup) == {"message": "Invalidated 0 cached answers."}
+    assert invalidate_cache("agent_1", setup=mock_setup) == {"message": "Invalidated 1 cached answers."}
+
+def test_get_trace_not_found(mock_setup):
+    with pytest.raises(HTTPException) as error:
+        get_trace("unknown", setup=mock_setup)
+    assert error.value.status_code == 404
+
+def test_ready(mock_setup):
+    mock_setup["timings"] = { "agent1": 0.1, "agent2": 0.2 }
+    result = ready(setup=mock_setup)
+
+    # Assert the readiness is reported per agent
+    assert result["ready"] is False
+    assert result["agents"] == [{ "agent": "agent1", "ready": True }, { "agent": "agent2", "ready": False }]
+    assert result["timings"] == { "agent1": 0.1, "agent2": 0.2 }
+
+def test_warm_up(mock_setup):
+    mock_setup["agents"][0].ensure_connected = MagicMock(return_value=True)
+    mock_setup["agents"][1].ensure_connected = MagicMock(return_value=False)
+    asyncio.run(warm_up(mock_setup))
+
+    # Assert every lazy backend is connected and timed
+    mock_setup["agents"][0].ensure_connected.assert_called_once()
+    mock_setup["agents"][1].ensure_connected.assert_called_once()
+    assert set(mock_setup["timings"].keys()) == { "agent1_backend", "agent2_backend" }
+
+def test_build_component():
+    timings = {}
+    assert build_component(timings, "component", lambda: "built") == "built"
+    assert "component" in timings
+
+def test_warm_routing_cache(mock_setup):
+    class MockEntity(dict):
+        def __init__(self, timestamp, **kwargs):
+            super().__init__(**kwargs)
+            self.metadata = { "timestamp": timestamp }
+
+    entities = [
+        MockEntity(2, PartitionKey="1", RowKey="b", role="bot", content="Paris", agent1="Paris"),
+        MockEntity(1, PartitionKey="1", RowKey="a", role="user", content="What is the capital of France?"),
+        MockEntity(3, PartitionKey="2", RowKey="c", role="user", content="What is the capital of Spain?"),
+        MockEntity(4, PartitionKey="2", RowKey="d", role="bot", content="Madrid", agent2="Madrid")
+    ]
+    read = []
+    async def list_entities():
+        for entity in entities:
+            read.append(entity)
+            yield entity
+    mock_setup["async_history_table"].list_entities = list_entities
+    mock_setup["routing_cache"] = RoutingCache()
+
+    # Assert the decisions are loaded in the order they were made
+    with patch.dict('main.routing_cache_config', {"warm_up_rows": 1}):
+        asyncio.run(warm_routing_cache(mock_setup))
+    assert mock_setup["routing_cache"].get("What is the capital of France?", []) == ["agent1"]
+
+    # Assert the session being read is finished past the rows limit, and the next one is not read
+    assert len(read) == 3
+    assert mock_setup["routing_cache"].get("What is the capital of Spain?", []) is None
+
+def test_get_metrics():
+    response = get_metrics()
+    assert response.media_type.startswith("text/plain")
+    assert b"# TYPE chatbot_requests_in_flight gauge" in response.body
+
 def test_store_feedback(mock_setup, mock_feedback):
     with patch('main.uuid') as MockId:
         mock_feedback_table = mock_setup["feedback_table"]
@@ -203,4 +467,39 @@ def test_delete_chat_history(mock_setup):
     # Assertions to verify expected behavior
     mock_history_table.query_entities.assert_called_once_with(f"PartitionKey eq '{mock_session_id}'")
     mock_history_table.delete_entity.assert_has_calls([call(partition_key=mock_session_id, row_key="2"), call(partition_key=mock_session_id, row_key="1")])
-    assert response == {"message": "Deleted 2 records successfully."}
\ No newline at end of file
+    assert response == {"message": "Deleted 2 records successfully."}
+
+def test_aget_chat_history(mock_setup):
+    mock_history_table = mock_setup["async_history_table"]
+    mock_session_id = "123"
+
+    async def mock_query_entities(query_filter):
+        for entity in [
+            MockEntity(PartitionKey=mock_session_id, RowKey="2", role="bot", content="Paris", metadata={"timestamp": datetime(2024, 12, 18, 12, 0, 1)}),
+            MockEntity(PartitionKey=mock_session_id, RowKey="1", role="user", content="What is the capital of France?", metadata={"timestamp": datetime(2024, 12, 18, 12, 0, 0)}),
+        ]:
+            yield entity
+    mock_history_table.query_entities = MagicMock(side_effect=mock_query_entities)
+
+    # Check results are sorted by timestamp
+    response = asyncio.run(aget_chat_history(mock_session_id, setup=mock_setup))
+    assert len(response) == 2
+    assert response[0]["content"] == "What is the capital of France?"
+    assert response[1]["content"] == "Paris"
+
+    # Check session id was used to query the table
+    mock_history_table.query_entities.assert_called_once_with(query_filter=f"PartitionKey eq '{mock_session_id}'")
+
+def test_aadd_to_chat_history(mock_setup, mock_answer):
+    with patch('main.uuid') as MockId:
+        mock_history_table = mock_setup["async_history_table"]
+        mock_user = MockEntity(PartitionKey=mock_answer.session_id, RowKey="123", role="user", content=mock_answer.question)
+        mock_bot = MockEntity(PartitionKey=mock_answer.session_id, RowKey="123", role="bot", content=mock_answer.answer, agent_1="agent answer", agent_2="agent answer")
+        MockId.uuid4.return_value = "123"
+
+        # Call the function under test
+        response = asyncio.run(aadd_to_chat_history(body=mock_answer, setup=mock_setup))
+
+        # Assertions to verify expected behavior
+        mock_history_table.create_entity.assert_has_awaits([call(entity=mock_user), call(entity=mock_bot)])
+        assert response == {"message": "Chat history updated successfully."}
@@ -0,0 +1,92 @@
+import pytest
+import os
+from modules import metrics
+from modules.metrics import MetricsRegistry, observe_span, record_agent_error
+from modules.tracing import ExecutionTrace
+
+@pytest.fixture
+def registry():
+    return MetricsRegistry()
+
+def test_counter(registry):
+    counter = registry.counter("test_total", "A test counter.", ["agent"])
+    counter.inc(agent="agent_rag")
+    counter.inc(2, agent="agent_rag")
+    counter.inc(agent="agent_sql")
+
+    # Assert the counter is rendered in Prometheus text format
+    lines = registry.render().splitlines()
+    assert lines[0] == "# HELP test_total A test counter."
+    assert lines[1] == "# TYPE test_total counter"
+    assert 'test_total{agent="agent_rag"} 3' in lines
+    assert 'test_total{agent="agent_sql"} 1' in lines
+
+def test_gauge(registry):
+    gauge = registry.gauge("test_in_flight", "A test gauge.")
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+
+    assert "test_in_flight 1" in registry.render().splitlines()
+
+def test_histogram(registry):
+    histogram = registry.histogram("test_seconds", "A test histogram.", ["node"], buckets=(0.1, 1))
+    histogram.observe(0.05, node="agent_node")
+    histogram.observe(0.5, node="agent_node")
+    histogram.observe(2, node="agent_node")
+
+    # Assert the buckets are cumulative
+    lines = registry.render().splitlines()
+    assert 'test_seconds_bucket{node="agent_node",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{node="agent_node",le="1"} 2' in lines
+    assert 'test_seconds_bucket{node="agent_node",le="+Inf"} 3' in lines
+    assert 'test_seconds_sum{node="agent_node"} 2.55' in lines
+    assert 'test_seconds_count{node="agent_node"} 3' in lines
+
+def test_label_escaping(registry):
+    counter = registry.counter("test_total", "A test counter.", ["chain"])
+    counter.inc(chain='say "hi"\n')
+
+    assert 'test_total{chain="say \\"hi\\"\\n"} 1' in registry.render().splitlines()
+
+def test_worker_label():
+    registry = MetricsRegistry(worker_label="worker")
+    counter = registry.counter("test_total", "A test counter.", ["agent"])
+    counter.inc(agent="agent_rag")
+    histogram = registry.histogram("test_seconds", "A test histogram.", buckets=(1,))
+    histogram.observe(0.5)
+
+    # Assert every series says which worker it comes from
+    lines = registry.render().splitlines()
+    pid = os.getpid()
+    assert f'test_total{{agent="agent_rag",worker="{pid}"}} 1' in lines
+    assert f'test_seconds_bucket{{worker="{pid}",le="1"}} 1' in lines
+    assert f'test_seconds_count{{worker="{pid}"}} 1' in lines
+
+def test_observe_span():
+    tokens_before = metrics.llm_tokens.values.get(("agent_rag_node", "prompt"), 0)
+    observe_span({ "name": "AzureChatOpenAI", "kind": "llm", "node": "agent_rag_node", "start": 1, "end": 2, "tokens": { "prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15 } })
+    observe_span({ "name": "vector_search", "kind": "io", "node": "agent_rag_node", "start": 1, "end": 1.5 })
+
+    # Assert the span durations and tokens are recorded
+    assert metrics.llm_tokens.values[("agent_rag_node", "prompt")] == tokens_before + 10
+    assert metrics.llm_duration.values[("agent_rag_node", "AzureChatOpenAI")]["count"] >= 1
+    assert metrics.io_duration.values[("vector_search",)]["count"] >= 1
+
+def test_trace_feeds_metrics():
+    count_before = metrics.request_duration.values.get(("/api/test",), {}).get("count", 0)
+    trace = ExecutionTrace("request-1", name="/api/test", on_span_end=observe_span)
+    with trace.span("history_read"):
+        pass
+    trace.end()
+
+    # Assert the finished spans are turned into metrics
+    assert metrics.request_duration.values[("/api/test",)]["count"] == count_before + 1
+    assert metrics.io_duration.values[("history_read",)]["count"] >= 1
+
+def test_record_agent_error():
+    exceptions_before = metrics.agent_exceptions.values.get(("agent_test",), 0)
+    record_agent_error("agent_test")
+
+    assert metrics.agent_exceptions.values[("agent_test",)] == exceptions_before + 1
+    assert metrics.agent_fallbacks.values[("agent_test", "error")] >= 1
@@ -0,0 +1,72 @@
+import pytest
+from unittest.mock import patch
+from modules.prompt_budget import PromptBudget, budget_prompt, TRUNCATED
+from modules import metrics
+
+class FakeEncoding:
+    # One token per word
+    def encode(self, text, disallowed_special=()):
+        return text.split(" ")
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+@pytest.fixture
+def budget():
+    budget = PromptBudget(
+        default={ "history": 10, "result": 5, "context": None },
+        chains={ "entry_point_chain": { "history": 4 }, "agent_sql.answer_generator_chain": { "result": 3 } }
+    )
+    budget.encoding = FakeEncoding()
+    return budget
+
+def test_get_budget(budget):
+    assert budget.get_budget("agent_rag", "entry_point_chain") == { "history": 4, "result": 5, "context": None }
+    assert budget.get_budget("agent_sql", "answer_generator_chain") == { "history": 10, "result": 3, "context": None }
+    assert budget.get_budget("agent_csv", "answer_generator_chain") == { "history": 10, "result": 5, "context": None }
+
+def test_truncate(budget):
+    assert budget.truncate("one two three", 5) == ("one two three", 3)
+    assert budget.truncate("one two three four five six", 2) == ("one two" + TRUNCATED, 2)
+
+def test_truncate_history(budget):
+    history = [{ "role": "user", "content": "first" }, { "role": "bot", "content": "second" }, { "role": "user", "content": "third" }]
+
+    # The most recent entries are kept
+    kept, tokens = budget.truncate_history(history, 9)
+    assert kept == history[1:]
+    assert tokens == 8
+
+    # The same list is returned when it fits
+    assert budget.truncate_history(history, 100)[0] is history
+
+def test_fit(budget):
+    inputs = { "question": "how many orders?", "result": [(1, "a"), (2, "b"), (3, "c"), (4, "d")], "context": "a b c d e f g h", "history": [] }
+    fitted = budget.fit("agent_sql", "answer_generator_chain", inputs)
+
+    # The question is never touched, the result is cut to the chain budget and the context has no limit
+    assert fitted["question"] == inputs["question"]
+    assert fitted["result"] == "[(1, 'a'), (2," + TRUNCATED
+    assert fitted["context"] is inputs["context"]
+    assert fitted["history"] is inputs["history"]
+    assert metrics.prompt_truncations.values[("answer_generator_chain", "result")] >= 1
+    assert metrics.prompt_section_tokens.values[("answer_generator_chain", "context")]["sum"] >= 8
+
+def test_fit_unchanged(budget):
+    # Sections within their budget are passed as they are, so the prompt renders the same
+    inputs = { "question": "hi", "result": [(1, "a")], "history": [{ "role": "user", "content": "hi" }] }
+    fitted = budget.fit("agent_sql", "answer_generator_chain", inputs)
+    assert fitted["result"] is inputs["result"]
+    assert fitted["history"] is inputs["history"]
+
+def test_estimate_without_encoding():
+    budget = PromptBudget(default={ "result": 2 })
+    with patch('modules.prompt_budget.tiktoken.get_encoding', side_effect=Exception("offline")):
+        assert budget.count("12345678") == 2
+        assert budget.fit("agent_sql", "answer_generator_chain", { "result": "123456789" })["result"] == "12345678" + TRUNCATED
+
+def test_budget_prompt(budget):
+    with patch('modules.prompt_budget.prompt_budget', budget):
+        step = budget_prompt("agent_rag", "entry_point_chain")
+        fitted = step.invoke({ "question": "hi", "history": [{ "content": "a b c" }, { "content": "d" }] })
+    assert fitted["history"] == [{ "content": "d" }]
@@ -0,0 +1,74 @@
+import pytest
+import asyncio
+import numpy as np
+from unittest.mock import MagicMock, AsyncMock
+from modules.router import EmbeddingRouter
+
+# Each text is embedded in a fixed direction, so the similarities are known
+EMBEDDINGS = {
+    "sql skills": [1.0, 0.0, 0.0],
+    "best selling products?": [0.9, 0.1, 0.0],
+    "csv skills": [0.0, 1.0, 0.0],
+    "marvel characters?": [0.0, 0.9, 0.1],
+    "api skills": [0.0, 0.0, 1.0]
+}
+
+@pytest.fixture
+def agents():
+    agents = []
+    for name in ["sql", "csv", "api"]:
+        agent = MagicMock(skills=f"{name} skills")
+        agent.name = f"agent_{name}"
+        agents.append(agent)
+    return agents
+
+def create_router(agents, **kwargs):
+    embed_documents = AsyncMock(side_effect=lambda texts: [EMBEDDINGS[text] for text in texts])
+    examples = { "agent_sql": ["best selling products?"], "agent_csv": ["marvel characters?"] }
+    router = EmbeddingRouter(AsyncMock(return_value=[1.0, 0.0, 0.0]), embed_documents, agents, examples=examples, **kwargs)
+    asyncio.run(router.aload())
+    return router
+
+def vector(*values):
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def test_aload(agents):
+    router = create_router(agents)
+
+    # Assert the skills and examples of every agent are embedded at once
+    router.embed_documents.assert_awaited_once_with(["sql skills", "best selling products?", "csv skills", "marvel characters?", "api skills"])
+    assert router.matrix.shape == (5, 3)
+    assert router.centroids.shape == (3, 3)
+    assert np.allclose(np.linalg.norm(router.centroids, axis=1), 1)
+
+    # Assert it is only done once
+    asyncio.run(router.aload())
+    router.embed_documents.assert_awaited_once()
+
+def test_route_not_loaded(agents):
+    router = EmbeddingRouter(AsyncMock(), AsyncMock(), agents)
+    assert router.route(vector(1, 0, 0)) is None
+
+def test_route_centroid(agents):
+    router = create_router(agents, min_similarity=0.7, min_margin=0.1)
+
+    # Assert a clear question is routed to the closest agent
+    assert router.route(vector(1, 0.05, 0)) == ["agent_sql"]
+    assert router.route(vector(0, 0, 1)) == ["agent_api"]
+
+    # Assert it gives up when two agents are too close, or none is close enough
+    assert router.route(vector(1, 1, 0)) is None
+    assert router.route(vector(1, 1, 1)) is None
+
+def test_route_top_k(agents):
+    router = create_router(agents, strategy="top_k", top_k=3, min_similarity=0.7, min_margin=0.1)
+
+    assert router.route(vector(0.1, 1, 0.1)) == ["agent_csv"]
+    assert router.route(vector(1, 1, 0)) is None
+
+def test_aembed(agents):
+    router = create_router(agents)
+    result = asyncio.run(router.aembed("question"))
+    assert result.dtype == np.float32
+    assert np.allclose(result, [1, 0, 0])
@@ -0,0 +1,54 @@
+import pytest
+from modules import metrics
+from modules.routing_cache import RoutingCache
+
+@pytest.fixture
+def history():
+    return [{"role": "user", "content": "hi!"}, {"role": "bot", "content": "hi! how can I help you?", "agent_rag": "hello"}]
+
+def test_get_add(history):
+    cache = RoutingCache()
+    hits_before = metrics.routing_cache_requests.values.get(("hit",), 0)
+    misses_before = metrics.routing_cache_requests.values.get(("miss",), 0)
+
+    assert cache.get("What is the capital of France?", history) is None
+    cache.add("What is the capital of France?", history, ["agent_rag"])
+
+    # Assert the decision is found for the same question and history, ignoring case and spacing
+    assert cache.get("what is the capital  of france?", history) == ["agent_rag"]
+    assert cache.get("What is the capital of France?", []) is None
+
+    # Assert hits and misses are counted
+    assert metrics.routing_cache_requests.values[("hit",)] == hits_before + 1
+    assert metrics.routing_cache_requests.values[("miss",)] == misses_before + 2
+
+def test_add_empty(history):
+    cache = RoutingCache()
+    cache.add("What is the capital of France?", history, [])
+    assert len(cache) == 0
+
+def test_warm():
+    session = [
+        {"role": "user", "content": "hello"},
+        {"role": "bot", "content": "Hi!", "agent_rag": "Hi!", "agent_sql": "Hi!"},
+        {"role": "user", "content": "How many products are there?"},
+        {"role": "bot", "content": "There are 10 products", "agent_sql": "There are 10 products"}
+    ]
+    cache = RoutingCache()
+
+    # Assert every question is loaded with the history it was asked with
+    assert cache.warm([session, [{"role": "user", "content": "unanswered question"}]], ["agent_rag", "agent_sql"]) == 2
+    assert cache.get("hello", []) == ["agent_rag", "agent_sql"]
+    assert cache.get("How many products are there?", session[:2]) == ["agent_sql"]
+
+def test_warm_incomplete_session():
+    # The first question has no answer, the history of the second one can't be rebuilt
+    session = [
+        {"role": "user", "content": "hello"},
+        {"role": "user", "content": "How many products are there?"},
+        {"role": "bot", "content": "There are 10 products", "agent_sql": "There are 10 products"}
+    ]
+    cache = RoutingCache()
+
+    assert cache.warm([session, session[1:] + session[:1]], ["agent_sql"]) == 0
+    assert len(cache) == 0
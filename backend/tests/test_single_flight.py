@@ -0,0 +1,63 @@
+import asyncio
+from unittest.mock import AsyncMock
+from modules.single_flight import SingleFlight
+
+def test_run_shared():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def func():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def run_concurrently():
+        return await asyncio.gather(single_flight.run("key", func), single_flight.run("key", func), single_flight.run("other", func))
+
+    # Assert the calls with the same key share one execution
+    assert asyncio.run(run_concurrently()) == ["result", "result", "result"]
+    assert len(calls) == 2
+    assert single_flight.in_flight == {}
+
+def test_run_sequential():
+    single_flight = SingleFlight()
+    func = AsyncMock(return_value="result")
+
+    async def run_one_after_another():
+        return [await single_flight.run("key", func), await single_flight.run("key", func)]
+
+    # Assert calls that don't overlap are not shared
+    assert asyncio.run(run_one_after_another()) == ["result", "result"]
+    assert func.await_count == 2
+
+def test_run_error():
+    single_flight = SingleFlight()
+
+    async def func():
+        await asyncio.sleep(0.05)
+        raise ValueError("Mocked exception")
+
+    async def run_concurrently():
+        return await asyncio.gather(single_flight.run("key", func), single_flight.run("key", func), return_exceptions=True)
+
+    # Assert every caller gets the error
+    results = asyncio.run(run_concurrently())
+    assert all(isinstance(result, ValueError) for result in results)
+
+def test_run_cancelled_caller():
+    single_flight = SingleFlight()
+
+    async def func():
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def cancel_first_caller():
+        first = asyncio.create_task(single_flight.run("key", func))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(single_flight.run("key", func))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    # Assert the other callers still get the result
+    assert asyncio.run(cancel_first_caller()) == "result"
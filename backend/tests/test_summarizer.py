@@ -1,16 +1,21 @@
 import pytest
+import asyncio
 from unittest.mock import MagicMock, patch
 from modules.models import State
 from modules.summarizer import Summarizer
 
 @pytest.fixture
-def summarizer():
-    with patch('modules.summarizer.AzureChatOpenAI') as MockLLM:
+def mock_llm():
+    return MagicMock()
+
+@pytest.fixture
+def summarizer(mock_llm):
+    with patch('modules.summarizer.get_llm') as MockLLM:
         # Mock the LLM
-        MockLLM.return_value = MagicMock()
+        MockLLM.return_value = mock_llm
         return Summarizer()
 
-def test_generate_answer(summarizer):
+def test_generate_answer(summarizer, mock_llm):
     # Mock state
     mock_question = "This is a test question"
     mock_agent_1_output = "response_1"
@@ -20,16 +25,59 @@ def test_generate_answer(summarizer):
 
     # Mock LLM response
     mock_answer = "This is a test answer"
-    summarizer.llm.return_value = mock_answer
+    mock_llm.return_value = mock_answer
 
     # Call the method under test
     response = summarizer.generate_answer(State(state))
     
     # Assert that the user question and each of the agents outputs were used when generating an answer
-    assert mock_question in summarizer.llm.call_args[0][0].messages[1].content
-    assert mock_agent_1_output in summarizer.llm.call_args[0][0].messages[0].content
-    assert mock_agent_2_output in summarizer.llm.call_args[0][0].messages[0].content
-    assert mock_agent_3_output in summarizer.llm.call_args[0][0].messages[0].content
+    assert mock_question in mock_llm.call_args[0][0].messages[1].content
+    assert mock_agent_1_output in mock_llm.call_args[0][0].messages[0].content
+    assert mock_agent_2_output in mock_llm.call_args[0][0].messages[0].content
+    assert mock_agent_3_output in mock_llm.call_args[0][0].messages[0].content
 
     # Assert the final answer
-    assert response == {"answer": mock_answer}
\ No newline at end of file
+    assert response == {"answer": mock_answer}
+
+def test_agenerate_answer(summarizer, mock_llm):
+    state = {"agents": {"agent_1": "response_1", "agent_2": "response_2"}, "question": "This is a test question" }
+
+    # Mock LLM response
+    mock_llm.return_value = "This is a test answer"
+
+    # Call the method under test
+    response = asyncio.run(summarizer.agenerate_answer(State(state)))
+
+    # Assert the agents outputs were used and the final answer
+    assert "response_1" in mock_llm.call_args[0][0].messages[0].content
+    assert "response_2" in mock_llm.call_args[0][0].messages[0].content
+    assert response == {"answer": "This is a test answer"}
+
+def test_is_non_answer(summarizer):
+    # The default detector only matches the agents fallback answer
+    assert summarizer.is_non_answer("I don't know")
+    assert summarizer.is_non_answer("")
+    assert summarizer.is_non_answer(None)
+    assert not summarizer.is_non_answer("Paris is the capital of France")
+
+    # The patterns can be configured
+    with patch('modules.summarizer.get_llm'):
+        custom_summarizer = Summarizer({"non_answer_patterns": [r"not in the provided data"]})
+    assert custom_summarizer.is_non_answer("The answer is not in the provided data.")
+    assert not custom_summarizer.is_non_answer("Paris is the capital of France")
+
+def test_route_answers(summarizer):
+    # A single real answer doesn't need a summary
+    state = {"agents": {"agent_1": "response_1", "agent_2": "I don't know"}, "question": "This is a test question"}
+    assert summarizer.route_answers(State(state)) == "bypass"
+    assert summarizer.bypass(State(state)) == {"answer": "response_1"}
+
+    state = {"agents": {"agent_1": "response_1"}, "question": "This is a test question"}
+    assert summarizer.route_answers(State(state)) == "bypass"
+
+    # More than one real answer, or none, goes through the summarizer
+    state = {"agents": {"agent_1": "response_1", "agent_2": "response_2"}, "question": "This is a test question"}
+    assert summarizer.route_answers(State(state)) == "summarize"
+
+    state = {"agents": {"agent_1": "I don't know"}, "question": "This is a test question"}
+    assert summarizer.route_answers(State(state)) == "summarize"
@@ -1,12 +1,18 @@
 import pytest
-from unittest.mock import MagicMock, patch
+import asyncio
+from unittest.mock import MagicMock, AsyncMock, patch
 from modules.supervisor import Supervisor
+from modules.routing_cache import RoutingCache
 
 @pytest.fixture
-def supervisor():
-    with patch('modules.supervisor.AzureChatOpenAI') as MockLLM:
+def mock_llm():
+    return MagicMock()
+
+@pytest.fixture
+def supervisor(mock_llm):
+    with patch('modules.supervisor.get_llm') as MockLLM:
         # Mock the LLM
-        MockLLM.return_value = MagicMock()
+        MockLLM.return_value = mock_llm
         # Mock available agents
         MockAgent1 = MagicMock()
         MockAgent2 = MagicMock()
@@ -21,18 +27,18 @@ def supervisor():
         
         return Supervisor(agents)
 
-def test_get_relevant_agents(supervisor):
+def test_get_relevant_agents(supervisor, mock_llm):
     # Mock LLM response
-    supervisor.llm.return_value = "agent_1, agent_2"
+    mock_llm.return_value = "agent_1, agent_2"
 
     agents = supervisor.get_relevant_agents({"question": "test_question", "history": []})
     assert agents == { "relevant_agents": ["agent_1", "agent_2"] }
 
     # Assert that the user question and the list of agents were used when choosing relevant agents
-    assert "test_question" in supervisor.llm.call_args[0][0].messages[1].content
-    assert "agent_1" in supervisor.llm.call_args[0][0].messages[0].content
-    assert "agent_2" in supervisor.llm.call_args[0][0].messages[0].content
-    assert "agent_3" in supervisor.llm.call_args[0][0].messages[0].content
+    assert "test_question" in mock_llm.call_args[0][0].messages[1].content
+    assert "agent_1" in mock_llm.call_args[0][0].messages[0].content
+    assert "agent_2" in mock_llm.call_args[0][0].messages[0].content
+    assert "agent_3" in mock_llm.call_args[0][0].messages[0].content
 
 def test_generate_answer(supervisor):
     relevant_agents = ["agent_1", "agent_2", "agent_3"]   
@@ -53,4 +59,116 @@ def test_generate_answer(supervisor):
     # Test when all agents have responded
     state = {"agents": {"agent_1": "response_1", "agent_2": "response_2", "agent_3": "response_3"}, "question": "test_question", "relevant_agents": relevant_agents}
     result = supervisor.generate_answer(state)
-    assert result == {"next": "FINISH"}
\ No newline at end of file
+    assert result == {"next": "FINISH"}
+def test_get_pending_agents(supervisor):
+    relevant_agents = ["agent_1", "agent_3", "unknown_agent"]
+
+    # All the known relevant agents are returned at once
+    state = {"agents": {}, "question": "test_question", "relevant_agents": relevant_agents}
+    assert supervisor.get_pending_agents(state) == ["agent_1", "agent_3"]
+
+    # Agents that already answered are not triggered again
+    state = {"agents": {"agent_1": "response_1"}, "question": "test_question", "relevant_agents": relevant_agents}
+    assert supervisor.get_pending_agents(state) == ["agent_3"]
+
+    # Test when there is nothing left to do
+    state = {"agents": {}, "question": "test_question", "relevant_agents": []}
+    assert supervisor.get_pending_agents(state) == ["FINISH"]
+
+def test_join_answers(supervisor):
+    state = {"agents": {"agent_1": "response_1"}, "question": "test_question", "relevant_agents": ["agent_1"]}
+    assert supervisor.join_answers(state) == {}
+
+def test_aget_relevant_agents(supervisor, mock_llm):
+    # Mock LLM response
+    mock_llm.return_value = "agent_1, agent_3"
+
+    agents = asyncio.run(supervisor.aget_relevant_agents({"question": "test_question", "history": []}))
+    assert agents == { "relevant_agents": ["agent_1", "agent_3"] }
+    assert "test_question" in mock_llm.call_args[0][0].messages[1].content
+
+def test_aget_relevant_agents_router(supervisor, mock_llm):
+    supervisor.router = MagicMock(aload=AsyncMock(), aembed=AsyncMock(return_value=[1.0, 0.0]), route=MagicMock(return_value=["agent_2"]))
+    mock_llm.return_value = "agent_1, agent_3"
+
+    # Assert the router picks the agent without the LLM
+    agents = asyncio.run(supervisor.aget_relevant_agents({"question": "test_question", "history": []}))
+    assert agents == { "relevant_agents": ["agent_2"] }
+    supervisor.router.route.assert_called_once_with([1.0, 0.0])
+    mock_llm.assert_not_called()
+
+    # Assert the embedding from the state is reused
+    asyncio.run(supervisor.aget_relevant_agents({"question": "test_question", "history": [], "embedding": [0.0, 1.0]}))
+    supervisor.router.aembed.assert_awaited_once()
+    supervisor.router.route.assert_called_with([0.0, 1.0])
+
+    # Assert the LLM is used when the router is not sure
+    supervisor.router.route.return_value = None
+    agents = asyncio.run(supervisor.aget_relevant_agents({"question": "test_question", "history": []}))
+    assert agents == { "relevant_agents": ["agent_1", "agent_3"] }
+
+def test_aget_relevant_agents_router_error(supervisor, mock_llm):
+    supervisor.router = MagicMock(aload=AsyncMock(side_effect=Exception("Mocked exception")))
+    mock_llm.return_value = "agent_1"
+
+    # Assert the LLM is used when the router fails
+    agents = asyncio.run(supervisor.aget_relevant_agents({"question": "test_question", "history": []}))
+    assert agents == { "relevant_agents": ["agent_1"] }
+
+def test_aget_relevant_agents_cache(supervisor, mock_llm):
+    supervisor.cache = RoutingCache()
+    mock_llm.return_value = "agent_1, agent_3"
+    state = {"question": "test_question", "history": []}
+
+    # Assert the LLM is called only the first time
+    assert asyncio.run(supervisor.aget_relevant_agents(state)) == { "relevant_agents": ["agent_1", "agent_3"] }
+    assert asyncio.run(supervisor.aget_relevant_agents(state)) == { "relevant_agents": ["agent_1", "agent_3"] }
+    assert supervisor.get_relevant_agents(state) == { "relevant_agents": ["agent_1", "agent_3"] }
+    mock_llm.assert_called_once()
+
+def test_aget_relevant_agents_fused(supervisor, mock_llm):
+    supervisor.fused = True
+    mock_llm.return_value = '```json\n{"agents": [{"name": "agent_1", "answer": "Paris"}, {"name": "agent_2", "answer": "CONTINUE"}, {"name": "unknown", "answer": "CONTINUE"}]}\n```'
+
+    # Assert the known agents are returned with their answers
+    agents = asyncio.run(supervisor.aget_relevant_agents({"question": "test_question", "history": []}))
+    assert agents == { "relevant_agents": ["agent_1", "agent_2"], "entry_answers": { "agent_1": "Paris", "agent_2": "CONTINUE" } }
+    assert "test_question" in mock_llm.call_args[0][0].messages[1].content
+    assert "agent_3" in mock_llm.call_args[0][0].messages[0].content
+
+    # Assert the sync path works the same way
+    assert supervisor.get_relevant_agents({"question": "test_question", "history": []}) == agents
+
+def test_get_relevant_agents_fused_malformed(supervisor, mock_llm):
+    supervisor.fused = True
+    state = {"question": "test_question", "history": []}
+
+    # Assert a reply that is not JSON falls back to the standard routing
+    mock_llm.side_effect = ['{"agents": agent_1}', "agent_1, agent_3"]
+    assert asyncio.run(supervisor.aget_relevant_agents(state)) == { "relevant_agents": ["agent_1", "agent_3"] }
+    mock_llm.side_effect = ["not json", "agent_2"]
+    assert supervisor.get_relevant_agents(state) == { "relevant_agents": ["agent_2"] }
+
+def test_get_relevant_agents_fused_empty(supervisor, mock_llm):
+    supervisor.fused = True
+    state = {"question": "test_question", "history": []}
+
+    # Assert a reply without known agents falls back to the standard routing
+    mock_llm.side_effect = ['{"agents": []}', "agent_1"]
+    assert asyncio.run(supervisor.aget_relevant_agents(state)) == { "relevant_agents": ["agent_1"] }
+    mock_llm.side_effect = ['{"agents": [{"name": "unknown", "answer": "CONTINUE"}]}', "agent_3"]
+    assert supervisor.get_relevant_agents(state) == { "relevant_agents": ["agent_3"] }
+    assert mock_llm.call_count == 4
+
+def test_skip_unavailable_agents(supervisor, mock_llm):
+    # The backend of agent_2 is down
+    supervisor.availability["agent_2"] = MagicMock(return_value=False)
+    mock_llm.return_value = "agent_1, agent_2"
+
+    result = supervisor.get_relevant_agents({"question": "test_question", "history": []})
+
+    # The agent is answered in the routing step, so the graph doesn't run it
+    assert result["relevant_agents"] == ["agent_1", "agent_2"]
+    assert result["agents"] == { "agent_2": "I don't know (unavailable)" }
+    assert result["unavailable"] == ["agent_2"]
+    assert supervisor.get_pending_agents({ **result, "agents": result["agents"] }) == ["agent_1"]
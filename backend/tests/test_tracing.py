@@ -0,0 +1,104 @@
+import pytest
+from langchain_core.runnables import RunnableLambda
+from langchain_core.outputs import LLMResult, ChatGeneration
+from langchain_core.messages import AIMessage
+from modules.tracing import ExecutionTrace, TraceStore, trace_span, get_token_usage
+
+@pytest.fixture
+def trace():
+    return ExecutionTrace("request-1")
+
+def find_span(span, name):
+    # Depth-first search of a span by name
+    if span["name"] == name:
+        return span
+    for child in span["children"]:
+        found = find_span(child, name)
+        if found is not None:
+            return found
+    return None
+
+def test_span(trace):
+    with trace.span("history_read"):
+        pass
+    with pytest.raises(ValueError):
+        with trace.span("history_write"):
+            raise ValueError("Mocked exception")
+    trace.end()
+
+    result = trace.to_dict()
+    assert result["request_id"] == "request-1"
+    assert result["trace"]["name"] == "request"
+    assert result["trace"]["duration_ms"] is not None
+
+    # Assert spans are nested under the request and errors are recorded
+    children = result["trace"]["children"]
+    assert [child["name"] for child in children] == ["history_read", "history_write"]
+    assert "error" not in children[0]
+    assert children[1]["error"] == "Mocked exception"
+
+def test_trace_runs(trace):
+    # A node that calls a named chain and does some I/O
+    def io_call(x):
+        with trace_span("vector_search"):
+            return x
+    chain = RunnableLambda(lambda x: x) | RunnableLambda(io_call)
+    chain = chain.with_config(run_name="entry_point_chain")
+    node = RunnableLambda(lambda x: chain.invoke(x), name="agent_node")
+
+    node.invoke("question", config={"callbacks": [trace], "metadata": {"langgraph_node": "agent_node"}})
+    trace.end()
+
+    # Assert the named runs are recorded as a tree, skipping the anonymous ones
+    root = trace.to_dict()["trace"]
+    node_span = find_span(root, "agent_node")
+    assert node_span["kind"] == "graph"
+    chain_span = find_span(node_span, "entry_point_chain")
+    assert chain_span["kind"] == "chain"
+    io_span = find_span(chain_span, "vector_search")
+    assert io_span["kind"] == "io"
+    assert io_span["duration_ms"] is not None
+    assert find_span(root, "RunnableLambda") is None
+
+def test_trace_span_without_trace():
+    # Nothing is recorded when the code doesn't run within a traced request
+    with trace_span("vector_search") as span_id:
+        assert span_id is None
+
+def test_get_token_usage():
+    response = LLMResult(generations=[[]], llm_output={"token_usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}})
+    assert get_token_usage(response) == {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15}
+
+    message = AIMessage(content="answer", usage_metadata={"input_tokens": 7, "output_tokens": 3, "total_tokens": 10})
+    response = LLMResult(generations=[[ChatGeneration(message=message)]])
+    assert get_token_usage(response) == {"prompt_tokens": 7, "completion_tokens": 3, "total_tokens": 10}
+
+    assert get_token_usage(LLMResult(generations=[[]])) is None
+
+def test_trace_store():
+    store = TraceStore(max_traces=2)
+    for request_id in ["request-1", "request-2", "request-3"]:
+        store.add(ExecutionTrace(request_id))
+
+    # Assert the oldest trace was dropped
+    assert store.get("request-1") is None
+    assert store.get("request-2")["request_id"] == "request-2"
+    assert store.get("request-3")["request_id"] == "request-3"
+
+def test_trace_store_shared(tmp_path):
+    # Two workers share the file, a finished trace is found by both
+    path = str(tmp_path / "traces.sqlite")
+    first, second = TraceStore(max_traces=2, path=path), TraceStore(max_traces=2, path=path)
+    trace = ExecutionTrace("request-1", on_end=first.save)
+    first.add(trace)
+    assert second.get("request-1") is None
+
+    trace.end()
+    assert second.get("request-1") == first.get("request-1")
+    assert second.get("request-1")["trace"]["duration_ms"] is not None
+
+    # The oldest traces over the limit are dropped from the file too
+    for request_id in ["request-2", "request-3"]:
+        first.save(ExecutionTrace(request_id))
+    assert second.get("request-1") is None
+    assert second.get("request-3")["request_id"] == "request-3"
@@ -1,5 +1,5 @@
 import pytest
-from modules.utils import filter_agent_history
+from modules.utils import filter_agent_history, merge_agents_output, normalize_question, get_question_key
 
 @pytest.fixture
 def history():
@@ -68,4 +68,27 @@ def test_filter_agent_history(history):
 
     # Test empty history
     result = filter_agent_history([], "rag")
-    assert result == []
\ No newline at end of file
+    assert result == []
+def test_merge_agents_output():
+    # Entries from different agents are merged
+    result = merge_agents_output({"agent_rag": "RAG response."}, {"agent_sql": "SQL response."})
+    assert result == {"agent_rag": "RAG response.", "agent_sql": "SQL response."}
+
+    # The latest entry for the same agent wins
+    result = merge_agents_output({"agent_rag": "RAG response."}, {"agent_rag": "New RAG response."})
+    assert result == {"agent_rag": "New RAG response."}
+
+    # Missing values are handled
+    assert merge_agents_output(None, {"agent_rag": "RAG response."}) == {"agent_rag": "RAG response."}
+    assert merge_agents_output({"agent_rag": "RAG response."}, None) == {"agent_rag": "RAG response."}
+
+def test_normalize_question():
+    assert normalize_question("  What is   the Capital of France? ") == "what is the capital of france?"
+
+def test_get_question_key(history):
+    key = get_question_key("What is the capital of France?", history)
+
+    # Assert the key ignores case and spacing, but not the history
+    assert get_question_key("what is the capital  of France?", [dict(entry) for entry in history]) == key
+    assert get_question_key("What is the capital of France?", history[:2]) != key
+    assert get_question_key("What is the capital of Italy?", history) != key
@@ -23,6 +23,13 @@ describe("AgentIcon component", () => {
     expect(badge).toHaveClass("bg-danger");
   });
 
+  it("renders with an unknown status", () => {
+    render(<AgentIcon status={null} name="Agent1" tooltip={false} />);
+    const badge = screen.getByText("?");
+    expect(badge).toBeInTheDocument();
+    expect(badge).toHaveClass("bg-default");
+  });
+
   it("renders with a tooltip when tooltip is true", () => {
     render(<AgentIcon status={true} name="Agent1" tooltip={true} />);
     const tooltip = screen.getByTestId("tooltip");
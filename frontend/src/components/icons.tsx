@@ -9,7 +9,8 @@ export const Logo: React.FC<IconSvgProps> = () => (
 );
 
 interface AgentIconProps {
-  status: boolean;
+  // null while the backend has not checked the agent yet
+  status: boolean | null;
   name: string;
   tooltip?: boolean;
 }
@@ -21,8 +22,8 @@ export const AgentIcon = ({
 }: AgentIconProps) => {
   return (
     <Badge
-      color={status ? "success" : "danger"}
-      content={status ? "✓" : "!"}
+      color={status === null ? "default" : status ? "success" : "danger"}
+      content={status === null ? "?" : status ? "✓" : "!"}
       shape="circle"
       placement="top-right"
     >